@@ -1,7 +1,23 @@
 from desfire_ev1.desfire_ev1_card import DesfireCard
 from desfire_ev1.applications import ApplicationManager
 from desfire_ev1.files import FileManager
-from desfire_ev1.utils import to_3bytes, to_4bytes, from_4bytes
-from desfire_ev1.crypto import des_cbc_encrypt, des_cbc_decrypt
+from desfire_ev1.utils import to_3bytes, to_4bytes, from_3bytes, from_4bytes
+from desfire_ev1.crypto import des_cbc_encrypt, des_cbc_decrypt, CipherContext
+from desfire_ev1.metrics import CardMetrics, default_metrics
+from desfire_ev1.profiler import SessionProfiler, profiler
+from desfire_ev1.session import SecureSession
+from desfire_ev1.keys import StaticKeys, KeyDiversifier
+from desfire_ev1.provisioning import Provisioner
+from desfire_ev1.shadow import CardShadow, DiffWriter
+from desfire_ev1.inventory import CardInventory
+from desfire_ev1.planner import StoragePlanner
+from desfire_ev1.segments import SegmentedReader
+from desfire_ev1.journal import ProvisioningJournal
+from desfire_ev1.tuning import ReaderProfile, ReaderProfiles, probe_reader
+from desfire_ev1.exceptions import DesfireError, AuthenticationError, IntegrityError, StorageError
 
-__all__ = ['DesfireCard', 'ApplicationManager', 'FileManager', 'to_3bytes', 'to_4bytes', 'from_4bytes']
+__all__ = ['DesfireCard', 'ApplicationManager', 'FileManager', 'to_3bytes', 'to_4bytes', 'from_3bytes', 'from_4bytes',
+           'des_cbc_encrypt', 'des_cbc_decrypt', 'CipherContext',
+           'CardMetrics', 'default_metrics', 'SessionProfiler', 'profiler',
+           'SecureSession', 'StaticKeys', 'KeyDiversifier', 'Provisioner', 'CardShadow', 'DiffWriter', 'CardInventory', 'StoragePlanner', 'SegmentedReader', 'ProvisioningJournal', 'ReaderProfile', 'ReaderProfiles', 'probe_reader', 'DesfireError', 'AuthenticationError', 'IntegrityError',
+           'StorageError']
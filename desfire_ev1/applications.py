@@ -1,4 +1,12 @@
-from smartcard.util import toHexString
+import logging
+from desfire_ev1.log import LazyHex
+
+log = logging.getLogger(__name__)
+
+# Crypto method flags OR-ed into num_keys by create_application
+APP_KEYS_DES = 0x00
+APP_KEYS_3K3DES = 0x40
+APP_KEYS_AES = 0x80
 
 class ApplicationManager:
     def __init__(self, card):
@@ -13,27 +21,27 @@ class ApplicationManager:
         if sw1 == 0x91 and sw2 == 0x00:
             aids = [data[i:i+3] for i in range(0, len(data), 3)]
             for aid in aids:
-                print(f"Application: {toHexString(aid)}")
+                log.debug("Application: %s", LazyHex(aid))
             return aids
         return []
     
     def create_application(self, aid, key_settings=0x0F, num_keys=0x01):
-        """Create new application"""
+        """Create new application (OR num_keys with APP_KEYS_AES/APP_KEYS_3K3DES for EV1 keys)"""
         apdu = [0x90, 0xCA, 0x00, 0x00, 0x05] + aid + [key_settings, num_keys, 0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Create app {toHexString(aid)} - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Create app %s - Status: %02X %02X", LazyHex(aid), sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
     def delete_application(self, aid):
         """Delete application"""
         apdu = [0x90, 0xDA, 0x00, 0x00, 0x03] + aid + [0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Delete {toHexString(aid)} - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Delete %s - Status: %02X %02X", LazyHex(aid), sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
     def change_key_settings(self, new_settings):
         """Change PICC key settings"""
         apdu = [0x90, 0x54, 0x00, 0x00, 0x01, new_settings, 0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Change key settings - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Change key settings - Status: %02X %02X", sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
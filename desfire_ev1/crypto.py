@@ -1,21 +1,155 @@
-from Crypto.Cipher import DES
-import random
+from collections import OrderedDict
+import secrets
+import threading
+
+from Crypto.Cipher import AES, DES, DES3
+
+# Key types
+KEY_DES = "DES"
+KEY_3DES = "3DES"
+KEY_AES = "AES"
+
+BLOCK_SIZES = {KEY_DES: 8, KEY_3DES: 8, KEY_AES: 16}
+
+# Up to this many blocks, chaining over the cached ECB cipher beats a fresh CBC object
+SHORT_MESSAGE_BLOCKS = 4
+
+
+class CipherContext:
+    """Caches ECB key schedules per key and runs CBC on top of them.
+
+    Building a pycryptodome cipher expands the key schedule; authentication
+    runs several times per tap with the same few keys, so the expanded ECB
+    cipher is kept in a bounded LRU. The *_inplace methods work on a
+    bytearray and return the last ciphertext block as the IV for the next
+    call, so a transfer can be processed frame by frame.
+    """
+
+    def __init__(self, max_keys=32):
+        self.max_keys = max_keys
+        self._ciphers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ecb(self, key, key_type=KEY_DES):
+        """Return the cached ECB cipher for a key"""
+        cache_key = (key_type, bytes(key))
+        with self._lock:
+            cipher = self._ciphers.get(cache_key)
+            if cipher is not None:
+                self._ciphers.move_to_end(cache_key)
+                return cipher
+        cipher = _new_ecb(bytes(key), key_type)
+        with self._lock:
+            self._ciphers[cache_key] = cipher
+            if len(self._ciphers) > self.max_keys:
+                self._ciphers.popitem(last=False)
+        return cipher
+
+    def cbc_encrypt_inplace(self, buf, key, iv=None, key_type=KEY_DES):
+        """CBC-encrypt a bytearray in place; returns the last ciphertext block"""
+        size = BLOCK_SIZES[key_type]
+        if len(buf) % size:
+            raise ValueError(f"Data length must be a multiple of {size}")
+        iv = bytes(iv) if iv else bytes(size)
+        if len(buf) > SHORT_MESSAGE_BLOCKS * size:
+            # Long messages: the native CBC loop outweighs one key expansion
+            _new_cbc(bytes(key), key_type, iv).encrypt(buf, output=buf)
+            return bytes(buf[-size:])
+        ecb = self.ecb(key, key_type)
+        chain = int.from_bytes(iv, 'big')
+        for i in range(0, len(buf), size):
+            block = ecb.encrypt((int.from_bytes(buf[i:i + size], 'big') ^ chain).to_bytes(size, 'big'))
+            buf[i:i + size] = block
+            chain = int.from_bytes(block, 'big')
+        return chain.to_bytes(size, 'big')
+
+    def cbc_decrypt_inplace(self, buf, key, iv=None, key_type=KEY_DES):
+        """CBC-decrypt a bytearray in place; returns the last ciphertext block.
+
+        CBC decryption has no chaining dependency, so the whole buffer goes
+        through the cached ECB cipher in one call and is then XORed with the
+        shifted ciphertext as a single integer.
+        """
+        size = BLOCK_SIZES[key_type]
+        if len(buf) % size:
+            raise ValueError(f"Data length must be a multiple of {size}")
+        if not buf:
+            return bytes(iv) if iv else bytes(size)
+        chain = (bytes(iv) if iv else bytes(size)) + bytes(buf[:-size])
+        last = bytes(buf[-size:])
+        self.ecb(key, key_type).decrypt(buf, output=buf)
+        plain = int.from_bytes(buf, 'big') ^ int.from_bytes(chain, 'big')
+        buf[:] = plain.to_bytes(len(buf), 'big')
+        return last
+
+    def cbc_encrypt(self, data, key, iv=None, key_type=KEY_DES):
+        """CBC-encrypt, zero-padding to the block size"""
+        size = BLOCK_SIZES[key_type]
+        buf = bytearray(data)
+        if len(buf) % size:
+            buf.extend(bytes(size - len(buf) % size))
+        self.cbc_encrypt_inplace(buf, key, iv, key_type)
+        return bytes(buf)
+
+    def cbc_decrypt(self, data, key, iv=None, key_type=KEY_DES):
+        """CBC-decrypt"""
+        buf = bytearray(data)
+        self.cbc_decrypt_inplace(buf, key, iv, key_type)
+        return bytes(buf)
+
+
+def _single_des_key(key, key_type):
+    """Single-DES key a DES/3DES key degenerates to, or None for a genuine 3DES key.
+
+    With K1 == K2 (2K3DES), E(K3)D(K2)E(K1) reduces to E(K3) and with
+    K2 == K3 to E(K1); K1 == K2 == K3 is both. Parity bits (where DESFire
+    keeps the key version) are ignored in the comparison, as DES does.
+    """
+    if key_type == KEY_DES:
+        return bytes(key[:8])
+    k = [bytes(b & 0xFE for b in key[i:i + 8]) for i in range(0, len(key), 8)]
+    if len(k) == 2 and k[0] == k[1]:
+        return bytes(key[:8])
+    if len(k) == 3 and k[0] == k[1]:
+        return bytes(key[16:24])
+    if len(k) == 3 and k[1] == k[2]:
+        return bytes(key[:8])
+    return None
+
+
+def _new_ecb(key, key_type):
+    if key_type == KEY_AES:
+        return AES.new(key, AES.MODE_ECB)
+    single = _single_des_key(key, key_type)
+    if single is not None:
+        return DES.new(single, DES.MODE_ECB)
+    return DES3.new(key, DES3.MODE_ECB)
+
+
+def _new_cbc(key, key_type, iv):
+    if key_type == KEY_AES:
+        return AES.new(key, AES.MODE_CBC, iv=iv)
+    single = _single_des_key(key, key_type)
+    if single is not None:
+        return DES.new(single, DES.MODE_CBC, iv=iv)
+    return DES3.new(key, DES3.MODE_CBC, iv=iv)
+
+
+# Shared context used by the module-level helpers
+default_context = CipherContext()
+
 
 def des_cbc_encrypt(data, key, iv=bytes(8)):
     """Encrypt data using DES in CBC mode"""
-    cipher = DES.new(key, DES.MODE_CBC, iv=iv)
-    if len(data) % 8 != 0:
-        data = data + bytes(8 - len(data) % 8)
-    return cipher.encrypt(data)
+    return default_context.cbc_encrypt(data, key, iv)
 
 def des_cbc_decrypt(data, key, iv=bytes(8)):
     """Decrypt data using DES in CBC mode"""
-    cipher = DES.new(key, DES.MODE_CBC, iv=iv)
-    return cipher.decrypt(data)
+    return default_context.cbc_decrypt(data, key, iv)
 
-def generate_reader_challenge():
-    """Generate random 8-byte challenge"""
-    return bytes([random.randint(0, 255) for _ in range(8)])
+def generate_reader_challenge(length=8):
+    """Generate random challenge from the OS CSPRNG"""
+    return secrets.token_bytes(length)
 
 def rotate_left(data, n=1):
     """Rotate bytes left by n positions"""
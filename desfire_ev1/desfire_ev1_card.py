@@ -1,20 +1,72 @@
+import logging
+import time
 from smartcard.System import readers
 from smartcard.util import toHexString
-from .crypto import des_cbc_decrypt, des_cbc_encrypt, generate_reader_challenge, rotate_left
+from .metrics import default_metrics, INS_NAMES
+from .profiler import profiler
+from .log import ApduRing
+from .crypto import (des_cbc_decrypt, des_cbc_encrypt, generate_reader_challenge, rotate_left,
+                     default_context, _single_des_key, BLOCK_SIZES, KEY_DES, KEY_3DES, KEY_AES)
+from .session import SecureSession, derive_session_key, crc32_update, crc32_finish
+from .exceptions import AuthenticationError
+
+log = logging.getLogger(__name__)
+
 
 class DesfireCard:
-    def __init__(self, reader_index=0):
+    def __init__(self, reader_index=0, metrics=None):
         """Initialize connection to card"""
+        self.metrics = metrics if metrics is not None else default_metrics
         r = readers()
         self.reader = r[reader_index]
         self.connection = self.reader.createConnection()
         self.connection.connect()
-        print(f"Connected to: {self.reader}")
-        print(f"ATR: {toHexString(self.connection.getATR())}")
+        self.apdu_ring = None
+        self.session = None
+        # AID of the last successful SelectApplication
+        self.selected_aid = None
+        log.info("Connected to: %s", self.reader)
+        log.info("ATR: %s", toHexString(self.connection.getATR()))
+    
+    def reconnect(self):
+        """Connect again to the card now on the reader (after a card swap)"""
+        try:
+            self.connection.disconnect()
+        except Exception as e:
+            log.debug("Disconnect failed: %s", e)
+        self.connection.connect()
+        self.session = None
+        self.selected_aid = None
+        log.info("ATR: %s", toHexString(self.connection.getATR()))
     
     def transmit(self, apdu):
-        """Send APDU and return response"""
-        return self.connection.transmit(apdu)
+        """Send APDU and return response.
+
+        With an EV1 secure-messaging session the command is MACed into the
+        session IV and the response MAC is verified and stripped.
+        """
+        session = self.session
+        if session is not None:
+            session.on_command(apdu)
+        start = time.perf_counter()
+        with profiler.span(INS_NAMES.get(apdu[1]) or f"0x{apdu[1]:02X}", "rf"):
+            data, sw1, sw2 = self.connection.transmit(apdu)
+        elapsed = time.perf_counter() - start
+        self.metrics.record_apdu(apdu, data, sw1, sw2, elapsed)
+        if self.apdu_ring is not None:
+            self.apdu_ring.record(apdu, data, sw1, sw2, elapsed)
+        if session is not None:
+            try:
+                data = session.on_response(data, sw1, sw2)
+            finally:
+                if not session.valid:
+                    self.session = None
+        return data, sw1, sw2
+    
+    def enable_apdu_ring(self, size=64):
+        """Keep the last `size` APDU exchanges in memory (debug mode)"""
+        self.apdu_ring = ApduRing(size)
+        return self.apdu_ring
     
     def get_version(self):
         """Get card version info (3 frames)"""
@@ -29,35 +81,164 @@ class DesfireCard:
         
         return frames
     
+    def get_uid(self):
+        """Card UID (7 bytes) from the third GetVersion frame"""
+        frames = self.get_version()
+        if len(frames) < 3 or len(frames[2]) < 7:
+            return None
+        return bytes(frames[2][:7])
+    
+    def get_free_memory(self):
+        """Free EEPROM bytes at PICC level (GetFreeMemory), None on error"""
+        apdu = [0x90, 0x6E, 0x00, 0x00, 0x00]
+        data, sw1, sw2 = self.transmit(apdu)
+        if sw1 != 0x91 or sw2 != 0x00 or len(data) < 3:
+            return None
+        return data[0] | (data[1] << 8) | (data[2] << 16)
+    
     def select_application(self, aid):
         """Select application by AID"""
+        # Selecting an application drops any authentication
+        self.session = None
         apdu = [0x90, 0x5A, 0x00, 0x00, 0x03] + aid + [0x00]
         data, sw1, sw2 = self.transmit(apdu)
-        return sw1 == 0x91 and sw2 == 0x00
+        ok = sw1 == 0x91 and sw2 == 0x00
+        self.selected_aid = list(aid) if ok else None
+        return ok
     
     def authenticate(self, key_number, key_value):
         """Authenticate with DES key"""
+        self.session = None
         # Request challenge
         apdu = [0x90, 0x0A, 0x00, 0x00, 0x01] + key_number + [0x00]
         encrypted_challenge, sw1, sw2 = self.transmit(apdu)
         
-        # Decrypt and rotate card challenge
-        card_challenge = des_cbc_decrypt(bytes(encrypted_challenge), key_value)
-        rotated = rotate_left(card_challenge, 1)
-        
-        # Generate reader challenge and combine
-        reader_challenge = generate_reader_challenge()
-        response_data = reader_challenge + rotated
-        
-        # Encrypt and send
-        encrypted_response = des_cbc_encrypt(response_data, key_value)
+        with profiler.span("des_challenge_response", "crypto"):
+            # Decrypt and rotate card challenge
+            card_challenge = des_cbc_decrypt(bytes(encrypted_challenge), key_value)
+            rotated = rotate_left(card_challenge, 1)
+            
+            # Generate reader challenge and combine
+            reader_challenge = generate_reader_challenge()
+            response_data = reader_challenge + rotated
+            
+            # Encrypt and send
+            encrypted_response = des_cbc_encrypt(response_data, key_value)
         apdu = [0x90, 0xAF, 0x00, 0x00, 0x10] + list(encrypted_response) + [0x00]
         data, sw1, sw2 = self.transmit(apdu)
         
+        if sw1 == 0x91 and sw2 == 0x00:
+            # Legacy session: key only, no CMAC secure messaging
+            session_key = derive_session_key(KEY_DES, reader_challenge, card_challenge)
+            self.session = SecureSession(KEY_DES, session_key, key_number[0], secure_messaging=False)
+            return True
+        return False
+    
+    def authenticate_key(self, key_number, key_value, key_type=KEY_DES):
+        """Authenticate with the command matching the key type"""
+        if key_type == KEY_AES:
+            return self.authenticate_aes(key_number, key_value)
+        if key_type == KEY_3DES:
+            return self.authenticate_iso(key_number, key_value)
+        return self.authenticate(key_number, key_value)
+    
+    def authenticate_iso(self, key_number, key_value):
+        """EV1 AuthenticateISO (0x1A) with a 2K3DES or 3K3DES key"""
+        return self._authenticate_ev1(0x1A, key_number, key_value, KEY_3DES)
+    
+    def authenticate_aes(self, key_number, key_value):
+        """EV1 AuthenticateAES (0xAA) with an AES-128 key"""
+        return self._authenticate_ev1(0xAA, key_number, key_value, KEY_AES)
+    
+    def _authenticate_ev1(self, ins, key_number, key_value, key_type):
+        """Three-pass EV1 authentication; establishes a CMAC session"""
+        self.session = None
+        key_value = bytes(key_value)
+        if key_type == KEY_3DES and len(key_value) == 8:
+            key_value = key_value * 2
+        apdu = [0x90, ins, 0x00, 0x00, 0x01] + key_number + [0x00]
+        encrypted_rnd_b, sw1, sw2 = self.transmit(apdu)
+        if sw1 != 0x91 or sw2 != 0xAF:
+            return False
+        
+        with profiler.span("ev1_challenge_response", "crypto"):
+            # ISO CBC: the IV carries over between the frames of the exchange
+            rnd_b = default_context.cbc_decrypt(bytes(encrypted_rnd_b), key_value, None, key_type)
+            iv = bytes(encrypted_rnd_b[-BLOCK_SIZES[key_type]:])
+            rnd_a = generate_reader_challenge(len(rnd_b))
+            token = bytearray(rnd_a + rotate_left(rnd_b, 1))
+            iv = default_context.cbc_encrypt_inplace(token, key_value, iv, key_type)
+        
+        apdu = [0x90, 0xAF, 0x00, 0x00, len(token)] + list(token) + [0x00]
+        encrypted_rnd_a, sw1, sw2 = self.transmit(apdu)
+        if sw1 != 0x91 or sw2 != 0x00:
+            return False
+        
+        with profiler.span("ev1_verify", "crypto"):
+            rotated_a = default_context.cbc_decrypt(bytes(encrypted_rnd_a), key_value, iv, key_type)
+            if rotated_a != rotate_left(rnd_a, 1):
+                log.warning("Authentication failed: card returned a wrong RndA'")
+                return False
+            if key_type == KEY_3DES and len(key_value) == 16 and _single_des_key(key_value, key_type) is not None:
+                # Single DES key (K1 == K2, parity bits aside) used with AuthenticateISO
+                session_key = derive_session_key(KEY_DES, rnd_a, rnd_b) * 2
+            else:
+                session_key = derive_session_key(key_type, rnd_a, rnd_b, len(key_value))
+        
+        self.session = SecureSession(key_type, session_key, key_number[0])
+        return True
+    
+    def change_key(self, key_number, new_key, old_key=None, key_type=None, key_version=0, key_number_flags=0x00):
+        """ChangeKey (0xC4) within an EV1 session.
+        
+        Changing the key used to authenticate ends the session; any other
+        key needs its current value in `old_key`. `key_number_flags` sets
+        the key type bits when changing the PICC master key.
+        """
+        session = self.session
+        if session is None or not session.secure_messaging:
+            raise AuthenticationError("ChangeKey needs AuthenticateISO or AuthenticateAES")
+        key_type = key_type or session.key_type
+        new_key = _normalize_key(new_key, key_type)
+        key_no = key_number | key_number_flags
+        version = bytes([key_version]) if key_type == KEY_AES else b""
+        same_key = key_number == session.key_number
+        
+        if same_key:
+            plain = new_key + version
+            crc = crc32_finish(crc32_update(bytes([0xC4, key_no]) + plain))
+            payload = bytearray(plain + crc)
+        else:
+            if old_key is None:
+                raise ValueError("old_key is required to change a key other than the authenticated one")
+            old_key = _normalize_key(old_key, key_type)
+            plain = bytes(a ^ b for a, b in zip(new_key, old_key)) + version
+            crc = crc32_finish(crc32_update(bytes([0xC4, key_no]) + plain))
+            payload = bytearray(plain + crc + crc32_finish(crc32_update(new_key)))
+        if len(payload) % session.block_size:
+            payload.extend(bytes(session.block_size - len(payload) % session.block_size))
+        session.iv = session.context.cbc_encrypt_inplace(payload, session.session_key, session.iv, session.key_type)
+        
+        apdu = [0x90, 0xC4, 0x00, 0x00, 1 + len(payload), key_no] + list(payload) + [0x00]
+        if same_key:
+            # The card drops the session and sends no MAC
+            self.session = None
+        else:
+            session.skip_command_mac()
+        data, sw1, sw2 = self.transmit(apdu)
+        log.debug("Change key %d - Status: %02X %02X", key_number, sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
     def format_card(self):
         """Format entire card (deletes everything)"""
         apdu = [0x90, 0xFC, 0x00, 0x00, 0x00]
         data, sw1, sw2 = self.transmit(apdu)
-        return sw1 == 0x91 and sw2 == 0x00
\ No newline at end of file
+        return sw1 == 0x91 and sw2 == 0x00
+
+
+def _normalize_key(key, key_type):
+    # DES keys are stored as 16-byte 3DES keys with equal halves
+    key = bytes(key)
+    if key_type != KEY_AES and len(key) == 8:
+        return key * 2
+    return key
@@ -0,0 +1,14 @@
+class DesfireError(Exception):
+    """Base class for errors raised by the desfire_ev1 library"""
+
+
+class AuthenticationError(DesfireError):
+    """Authentication failed or no session is established"""
+
+
+class IntegrityError(DesfireError):
+    """A MAC or CRC received from the card does not match"""
+
+
+class StorageError(DesfireError):
+    """The planned layout or data does not fit in the card memory"""
@@ -1,7 +1,29 @@
-from smartcard.util import toHexString
-from desfire_ev1.utils import to_3bytes, to_4bytes, from_4bytes
+import io
+import logging
+from desfire_ev1.utils import to_3bytes, to_4bytes, from_3bytes, from_4bytes
+from desfire_ev1.log import LazyHex, LazyText
+from desfire_ev1.session import EncipheredReader, EncipheredWriter, MAC_LENGTH
+from desfire_ev1.exceptions import AuthenticationError
+
+log = logging.getLogger(__name__)
+
+# File types
+FILE_STANDARD = 0x00
+FILE_BACKUP = 0x01
+FILE_VALUE = 0x02
+FILE_LINEAR_RECORD = 0x03
+FILE_CYCLIC_RECORD = 0x04
+
+# Communication settings of a file
+COMM_PLAIN = 0x00
+COMM_MAC = 0x01
+COMM_ENCRYPTED = 0x03
+
 
 class FileManager:
+    # Largest Lc (command data bytes) sent in one native-wrapped frame
+    max_frame_data = 54
+
     def __init__(self, card):
         """Initialize with DesfireCard instance"""
         self.card = card
@@ -13,7 +35,7 @@ class FileManager:
         
         if sw1 == 0x91 and sw2 == 0x00:
             file_ids = list(data)
-            print(f"Files: {[f'0x{fid:02X}' for fid in file_ids]}")
+            log.debug("Files: %s", LazyHex(file_ids))
             return file_ids
         return []
     
@@ -21,7 +43,7 @@ class FileManager:
         """Delete file"""
         apdu = [0x90, 0xDF, 0x00, 0x00, 0x01, file_id, 0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Delete file {file_id} - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Delete file %s - Status: %02X %02X", file_id, sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
     def get_file_type(self, file_id):
@@ -38,9 +60,36 @@ class FileManager:
             0x03: "Linear record",
             0x04: "Cyclic record",
         }
-        print(f"File {file_id} type: {mapping.get(file_type, 'Unknown')} (0x{file_type:02X})")
+        log.debug("File %s type: %s (0x%02X)", file_id, mapping.get(file_type, 'Unknown'), file_type)
         return file_type
 
+    def get_file_settings(self, file_id):
+        """Return the parsed GetFileSettings response as a dict (None on error)"""
+        apdu = [0x90, 0xF5, 0x00, 0x00, 0x01, file_id, 0x00]
+        data, sw1, sw2 = self.card.transmit(apdu)
+        log.debug("File settings %s - Status: %02X %02X - %s", file_id, sw1, sw2, LazyHex(data))
+        if sw1 != 0x91 or sw2 != 0x00 or len(data) < 4:
+            return None
+        
+        settings = {
+            'file_id': file_id,
+            'file_type': data[0],
+            'comm_settings': data[1] & 0x03,
+            'access_rights': [data[2], data[3]],
+        }
+        body = data[4:]
+        if data[0] in (FILE_STANDARD, FILE_BACKUP):
+            settings['size'] = from_3bytes(body[0:3])
+        elif data[0] == FILE_VALUE:
+            settings['lower_limit'] = from_4bytes(body[0:4])
+            settings['upper_limit'] = from_4bytes(body[4:8])
+            settings['limited_credit_value'] = from_4bytes(body[8:12])
+            settings['limited_credit'] = bool(body[12])
+        elif data[0] in (FILE_LINEAR_RECORD, FILE_CYCLIC_RECORD):
+            settings['record_size'] = from_3bytes(body[0:3])
+            settings['max_records'] = from_3bytes(body[3:6])
+            settings['current_records'] = from_3bytes(body[6:9])
+        return settings
     
     # Standard File
     def create_standard_file(self, file_id, file_size, comm_settings=0x00, access_rights=[0x00, 0x00]):
@@ -48,26 +97,47 @@ class FileManager:
         size_bytes = to_3bytes(file_size)
         apdu = [0x90, 0xCD, 0x00, 0x00, 0x07, file_id, comm_settings] + access_rights + size_bytes + [0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Create standard file {file_id} - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Create standard file %s - Status: %02X %02X", file_id, sw1, sw2)
+        return sw1 == 0x91 and sw2 == 0x00
+    
+    def create_backup_data_file(self, file_id, file_size, comm_settings=0x00, access_rights=[0x00, 0x00]):
+        """Create backup data file (writes take effect on commit_transaction)"""
+        size_bytes = to_3bytes(file_size)
+        apdu = [0x90, 0xCB, 0x00, 0x00, 0x07, file_id, comm_settings] + access_rights + size_bytes + [0x00]
+        data, sw1, sw2 = self.card.transmit(apdu)
+        log.debug("Create backup data file %s - Status: %02X %02X", file_id, sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
-    def write_data(self, file_id, offset, data):
+    def write_data(self, file_id, offset, data, comm_mode=COMM_PLAIN):
         """Write data to standard file"""
+        if comm_mode != COMM_PLAIN:
+            return self._write_protected(0x3D, file_id, offset, data, comm_mode)
         offset_bytes = to_3bytes(offset)
         length_bytes = to_3bytes(len(data))
-        apdu = [0x90, 0x3D, 0x00, 0x00, 7 + len(data), file_id] + offset_bytes + length_bytes + data + [0x00]
+        if 7 + len(data) > self.max_frame_data:
+            # Too long for one frame: chain the rest with additional frames
+            ok = self._send_chained(0x3D, [file_id] + offset_bytes + length_bytes, io.BytesIO(bytes(data)))
+            log.debug("Chained write to file %s - %s", file_id, ok)
+            return ok
+        apdu = [0x90, 0x3D, 0x00, 0x00, 7 + len(data), file_id] + offset_bytes + length_bytes + list(data) + [0x00]
         response, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Write to file {file_id} - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Write to file %s - Status: %02X %02X", file_id, sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
-    def read_data(self, file_id, offset, length):
-        """Read data from standard file"""
+    def read_data(self, file_id, offset, length, comm_mode=COMM_PLAIN):
+        """Read data from standard file, following additional frames"""
         offset_bytes = to_3bytes(offset)
         length_bytes = to_3bytes(length)
         apdu = [0x90, 0xBD, 0x00, 0x00, 0x07, file_id] + offset_bytes + length_bytes + [0x00]
+        if comm_mode != COMM_PLAIN:
+            return self._read_protected(apdu, length, comm_mode)
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Read from file {file_id} - Status: {sw1:02X} {sw2:02X}")
-        print(f"Data: {bytes(data).decode('utf-8', errors='ignore')}")
+        if sw2 == 0xAF:
+            data = list(data)
+            while sw1 == 0x91 and sw2 == 0xAF:
+                frame, sw1, sw2 = self.card.transmit([0x90, 0xAF, 0x00, 0x00, 0x00])
+                data.extend(frame)
+        log.debug("Read from file %s - Status: %02X %02X - Data: %s", file_id, sw1, sw2, LazyText(data))
         return data
     
     # Value File
@@ -79,7 +149,7 @@ class FileManager:
         limited = 0x01 if limited_credit else 0x00
         apdu = [0x90, 0xCC, 0x00, 0x00, 0x11, file_id, comm_settings] + access_rights + lower_bytes + upper_bytes + initial_bytes + [limited, 0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Create value file {file_id} - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Create value file %s - Status: %02X %02X", file_id, sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
     def credit_value(self, file_id, amount):
@@ -87,7 +157,7 @@ class FileManager:
         amount_bytes = to_4bytes(amount)
         apdu = [0x90, 0x0C, 0x00, 0x00, 0x05, file_id] + amount_bytes + [0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Credit {amount} - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Credit %s - Status: %02X %02X", amount, sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
     def debit_value(self, file_id, amount):
@@ -95,7 +165,7 @@ class FileManager:
         amount_bytes = to_4bytes(amount)
         apdu = [0x90, 0xDC, 0x00, 0x00, 0x05, file_id] + amount_bytes + [0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Debit {amount} - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Debit %s - Status: %02X %02X", amount, sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
     def get_value(self, file_id):
@@ -104,7 +174,7 @@ class FileManager:
         data, sw1, sw2 = self.card.transmit(apdu)
         if sw1 == 0x91 and sw2 == 0x00:
             value = from_4bytes(data)
-            print(f"Value: {value}")
+            log.debug("Value: %s", value)
             return value
         return None
     
@@ -115,7 +185,7 @@ class FileManager:
         max_bytes = to_3bytes(max_records)
         apdu = [0x90, 0xC1, 0x00, 0x00, 0x0A, file_id, comm_settings] + access_rights + size_bytes + max_bytes + [0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Create linear record file {file_id} - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Create linear record file %s - Status: %02X %02X", file_id, sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
     def create_cyclic_record_file(self, file_id, record_size, max_records, comm_settings=0x00, access_rights=[0x00, 0x00]):
@@ -124,45 +194,118 @@ class FileManager:
         max_bytes = to_3bytes(max_records)
         apdu = [0x90, 0xC0, 0x00, 0x00, 0x0A, file_id, comm_settings] + access_rights + size_bytes + max_bytes + [0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Create cyclic record file {file_id} - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Create cyclic record file %s - Status: %02X %02X", file_id, sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
-    def write_record(self, file_id, offset, data):
+    def write_record(self, file_id, offset, data, comm_mode=COMM_PLAIN):
         """Write record"""
+        if comm_mode != COMM_PLAIN:
+            return self._write_protected(0x3B, file_id, offset, data, comm_mode)
         offset_bytes = to_3bytes(offset)
         length_bytes = to_3bytes(len(data))
         apdu = [0x90, 0x3B, 0x00, 0x00, 7 + len(data), file_id] + offset_bytes + length_bytes + data + [0x00]
         response, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Write record - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Write record - Status: %02X %02X", sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
-    def read_records(self, file_id, record_offset, num_records):
-        """Read records"""
+    def read_records(self, file_id, record_offset, num_records, comm_mode=COMM_PLAIN, record_size=None):
+        """Read records, following additional frames (enciphered reads need num_records and record_size)"""
         offset_bytes = to_3bytes(record_offset)
         num_bytes = to_3bytes(num_records)
         apdu = [0x90, 0xBB, 0x00, 0x00, 0x07, file_id] + offset_bytes + num_bytes + [0x00]
+        if comm_mode != COMM_PLAIN:
+            return self._read_protected(apdu, num_records * (record_size or 0), comm_mode)
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Read records - Status: {sw1:02X} {sw2:02X}")
-        print(f"Data: {bytes(data).decode('utf-8', errors='ignore')}")
+        data = list(data)
+        while sw1 == 0x91 and sw2 == 0xAF:
+            frame, sw1, sw2 = self.card.transmit([0x90, 0xAF, 0x00, 0x00, 0x00])
+            data.extend(frame)
+        log.debug("Read records - Status: %02X %02X - Data: %s", sw1, sw2, LazyText(data))
+        if sw1 != 0x91 or sw2 != 0x00:
+            return []
         return data
     
     def clear_record_file(self, file_id):
         """Clear all records"""
         apdu = [0x90, 0xEB, 0x00, 0x00, 0x01, file_id, 0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Clear records - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Clear records - Status: %02X %02X", sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
     
     def commit_transaction(self):
         """Validate all pending writes in current application"""
         apdu = [0x90, 0xC7, 0x00, 0x00, 0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Commit transaction - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Commit transaction - Status: %02X %02X", sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
 
+    # MACed / enciphered communication (requires an EV1 session)
+    def _secure_session(self):
+        session = self.card.session
+        if session is None or not session.secure_messaging:
+            raise AuthenticationError("MAC/enciphered file access needs AuthenticateISO or AuthenticateAES")
+        return session
+    
+    def _write_protected(self, ins, file_id, offset, data, comm_mode):
+        """Chained write in MAC or enciphered mode"""
+        session = self._secure_session()
+        header = [file_id] + to_3bytes(offset) + to_3bytes(len(data))
+        if comm_mode == COMM_ENCRYPTED:
+            stream = EncipheredWriter(session, [ins] + header, data)
+        else:
+            mac = session.cmac(bytes([ins] + header) + bytes(data), session.iv)
+            session.iv = mac
+            stream = io.BytesIO(bytes(data) + mac[:MAC_LENGTH])
+        session.skip_command_mac()
+        ok = self._send_chained(ins, header, stream)
+        log.debug("Protected write to file %s (mode %02X) - %s", file_id, comm_mode, ok)
+        return ok
+    
+    def _send_chained(self, ins, header, stream):
+        """Send header + stream over as many frames as needed"""
+        chunk = stream.read(self.max_frame_data - len(header))
+        apdu = [0x90, ins, 0x00, 0x00, len(header) + len(chunk)] + header + list(chunk) + [0x00]
+        response, sw1, sw2 = self.card.transmit(apdu)
+        while sw1 == 0x91 and sw2 == 0xAF:
+            chunk = stream.read(self.max_frame_data)
+            apdu = [0x90, 0xAF, 0x00, 0x00, len(chunk)] + list(chunk) + [0x00]
+            response, sw1, sw2 = self.card.transmit(apdu)
+        return sw1 == 0x91 and sw2 == 0x00
+    
+    def _read_protected(self, apdu, length, comm_mode):
+        """Chained read in MAC or enciphered mode.
+
+        MACed frames are verified by the session as they arrive; enciphered
+        frames are decrypted and CRC-checked as a stream.
+        """
+        session = self._secure_session()
+        reader = None
+        if comm_mode == COMM_ENCRYPTED:
+            if not length:
+                raise ValueError("Enciphered reads need an explicit length")
+            reader = EncipheredReader(session, length)
+            session.raw_response = True
+        data = []
+        frame, sw1, sw2 = self.card.transmit(apdu)
+        while True:
+            if sw1 != 0x91 or sw2 not in (0x00, 0xAF):
+                log.debug("Protected read - Status: %02X %02X", sw1, sw2)
+                return []
+            if reader is not None:
+                reader.feed(frame)
+            else:
+                data.extend(frame)
+            if sw2 == 0x00:
+                break
+            frame, sw1, sw2 = self.card.transmit([0x90, 0xAF, 0x00, 0x00, 0x00])
+        if reader is not None:
+            data = list(reader.finish())
+        log.debug("Protected read - %d bytes", len(data))
+        return data
+    
     def abort_transaction(self):
         """Cancel all pending writes in current application"""
         apdu = [0x90, 0xA7, 0x00, 0x00, 0x00]
         data, sw1, sw2 = self.card.transmit(apdu)
-        print(f"Abort transaction - Status: {sw1:02X} {sw2:02X}")
+        log.debug("Abort transaction - Status: %02X %02X", sw1, sw2)
         return sw1 == 0x91 and sw2 == 0x00
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+MASTER_APP_ID = [0x00, 0x00, 0x00]
+
+
+class CardInventory:
+    def __init__(self, card, app_manager, file_manager, max_cards=256):
+        """Applications, files and file settings of each card, cached by UID.
+
+        scan() walks the card once: GetApplicationIDs at PICC level, then
+        GetFileIDs and GetFileSettings per application. The result maps
+        AID bytes to {file_id: settings} and is kept in a bounded LRU, so a
+        repeat tap costs no discovery at all. Code that changes the layout
+        (create/delete/format, record writes) calls invalidate().
+        """
+        self.card = card
+        self.app_manager = app_manager
+        self.file_manager = file_manager
+        self.max_cards = max_cards
+        self._cards = OrderedDict()
+        self._lock = threading.Lock()
+
+    def scan(self, uid):
+        """Walk the card and cache the result (selects other applications: authenticate again after)"""
+        self.card.select_application(MASTER_APP_ID)
+        snapshot = {}
+        for aid in self.app_manager.list_applications():
+            aid = list(aid)
+            self.card.select_application(aid)
+            snapshot[bytes(aid)] = {file_id: self.file_manager.get_file_settings(file_id)
+                                    for file_id in self.file_manager.list_files()}
+        log.debug("Scanned %d applications", len(snapshot))
+        with self._lock:
+            self._cards[bytes(uid)] = snapshot
+            if len(self._cards) > self.max_cards:
+                self._cards.popitem(last=False)
+        return snapshot
+
+    def get(self, uid, scan=False):
+        """Cached snapshot of a card, scanning it first if asked and unknown"""
+        with self._lock:
+            snapshot = self._cards.get(bytes(uid))
+            if snapshot is not None:
+                self._cards.move_to_end(bytes(uid))
+                return snapshot
+        return self.scan(uid) if scan else None
+
+    def file_settings(self, uid, aid, file_id):
+        """Cached settings of one file (None if unknown).
+
+        Settings marked stale by invalidate() are fetched again with
+        GetFileSettings, so `aid` must be the selected application then.
+        """
+        snapshot = self.get(uid)
+        if snapshot is None or bytes(aid) not in snapshot:
+            return None
+        files = snapshot[bytes(aid)]
+        if file_id not in files:
+            return None
+        if files[file_id] is None:
+            files[file_id] = self.file_manager.get_file_settings(file_id)
+        return files[file_id]
+
+    def file_size(self, uid, aid, file_id, default=None):
+        """Size of a standard/backup file, or record_size * max_records for record files"""
+        settings = self.file_settings(uid, aid, file_id)
+        if settings is None:
+            return default
+        if 'size' in settings:
+            return settings['size']
+        if 'record_size' in settings:
+            return settings['record_size'] * settings['max_records']
+        return default
+
+    def invalidate(self, uid, aid=None, file_id=None):
+        """Mark what our own code changed on a card.
+
+        With a file ID only that file's settings are refetched on next use
+        (e.g. its record count after a write); otherwise the application or
+        file directory changed and the whole card is scanned again.
+        """
+        with self._lock:
+            snapshot = self._cards.get(bytes(uid))
+            if snapshot is None:
+                return
+            files = snapshot.get(bytes(aid)) if aid is not None else None
+            if files is not None and file_id in files:
+                files[file_id] = None
+            else:
+                del self._cards[bytes(uid)]
+
+    def clear(self):
+        with self._lock:
+            self._cards.clear()
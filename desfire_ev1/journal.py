@@ -0,0 +1,102 @@
+from collections import OrderedDict
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Bytes of a long file written between two journal checkpoints
+JOURNAL_CHUNK = 256
+
+
+class ProvisioningJournal:
+    def __init__(self, path=None, max_cards=256):
+        """Completed issuing steps per card UID, so a torn card resumes where it stopped.
+
+        Each card gets an entry for one job (a key identifying what is being
+        written): the steps already done and, for long writes, the byte
+        offset reached. Starting the same job again on the same card skips
+        what is done; a different job starts over. With a path the journal
+        is saved (atomically) after every change and survives a restart.
+        """
+        self.path = path
+        self.max_cards = max_cards
+        self._cards = OrderedDict()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                self._cards = OrderedDict(json.load(f))
+        except (OSError, ValueError) as e:
+            log.warning("Cannot load journal %s: %s", self.path, e)
+            self._cards = OrderedDict()
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self._cards, f)
+        os.replace(tmp, self.path)
+
+    def start(self, uid, job):
+        """Begin or resume a job on a card; returns the steps already done"""
+        key = bytes(uid).hex()
+        with self._lock:
+            entry = self._cards.get(key)
+            if entry is None or entry['job'] != job:
+                entry = {'job': job, 'done': [], 'offsets': {}}
+                self._cards[key] = entry
+            entry['updated'] = time.time()
+            self._cards.move_to_end(key)
+            if len(self._cards) > self.max_cards:
+                self._cards.popitem(last=False)
+            self._save()
+            return list(entry['done'])
+
+    def is_done(self, uid, step):
+        with self._lock:
+            entry = self._cards.get(bytes(uid).hex())
+            return entry is not None and step in entry['done']
+
+    def offset(self, uid, step):
+        """Bytes of a step already written (0 if none)"""
+        with self._lock:
+            entry = self._cards.get(bytes(uid).hex())
+            return entry['offsets'].get(step, 0) if entry is not None else 0
+
+    def progress(self, uid, step, offset):
+        """Record how far a long write got"""
+        self._update(uid, lambda entry: entry['offsets'].__setitem__(step, offset))
+
+    def done(self, uid, step):
+        def mark(entry):
+            if step not in entry['done']:
+                entry['done'].append(step)
+            entry['offsets'].pop(step, None)
+        self._update(uid, mark)
+
+    def finish(self, uid):
+        """The job is complete: forget the card"""
+        with self._lock:
+            if self._cards.pop(bytes(uid).hex(), None) is not None:
+                self._save()
+
+    def pending(self):
+        """UIDs (hex) of cards with an unfinished job"""
+        with self._lock:
+            return list(self._cards)
+
+    def _update(self, uid, change):
+        with self._lock:
+            entry = self._cards.get(bytes(uid).hex())
+            if entry is None:
+                return
+            change(entry)
+            entry['updated'] = time.time()
+            self._save()
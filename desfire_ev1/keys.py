@@ -0,0 +1,155 @@
+from collections import OrderedDict
+import threading
+
+from .crypto import default_context, BLOCK_SIZES, KEY_DES, KEY_3DES, KEY_AES
+from .session import _subkeys
+from .exceptions import AuthenticationError
+
+# PICC level: the card master key is diversified with this AID
+MASTER_APP_ID = [0x00, 0x00, 0x00]
+
+# Key type bits of the key number when changing the PICC master key
+PICC_KEY_FLAGS = {KEY_DES: 0x00, KEY_3DES: 0x00, KEY_AES: 0x80}
+PICC_3K3DES_FLAG = 0x40
+
+
+class StaticKeys:
+    needs_uid = False
+
+    def __init__(self, key):
+        """Same key for every card and application (the factory default setup)"""
+        self.key = bytes(key)
+
+    def key_for(self, uid, aid, key_number=0):
+        return self.key
+
+
+class KeyDiversifier:
+    needs_uid = True
+
+    def __init__(self, master_key, key_type=KEY_AES, system_identifier=b"", cache_size=4096):
+        """UID-based key diversification (NXP AN10922) with a bounded LRU.
+
+        The diversification input is UID || AID || key number || system
+        identifier. Derived keys are cached per (uid, aid, key number), so
+        repeat taps cost one dict lookup and memory stays bounded however
+        many cards are issued.
+        """
+        self.master_key = bytes(master_key)
+        self.key_type = key_type
+        self.system_identifier = bytes(system_identifier)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key_for(self, uid, aid, key_number=0):
+        """Return the diversified key for a card UID and application"""
+        cache_key = (bytes(uid), bytes(aid), key_number)
+        with self._lock:
+            key = self._cache.get(cache_key)
+            if key is not None:
+                self._cache.move_to_end(cache_key)
+                self.hits += 1
+                return key
+            self.misses += 1
+        key = self.derive(uid, aid, key_number)
+        with self._lock:
+            self._cache[cache_key] = key
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return key
+
+    def derive(self, uid, aid, key_number=0):
+        """Derive a key without touching the cache"""
+        m = bytes(uid) + bytes(aid) + bytes([key_number]) + self.system_identifier
+        if self.key_type == KEY_AES:
+            return _an10922_cmac(self.master_key, KEY_AES, 0x01, m, 32)
+        if self.key_type == KEY_3DES and len(self.master_key) == 24:
+            return b"".join(_an10922_cmac(self.master_key, KEY_3DES, const, m, 16) for const in (0x31, 0x32, 0x33))
+        master = self.master_key if len(self.master_key) == 16 else self.master_key * 2
+        key = _an10922_cmac(master, KEY_3DES, 0x21, m, 16) + _an10922_cmac(master, KEY_3DES, 0x22, m, 16)
+        # Single DES keys take the first half of the 2TDEA result
+        return key[:8] if self.key_type == KEY_DES else key
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+def _an10922_cmac(key, key_type, constant, m, padded_length):
+    """CMAC of `constant || m` padded to a fixed length as AN10922 requires"""
+    size = BLOCK_SIZES[key_type]
+    ecb = default_context.ecb(key, key_type)
+    k1, k2 = _subkeys(ecb, size)
+    data = bytes([constant]) + m
+    if len(data) > padded_length:
+        raise ValueError("Diversification input too long")
+    if len(data) < padded_length:
+        data += b"\x80" + bytes(padded_length - len(data) - 1)
+        last_mask = k2
+    else:
+        last_mask = k1
+    chain = 0
+    blocks = [data[i:i + size] for i in range(0, len(data), size)]
+    for i, block in enumerate(blocks):
+        value = int.from_bytes(block, 'big') ^ chain
+        if i == len(blocks) - 1:
+            value ^= last_mask
+        chain = int.from_bytes(ecb.encrypt(value.to_bytes(size, 'big')), 'big')
+    return chain.to_bytes(size, 'big')
+
+
+def roll_to_diversified(card, diversifier, aids, current_keys, key_number=0):
+    """Change key `key_number` of each application to its diversified value.
+
+    `current_keys` is a key provider (e.g. StaticKeys) for the keys now on
+    the card. Applications already on their diversified key are skipped.
+    Returns the list of AIDs that were changed.
+    """
+    uid = card.get_uid()
+    if uid is None:
+        raise AuthenticationError("Cannot read the card UID to diversify its keys")
+    changed = []
+    for aid in aids:
+        new_key = diversifier.key_for(uid, aid, key_number)
+        card.select_application(aid)
+        if _authenticate_ev1(card, key_number, new_key, diversifier.key_type):
+            continue
+        card.select_application(aid)
+        if not _authenticate_ev1(card, key_number, current_keys.key_for(uid, aid, key_number), diversifier.key_type):
+            raise ValueError(f"Cannot authenticate application {bytes(aid).hex()} with the current key")
+        if not card.change_key(key_number, new_key, key_type=diversifier.key_type):
+            raise ValueError(f"ChangeKey failed for application {bytes(aid).hex()}")
+        changed.append(aid)
+    return changed
+
+
+def roll_master_to_diversified(card, diversifier, current_key, current_key_type=KEY_DES):
+    """Change the PICC master key from `current_key` to its diversified value.
+
+    Returns False if the card already uses its diversified master key.
+    """
+    uid = card.get_uid()
+    if uid is None:
+        raise AuthenticationError("Cannot read the card UID to diversify its master key")
+    new_key = diversifier.key_for(uid, MASTER_APP_ID, 0)
+    card.select_application(MASTER_APP_ID)
+    if _authenticate_ev1(card, 0, new_key, diversifier.key_type):
+        return False
+    card.select_application(MASTER_APP_ID)
+    if not _authenticate_ev1(card, 0, current_key, current_key_type):
+        raise ValueError("Cannot authenticate the PICC with the current master key")
+    flags = PICC_3K3DES_FLAG if diversifier.key_type == KEY_3DES and len(new_key) == 24 else \
+        PICC_KEY_FLAGS[diversifier.key_type]
+    if not card.change_key(0, new_key, key_type=diversifier.key_type, key_number_flags=flags):
+        raise ValueError("ChangeKey failed for the PICC master key")
+    return True
+
+
+def _authenticate_ev1(card, key_number, key, key_type):
+    # ChangeKey needs an EV1 session; DES keys authenticate through AuthenticateISO
+    if key_type == KEY_AES:
+        return card.authenticate_aes([key_number], key)
+    return card.authenticate_iso([key_number], key)
@@ -0,0 +1,112 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+from smartcard.util import toHexString
+
+# Root logger of the library; modules log through logging.getLogger(__name__)
+logger = logging.getLogger("desfire_ev1")
+logger.addHandler(logging.NullHandler())
+
+
+class LazyHex:
+    """Hex-formats a byte list only when the log record is actually emitted"""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return toHexString(list(self.data))
+
+
+class LazyText:
+    """Decodes a byte list as text only when the log record is actually emitted"""
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return bytes(self.data).decode('utf-8', errors='ignore')
+
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        """Format as `ts level logger msg key=value ...`
+
+        Extra fields are passed with `extra={'fields': {...}}`.
+        """
+        parts = [
+            time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            record.levelname,
+            record.name,
+            repr(record.getMessage()),
+        ]
+        fields = getattr(record, 'fields', None)
+        if fields:
+            parts.extend(f"{key}={value}" for key, value in fields.items())
+        line = " ".join(parts)
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+def configure(level=None, structured=True, stream=None):
+    """Attach a stream handler to the library and application loggers.
+
+    The level defaults to the DESFIRE_LOG_LEVEL environment variable, then
+    WARNING, so the production path formats nothing below warnings.
+    """
+    level = level or os.environ.get("DESFIRE_LOG_LEVEL", "WARNING")
+    handler = logging.StreamHandler(stream or sys.stderr)
+    if structured:
+        handler.setFormatter(StructuredFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
+
+
+class ApduRing:
+    def __init__(self, size=64):
+        """Keep the last `size` APDU exchanges in memory for post-mortem.
+
+        Entries are stored as raw tuples; nothing is formatted until dump().
+        """
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def record(self, apdu, response, sw1, sw2, elapsed):
+        with self._lock:
+            self._entries.append((time.time(), apdu, response, sw1, sw2, elapsed))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def entries(self):
+        """Return a copy of the stored raw entries"""
+        with self._lock:
+            return list(self._entries)
+
+    def dump(self):
+        """Format the stored exchanges, oldest first"""
+        lines = []
+        for ts, apdu, response, sw1, sw2, elapsed in self.entries():
+            stamp = time.strftime("%H:%M:%S", time.localtime(ts)) + f".{int(ts * 1000) % 1000:03d}"
+            lines.append(
+                f"{stamp} > {toHexString(list(apdu))}\n"
+                f"{stamp} < {toHexString(list(response))} {sw1:02X}{sw2:02X} ({elapsed * 1000:.1f} ms)"
+            )
+        return "\n".join(lines)
+
+    def log_dump(self, level=logging.ERROR):
+        """Emit the stored exchanges through the library logger"""
+        if logger.isEnabledFor(level):
+            logger.log(level, "Last %d APDUs:\n%s", len(self._entries), self.dump())
@@ -0,0 +1,267 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency bucket upper bounds in seconds (Prometheus style, cumulative)
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+# Native DESFire command names, used as the "command" label
+INS_NAMES = {
+    0x0A: "authenticate",
+    0x1A: "authenticate_iso",
+    0xAA: "authenticate_aes",
+    0x5A: "select_application",
+    0x60: "get_version",
+    0x6A: "get_application_ids",
+    0x6F: "get_file_ids",
+    0xF5: "get_file_settings",
+    0x6E: "get_free_memory",
+    0xCA: "create_application",
+    0xDA: "delete_application",
+    0x54: "change_key_settings",
+    0xC4: "change_key",
+    0xCD: "create_std_data_file",
+    0xCB: "create_backup_data_file",
+    0xCC: "create_value_file",
+    0xC1: "create_linear_record_file",
+    0xC0: "create_cyclic_record_file",
+    0xDF: "delete_file",
+    0x3D: "write_data",
+    0xBD: "read_data",
+    0x3B: "write_record",
+    0xBB: "read_records",
+    0xEB: "clear_record_file",
+    0x0C: "credit",
+    0xDC: "debit",
+    0x6C: "get_value",
+    0xC7: "commit_transaction",
+    0xA7: "abort_transaction",
+    0xFC: "format_picc",
+    0xAF: "additional_frame",
+}
+
+AUTH_INS = (0x0A, 0x1A, 0xAA)
+ADDITIONAL_FRAME = 0xAF
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Cumulative histogram with fixed bucket bounds"""
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Record one observation"""
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def snapshot(self):
+        """Return cumulative bucket counts as a dict"""
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets, self.counts):
+            running += count
+            cumulative.append((bound, running))
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+class CommandStats:
+    def __init__(self):
+        """Counters for one command (INS)"""
+        self.latency = Histogram()
+        self.commands = 0
+        self.frames = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.status = {}
+
+    def snapshot(self):
+        return {
+            'commands': self.commands,
+            'frames': self.frames,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'status': dict(self.status),
+            'latency': self.latency.snapshot(),
+        }
+
+
+class CardMetrics:
+    def __init__(self, station=None):
+        """Per-command latency and throughput counters for a card session"""
+        self.station = station
+        self._lock = threading.Lock()
+        self._commands = {}
+        self._operations = {}
+        self._current_ins = None
+        self.auth_count = 0
+        self.started = time.time()
+
+    def record_apdu(self, apdu, response, sw1, sw2, elapsed):
+        """Record one APDU exchange.
+
+        Additional frames (INS 0xAF) are attributed to the command that
+        started the chain, so a chained read counts as one command with
+        several frames.
+        """
+        ins = apdu[1]
+        with self._lock:
+            if ins == ADDITIONAL_FRAME and self._current_ins is not None:
+                stats = self._stats(self._current_ins)
+            else:
+                self._current_ins = ins
+                stats = self._stats(ins)
+                stats.commands += 1
+                if ins in AUTH_INS:
+                    self.auth_count += 1
+            stats.frames += 1
+            stats.bytes_out += len(apdu)
+            stats.bytes_in += len(response) + 2
+            stats.latency.observe(elapsed)
+            status = (sw1 << 8) | sw2
+            stats.status[status] = stats.status.get(status, 0) + 1
+            if sw2 != ADDITIONAL_FRAME:
+                self._current_ins = None
+
+    def record_operation(self, name, elapsed):
+        """Record the duration of a non-APDU operation (codec, crypto)"""
+        with self._lock:
+            histogram = self._operations.get(name)
+            if histogram is None:
+                histogram = self._operations[name] = Histogram()
+            histogram.observe(elapsed)
+
+    @contextmanager
+    def timed(self, name):
+        """Context manager recording the duration of a block as an operation"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_operation(name, time.perf_counter() - start)
+
+    def reset(self):
+        """Drop all recorded values"""
+        with self._lock:
+            self._commands = {}
+            self._operations = {}
+            self._current_ins = None
+            self.auth_count = 0
+            self.started = time.time()
+
+    def snapshot(self):
+        """Return a plain-dict copy of all counters"""
+        with self._lock:
+            return {
+                'station': self.station,
+                'started': self.started,
+                'auth_count': self.auth_count,
+                'commands': {
+                    INS_NAMES.get(ins, f"0x{ins:02X}"): stats.snapshot()
+                    for ins, stats in self._commands.items()
+                },
+                'operations': {
+                    name: histogram.snapshot()
+                    for name, histogram in self._operations.items()
+                },
+            }
+
+    def to_prometheus(self):
+        """Render the counters in Prometheus text exposition format"""
+        snap = self.snapshot()
+        base = f'station="{snap["station"]}",' if snap['station'] else ''
+        lines = [
+            "# HELP desfire_auth_total Authentications started",
+            "# TYPE desfire_auth_total counter",
+            f"desfire_auth_total{{{base.rstrip(',')}}} {snap['auth_count']}" if base
+            else f"desfire_auth_total {snap['auth_count']}",
+        ]
+
+        counters = (
+            ('commands', "desfire_commands_total", "Commands sent"),
+            ('frames', "desfire_frames_total", "Frames exchanged, including additional frames"),
+            ('bytes_out', "desfire_bytes_out_total", "APDU bytes sent to the card"),
+            ('bytes_in', "desfire_bytes_in_total", "Response bytes received, including status word"),
+        )
+        for key, metric, help_text in counters:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for command, stats in snap['commands'].items():
+                lines.append(f'{metric}{{{base}command="{command}"}} {stats[key]}')
+
+        lines.append("# HELP desfire_status_total Status words returned")
+        lines.append("# TYPE desfire_status_total counter")
+        for command, stats in snap['commands'].items():
+            for status, count in stats['status'].items():
+                lines.append(f'desfire_status_total{{{base}command="{command}",sw="{status:04X}"}} {count}')
+
+        lines.append("# HELP desfire_command_seconds Per-frame APDU latency")
+        lines.append("# TYPE desfire_command_seconds histogram")
+        for command, stats in snap['commands'].items():
+            lines.extend(_histogram_lines("desfire_command_seconds", f'{base}command="{command}"', stats['latency']))
+
+        lines.append("# HELP desfire_operation_seconds Duration of non-APDU operations")
+        lines.append("# TYPE desfire_operation_seconds histogram")
+        for name, histogram in snap['operations'].items():
+            lines.extend(_histogram_lines("desfire_operation_seconds", f'{base}operation="{name}"', histogram))
+
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write the Prometheus text to a file (node_exporter textfile collector)"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp_path, path)
+
+    def serve(self, port=9464, host="127.0.0.1"):
+        """Serve /metrics on a local HTTP port from a daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+    def _stats(self, ins):
+        stats = self._commands.get(ins)
+        if stats is None:
+            stats = self._commands[ins] = CommandStats()
+        return stats
+
+
+def _histogram_lines(metric, labels, histogram):
+    lines = []
+    for bound, count in histogram['buckets']:
+        lines.append(f'{metric}_bucket{{{labels},le="{bound}"}} {count}')
+    lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+    lines.append(f'{metric}_sum{{{labels}}} {histogram["sum"]}')
+    lines.append(f'{metric}_count{{{labels}}} {histogram["count"]}')
+    return lines
+
+
+# Shared registry used when no explicit instance is given
+default_metrics = CardMetrics()
@@ -0,0 +1,114 @@
+import logging
+
+from desfire_ev1.files import FILE_STANDARD, FILE_BACKUP, FILE_LINEAR_RECORD, FILE_CYCLIC_RECORD
+from desfire_ev1.exceptions import StorageError
+
+log = logging.getLogger(__name__)
+
+# DESFire EV1 allocates file memory in blocks of this many bytes
+EEPROM_BLOCK = 32
+
+# Nominal user memory of the 2 KB card; GetFreeMemory gives the real figure
+CARD_CAPACITY = 2048
+
+# Estimated memory taken by an application itself (directory entry and key storage)
+APP_OVERHEAD = 96
+
+
+def allocated_size(size, block=EEPROM_BLOCK):
+    """EEPROM bytes a file of `size` data bytes actually takes"""
+    return -(-size // block) * block
+
+
+def aligned_records(record_size, max_records, block=EEPROM_BLOCK):
+    """Largest record count that fits in the blocks `max_records` records already take"""
+    return allocated_size(record_size * max_records, block) // record_size
+
+
+class StoragePlanner:
+    def __init__(self, capacity=CARD_CAPACITY, block=EEPROM_BLOCK, app_overhead=APP_OVERHEAD):
+        """Block-aligned layout of applications and files on a card.
+
+        Logical sizes are rounded up to the EEPROM block so the slack the
+        card allocates anyway becomes usable, and the total is checked
+        against the card memory before a single APDU is sent.
+        """
+        self.capacity = capacity
+        self.block = block
+        self.app_overhead = app_overhead
+        self.applications = {}
+
+    def add_application(self, aid):
+        self.applications.setdefault(bytes(aid), {})
+        return self
+
+    def add_standard_file(self, aid, file_id, size, backup=False):
+        """Plan a standard (or backup) file of at least `size` bytes"""
+        files = self.applications.setdefault(bytes(aid), {})
+        files[file_id] = {
+            'file_type': FILE_BACKUP if backup else FILE_STANDARD,
+            'min_size': size,
+            'size': allocated_size(size, self.block),
+        }
+        return self
+
+    def add_record_file(self, aid, file_id, record_size, max_records, cyclic=False):
+        """Plan a record file of at least `max_records` records"""
+        files = self.applications.setdefault(bytes(aid), {})
+        files[file_id] = {
+            'file_type': FILE_CYCLIC_RECORD if cyclic else FILE_LINEAR_RECORD,
+            'record_size': record_size,
+            'min_records': max_records,
+            'max_records': aligned_records(record_size, max_records, self.block),
+        }
+        return self
+
+    def file(self, aid, file_id):
+        """Planned settings of one file"""
+        return self.applications[bytes(aid)][file_id]
+
+    def file_bytes(self, settings):
+        """EEPROM taken by a planned file; backup files keep two copies"""
+        if 'record_size' in settings:
+            size = settings['record_size'] * settings['max_records']
+            # Cyclic files keep one spare record for the transaction
+            if settings['file_type'] == FILE_CYCLIC_RECORD:
+                size += settings['record_size']
+            return allocated_size(size, self.block)
+        copies = 2 if settings['file_type'] == FILE_BACKUP else 1
+        return copies * allocated_size(settings['size'], self.block)
+
+    def required(self, existing=None):
+        """Bytes still to allocate; `existing` maps AID bytes to the file IDs already on the card"""
+        existing = existing or {}
+        total = 0
+        for aid, files in self.applications.items():
+            present = existing.get(aid)
+            if present is None:
+                total += self.app_overhead
+                present = ()
+            total += sum(self.file_bytes(settings) for file_id, settings in files.items() if file_id not in present)
+        return total
+
+    def remaining(self, free_memory=None, existing=None):
+        """Free memory left after the plan (capacity is used when free_memory is unknown)"""
+        free = self.capacity if free_memory is None else free_memory
+        return free - self.required(existing)
+
+    def check(self, free_memory=None, existing=None):
+        """Raise StorageError if the plan does not fit; returns the bytes left over"""
+        left = self.remaining(free_memory, existing)
+        if left < 0:
+            raise StorageError(f"Layout needs {-left} bytes more than the card has free")
+        log.debug("Layout fits with %d bytes to spare", left)
+        return left
+
+    def check_data(self, aid, file_id, length):
+        """Raise StorageError if `length` bytes do not fit in a planned file"""
+        settings = self.file(aid, file_id)
+        if 'record_size' in settings:
+            capacity = settings['record_size'] * settings['max_records']
+        else:
+            capacity = settings['size']
+        if length > capacity:
+            raise StorageError(f"{length} bytes do not fit in file {file_id} of {bytes(aid).hex()} ({capacity} bytes)")
@@ -0,0 +1,94 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class SessionProfiler:
+    def __init__(self):
+        """Opt-in span recorder writing Chrome trace-event JSON.
+
+        Disabled by default; while disabled, span() and profiled() cost one
+        attribute check. Open the written file in chrome://tracing or
+        https://ui.perfetto.dev.
+        """
+        self.enabled = False
+        self._events = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._origin = time.perf_counter()
+
+    def enable(self):
+        """Start recording spans"""
+        self.enabled = True
+
+    def disable(self):
+        """Stop recording spans (recorded events are kept)"""
+        self.enabled = False
+
+    def clear(self):
+        """Drop recorded events and restart the clock"""
+        with self._lock:
+            self._events = []
+            self._origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, cat="app", **args):
+        """Record the enclosed block as one complete ("X") event.
+
+        Spans opened inside the block on the same thread nest under it in
+        the trace viewer.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = {
+                'name': name,
+                'cat': cat,
+                'ph': 'X',
+                'ts': (start - self._origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': self._pid,
+                'tid': threading.get_ident(),
+            }
+            if args:
+                event['args'] = args
+            with self._lock:
+                self._events.append(event)
+
+    def profiled(self, name=None, cat="app"):
+        """Decorator wrapping every call of a function in a span"""
+        def decorator(func):
+            span_name = name or func.__qualname__
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self.span(span_name, cat):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def events(self):
+        """Return a copy of the recorded events"""
+        with self._lock:
+            return list(self._events)
+
+    def write(self, path):
+        """Write recorded events as a Chrome trace-event JSON file"""
+        trace = {'traceEvents': self.events(), 'displayTimeUnit': 'ms'}
+        with open(path, "w") as f:
+            json.dump(trace, f)
+        return path
+
+
+# Shared profiler used by the card library and the UI
+profiler = SessionProfiler()
@@ -0,0 +1,139 @@
+import logging
+
+from desfire_ev1.files import COMM_PLAIN, FILE_STANDARD, FILE_BACKUP, FILE_LINEAR_RECORD, FILE_CYCLIC_RECORD
+
+log = logging.getLogger(__name__)
+
+MASTER_APP_ID = [0x00, 0x00, 0x00]
+
+# Outcomes reported by the ensure_* methods
+CREATED = "created"
+REUSED = "reused"
+RECREATED = "recreated"
+FAILED = "failed"
+
+
+class Provisioner:
+    def __init__(self, card, app_manager, file_manager, inventory=None):
+        """Idempotent card provisioning.
+
+        Discovers the existing layout (GetApplicationIDs, GetFileIDs,
+        GetFileSettings) and only creates what is missing, so a reused card
+        can be re-issued without a FormatPICC. Files whose type or size no
+        longer match are deleted and recreated; matching record files are
+        cleared instead of recreated. With a CardInventory and a UID the
+        discovery comes from its cache, and every change is reported back.
+        """
+        self.card = card
+        self.app_manager = app_manager
+        self.file_manager = file_manager
+        self.inventory = inventory
+        self._uid = None
+        self._aid = None
+        self._aids = None
+        self._files = None
+
+    def load_applications(self, uid=None):
+        """Read the application directory; leaves the PICC level selected"""
+        self._uid = uid
+        if self.inventory is not None and uid is not None:
+            snapshot = self.inventory.get(uid, scan=True)
+            self._aids = {tuple(aid) for aid in snapshot}
+            self.card.select_application(MASTER_APP_ID)
+            return self._aids
+        self.card.select_application(MASTER_APP_ID)
+        self._aids = {tuple(aid) for aid in self.app_manager.list_applications()}
+        return self._aids
+
+    def ensure_application(self, aid, key_settings=0x0F, num_keys=0x01):
+        """Create the application unless it already exists (PICC level must be selected)"""
+        if self._aids is None:
+            self.load_applications()
+        if tuple(aid) in self._aids:
+            return REUSED
+        if not self.app_manager.create_application(aid, key_settings, num_keys):
+            return FAILED
+        self._aids.add(tuple(aid))
+        self._changed()
+        return CREATED
+
+    def application_selected(self, aid=None):
+        """Forget the cached file directory; call after selecting another application"""
+        self._aid = aid
+        self._files = None
+
+    def file_settings(self, file_id):
+        """Settings of a file in the selected application (None if missing)"""
+        if self._files is None:
+            snapshot = self._snapshot()
+            if snapshot is not None and bytes(self._aid) in snapshot:
+                self._files = dict(snapshot[bytes(self._aid)])
+            else:
+                self._files = {fid: None for fid in self.file_manager.list_files()}
+        if file_id not in self._files:
+            return None
+        if self._files[file_id] is None:
+            self._files[file_id] = self.file_manager.get_file_settings(file_id)
+        return self._files[file_id]
+
+    def ensure_standard_file(self, file_id, file_size, comm_settings=COMM_PLAIN, access_rights=[0x00, 0x00],
+                             min_size=None, backup=False):
+        """Reuse a matching standard (or backup data) file or (re)create it.
+
+        A file between `min_size` and `file_size` bytes counts as matching:
+        deleted files only give their memory back on a format.
+        """
+        file_type = FILE_BACKUP if backup else FILE_STANDARD
+        create = self.file_manager.create_backup_data_file if backup else self.file_manager.create_standard_file
+        settings = self.file_settings(file_id)
+        if settings is not None:
+            low = file_size if min_size is None else min_size
+            if (settings['file_type'] == file_type and low <= settings['size'] <= file_size
+                    and settings['comm_settings'] == comm_settings):
+                return REUSED
+            return self._recreate(file_id, lambda: create(file_id, file_size, comm_settings, access_rights))
+        return self._create(file_id, create(file_id, file_size, comm_settings, access_rights))
+
+    def ensure_record_file(self, file_id, record_size, max_records, comm_settings=COMM_PLAIN,
+                           access_rights=[0x00, 0x00], cyclic=False, min_records=None):
+        """Reuse and clear a matching record file (at least `min_records` records), or (re)create it"""
+        file_type = FILE_CYCLIC_RECORD if cyclic else FILE_LINEAR_RECORD
+        create = self.file_manager.create_cyclic_record_file if cyclic else self.file_manager.create_linear_record_file
+        settings = self.file_settings(file_id)
+        if settings is not None:
+            low = max_records if min_records is None else min_records
+            if (settings['file_type'] == file_type and settings['record_size'] == record_size
+                    and low <= settings['max_records'] <= max_records and settings['comm_settings'] == comm_settings):
+                if settings['current_records']:
+                    if not (self.file_manager.clear_record_file(file_id) and self.file_manager.commit_transaction()):
+                        return FAILED
+                    settings['current_records'] = 0
+                    self._changed(file_id)
+                return REUSED
+            return self._recreate(file_id, lambda: create(
+                file_id, record_size, max_records, comm_settings, access_rights))
+        return self._create(file_id, create(file_id, record_size, max_records, comm_settings, access_rights))
+
+    def _snapshot(self):
+        if self.inventory is None or self._uid is None or self._aid is None:
+            return None
+        return self.inventory.get(self._uid)
+
+    def _changed(self, file_id=None):
+        # Tell the inventory; a new application or file changes a directory
+        if self.inventory is not None and self._uid is not None:
+            self.inventory.invalidate(self._uid, self._aid, file_id)
+
+    def _create(self, file_id, ok):
+        if not ok:
+            return FAILED
+        self._changed(file_id)
+        self._files[file_id] = None
+        return CREATED
+
+    def _recreate(self, file_id, create):
+        log.info("File %s layout changed - recreating", file_id)
+        if not self.file_manager.delete_file(file_id):
+            return FAILED
+        del self._files[file_id]
+        return RECREATED if self._create(file_id, create()) == CREATED else FAILED
@@ -0,0 +1,155 @@
+import binascii
+import logging
+
+from desfire_ev1.files import COMM_PLAIN
+from desfire_ev1.exceptions import IntegrityError
+
+log = logging.getLogger(__name__)
+
+# Bytes covered by one CRC: a segment and its MAC or CRC still come back in a single frame
+SEGMENT_SIZE = 48
+
+CRC_SIZE = 2
+
+# Length-prefixed payloads start with a 2-byte length and its CRC
+FRAME_HEADER = 4
+
+# How often a segment failing its CRC is read again before giving up
+READ_RETRIES = 2
+
+
+def segment_crc(data):
+    """CRC-16/CCITT of one segment"""
+    return binascii.crc_hqx(bytes(data), 0xFFFF)
+
+
+def segment_count(length, segment_size=SEGMENT_SIZE):
+    return -(-length // segment_size)
+
+
+def table_size(length, segment_size=SEGMENT_SIZE):
+    """Bytes of the CRC table for `length` bytes of payload"""
+    return CRC_SIZE * segment_count(length, segment_size)
+
+
+def sealed_size(length, segment_size=SEGMENT_SIZE):
+    """Payload plus its CRC table"""
+    return length + table_size(length, segment_size)
+
+
+def framed_size(length, segment_size=SEGMENT_SIZE):
+    """Header, payload and CRC table of a length-prefixed payload"""
+    return FRAME_HEADER + sealed_size(length, segment_size)
+
+
+def seal(data, segment_size=SEGMENT_SIZE):
+    """Payload followed by the CRC of each of its segments (little endian)"""
+    data = bytes(data)
+    table = bytearray()
+    for start in range(0, len(data), segment_size):
+        table.extend(segment_crc(data[start:start + segment_size]).to_bytes(CRC_SIZE, 'little'))
+    return data + bytes(table)
+
+
+def frame(data, segment_size=SEGMENT_SIZE):
+    """Sealed payload behind a 2-byte length and the CRC of that length.
+
+    For payloads whose length the reader cannot know in advance (the
+    photo, the compact mission): the header tells where the CRC table is.
+    """
+    length = len(data).to_bytes(2, 'little')
+    return length + segment_crc(length).to_bytes(CRC_SIZE, 'little') + seal(data, segment_size)
+
+
+def framed_spans(data, offset=0, segment_size=SEGMENT_SIZE):
+    """(offset, length) of the header and CRC table of a framed payload held in `data` at `offset`.
+
+    A copy whose header and CRC table match the card's matches it in
+    every segment, short of a CRC collision. None if `data` holds no
+    valid frame there.
+    """
+    header = bytes(data[offset:offset + FRAME_HEADER])
+    if len(header) < FRAME_HEADER or int.from_bytes(header[2:], 'little') != segment_crc(header[:2]):
+        return None
+    length = int.from_bytes(header[:2], 'little')
+    if offset + framed_size(length, segment_size) > len(data):
+        return None
+    return [(offset, FRAME_HEADER), (offset + FRAME_HEADER + length, table_size(length, segment_size))]
+
+
+class SegmentedReader:
+    def __init__(self, file_manager, segment_size=SEGMENT_SIZE, retries=READ_RETRIES):
+        """Reads sealed payloads and re-reads only the segments that fail their CRC.
+
+        A payload of `length` bytes at `offset` is followed by one CRC per
+        segment. The payload and table are read in one (chained) command;
+        each segment is then checked, and a failing one is read again on
+        its own, which costs a single frame instead of tapping the card
+        again. If the segment still fails, its table entry is re-read too.
+        Reads that come back short (a MAC or CRC error in a secure mode
+        ends the session) raise IntegrityError without retrying.
+        """
+        self.file_manager = file_manager
+        self.segment_size = segment_size
+        self.retries = retries
+        self.segments_read = 0
+        self.segments_reread = 0
+
+    def _read(self, file_id, offset, length, comm_mode, head=b""):
+        """Bytes [offset, offset + length) of a file, taking what `head` (read from 0) already has"""
+        end = offset + length
+        data = bytes(head[offset:end])
+        if len(data) < length:
+            data += bytes(self.file_manager.read_data(file_id, offset + len(data), length - len(data),
+                                                      comm_mode=comm_mode))
+        if len(data) != length:
+            raise IntegrityError(f"Short read of file {file_id}: {len(data)} of {length} bytes")
+        return data
+
+    def read(self, file_id, offset, length, comm_mode=COMM_PLAIN, head=b""):
+        """Verified payload of `length` bytes sealed at `offset`"""
+        sealed = self._read(file_id, offset, sealed_size(length, self.segment_size), comm_mode, head)
+        payload = bytearray(sealed[:length])
+        table = bytearray(sealed[length:])
+        for index, start in enumerate(range(0, length, self.segment_size)):
+            end = min(start + self.segment_size, length)
+            entry = slice(index * CRC_SIZE, (index + 1) * CRC_SIZE)
+            self.segments_read += 1
+            attempt = 0
+            while segment_crc(payload[start:end]) != int.from_bytes(table[entry], 'little'):
+                if attempt == self.retries:
+                    raise IntegrityError(f"Segment {index} of file {file_id} fails its CRC")
+                attempt += 1
+                self.segments_reread += 1
+                log.info("Segment %d of file %s fails its CRC: reading it again", index, file_id)
+                payload[start:end] = self._read(file_id, offset + start, end - start, comm_mode)
+                if attempt > 1:
+                    table[entry] = self._read(file_id, offset + length + entry.start, CRC_SIZE, comm_mode)
+        return bytes(payload)
+
+    def read_framed(self, file_id, offset, comm_mode=COMM_PLAIN, head=b""):
+        """Verified payload of a length-prefixed frame at `offset`"""
+        header = self._read(file_id, offset, FRAME_HEADER, comm_mode, head)
+        attempt = 0
+        while segment_crc(header[:2]) != int.from_bytes(header[2:], 'little'):
+            if attempt == self.retries:
+                raise IntegrityError(f"Frame header of file {file_id} fails its CRC")
+            attempt += 1
+            header = self._read(file_id, offset, FRAME_HEADER, comm_mode)
+        length = int.from_bytes(header[:2], 'little')
+        return self.read(file_id, offset + FRAME_HEADER, length, comm_mode, head)
+
+    def patch(self, file_id, offset, payload, start, data, comm_mode=COMM_PLAIN):
+        """Change bytes of a verified sealed payload and the CRCs of their segments.
+
+        Written as one command from the first changed byte to the last
+        updated table entry. Returns the new payload, or None on failure.
+        """
+        payload = bytearray(payload)
+        payload[start:start + len(data)] = bytes(data)
+        last = (start + len(data) - 1) // self.segment_size
+        sealed = seal(payload, self.segment_size)
+        end = len(payload) + (last + 1) * CRC_SIZE
+        if not self.file_manager.write_data(file_id, offset + start, list(sealed[start:end]), comm_mode=comm_mode):
+            return None
+        return bytes(payload)
@@ -0,0 +1,294 @@
+import zlib
+
+from .crypto import default_context, BLOCK_SIZES, KEY_3DES, KEY_AES
+from .exceptions import IntegrityError
+
+MAC_LENGTH = 8
+ADDITIONAL_FRAME = 0xAF
+
+# CMAC subkey constants per block size
+_RB = {8: 0x1B, 16: 0x87}
+
+
+class Cmac:
+    def __init__(self, ecb, block_size, iv=None):
+        """Streaming CMAC (NIST SP 800-38B) over a cached ECB cipher.
+
+        `iv` seeds the chaining value, which is how DESFire EV1 chains the
+        MAC of one command onto the next. Data can be fed in arbitrary
+        pieces with update(); only the last block is held back.
+        """
+        self._ecb = ecb
+        self._size = block_size
+        self._chain = int.from_bytes(iv or bytes(block_size), 'big')
+        self._pending = bytearray()
+        self._k1, self._k2 = _subkeys(ecb, block_size)
+
+    def update(self, data):
+        self._pending.extend(data)
+        size = self._size
+        # Keep at least one byte back: the final block is masked with K1/K2
+        full = (len(self._pending) - 1) // size * size
+        if full <= 0:
+            return
+        chain = self._chain
+        encrypt = self._ecb.encrypt
+        pending = self._pending
+        for i in range(0, full, size):
+            block = int.from_bytes(pending[i:i + size], 'big') ^ chain
+            chain = int.from_bytes(encrypt(block.to_bytes(size, 'big')), 'big')
+        self._chain = chain
+        del pending[:full]
+
+    def finalize(self):
+        """Return the full CMAC block"""
+        size = self._size
+        last = self._pending
+        if len(last) == size:
+            block = int.from_bytes(last, 'big') ^ self._k1
+        else:
+            padded = bytes(last) + b'\x80' + bytes(size - len(last) - 1)
+            block = int.from_bytes(padded, 'big') ^ self._k2
+        block ^= self._chain
+        return self._ecb.encrypt(block.to_bytes(size, 'big'))
+
+
+def _subkeys(ecb, size):
+    mask = (1 << (size * 8)) - 1
+    msb = 1 << (size * 8 - 1)
+    l = int.from_bytes(ecb.encrypt(bytes(size)), 'big')
+    k1 = ((l << 1) & mask) ^ (_RB[size] if l & msb else 0)
+    k2 = ((k1 << 1) & mask) ^ (_RB[size] if k1 & msb else 0)
+    return k1, k2
+
+
+def derive_session_key(key_type, rnd_a, rnd_b, key_length=16):
+    """Derive the EV1 session key from the two authentication randoms"""
+    if key_type == KEY_AES:
+        return rnd_a[0:4] + rnd_b[0:4] + rnd_a[12:16] + rnd_b[12:16]
+    if key_type == KEY_3DES and key_length == 24:
+        return (rnd_a[0:4] + rnd_b[0:4] + rnd_a[6:10] + rnd_b[6:10]
+                + rnd_a[12:16] + rnd_b[12:16])
+    if key_type == KEY_3DES:
+        return rnd_a[0:4] + rnd_b[0:4] + rnd_a[4:8] + rnd_b[4:8]
+    return rnd_a[0:4] + rnd_b[0:4]
+
+
+class SecureSession:
+    def __init__(self, key_type, session_key, key_number, secure_messaging=True, context=None):
+        """Authenticated session state: session key and running IV.
+
+        With secure messaging on (EV1 AuthenticateISO/AES), every command
+        is CMACed into the running IV and every response MAC is verified
+        against it. Chained frames are fed into the MAC as they arrive, so
+        a long read is verified incrementally rather than per block.
+        Legacy (0x0A) sessions only keep the session key.
+        """
+        self.key_type = key_type
+        self.session_key = bytes(session_key)
+        self.key_number = key_number
+        self.secure_messaging = secure_messaging
+        self.context = context or default_context
+        self.block_size = BLOCK_SIZES[key_type]
+        self.iv = bytes(self.block_size)
+        self.valid = True
+        # Set by callers that decrypt the response themselves (enciphered mode)
+        self.raw_response = False
+        self._command_mac = None
+        self._response_mac = None
+        self._skip_command_mac = False
+        self._await_response_mac = False
+
+    def ecb(self):
+        return self.context.ecb(self.session_key, self.key_type)
+
+    def cmac(self, data, iv=None):
+        """One-shot CMAC with the session key"""
+        mac = Cmac(self.ecb(), self.block_size, iv)
+        mac.update(data)
+        return mac.finalize()
+
+    def skip_command_mac(self):
+        """Next command carries its own MAC or ciphertext.
+
+        The caller has already moved the IV (to the transmitted MAC or the
+        last ciphertext block); only the response MAC is checked.
+        """
+        self._skip_command_mac = True
+
+    def on_command(self, apdu):
+        """Feed an outgoing native-wrapped APDU into the command MAC"""
+        if not self.secure_messaging:
+            return
+        ins = apdu[1]
+        payload = apdu[5:-1] if len(apdu) > 5 else []
+        if ins == ADDITIONAL_FRAME:
+            if self._command_mac is not None:
+                # Continuation of a chained write
+                self._command_mac.update(payload)
+            return
+        self._response_mac = None
+        if self._skip_command_mac:
+            self._skip_command_mac = False
+            self._command_mac = None
+            self._await_response_mac = True
+            return
+        self._command_mac = Cmac(self.ecb(), self.block_size, self.iv)
+        self._command_mac.update(bytes([ins]) + bytes(payload))
+
+    def on_response(self, data, sw1, sw2):
+        """Check a response frame against the running MAC.
+
+        Returns the frame data with the trailing MAC stripped from the
+        final frame. Raises IntegrityError on a MAC mismatch.
+        """
+        if sw1 != 0x91 or sw2 not in (0x00, ADDITIONAL_FRAME):
+            # Any error status resets the authentication on the card
+            self.invalidate()
+            return data
+        if not self.secure_messaging:
+            return data
+        if self._command_mac is not None:
+            if sw2 == ADDITIONAL_FRAME and not data and not self.raw_response:
+                # Card requests the next frame of a chained write
+                return data
+            self.iv = self._command_mac.finalize()
+            self._command_mac = None
+            if not self.raw_response:
+                self._response_mac = Cmac(self.ecb(), self.block_size, self.iv)
+        elif self._await_response_mac:
+            if sw2 == ADDITIONAL_FRAME and not data:
+                return data
+            self._await_response_mac = False
+            self._response_mac = Cmac(self.ecb(), self.block_size, self.iv)
+        if self.raw_response:
+            if sw2 == 0x00:
+                self.raw_response = False
+            return data
+        if self._response_mac is None:
+            return data
+        if sw2 == ADDITIONAL_FRAME:
+            self._response_mac.update(data)
+            return data
+        if len(data) < MAC_LENGTH:
+            self.invalidate()
+            raise IntegrityError("Response too short to carry a MAC")
+        body, mac = data[:-MAC_LENGTH], data[-MAC_LENGTH:]
+        self._response_mac.update(body)
+        self._response_mac.update(b'\x00')
+        full = self._response_mac.finalize()
+        self._response_mac = None
+        if bytes(mac) != full[:MAC_LENGTH]:
+            self.invalidate()
+            raise IntegrityError("Response MAC mismatch")
+        self.iv = full
+        return body
+
+    def invalidate(self):
+        """Mark the session as no longer authenticated"""
+        self.valid = False
+        self._command_mac = None
+        self._response_mac = None
+        self.raw_response = False
+        self._skip_command_mac = False
+        self._await_response_mac = False
+
+
+def crc32_update(data, crc=0):
+    """Running zlib CRC32; pass the result back in to continue"""
+    return zlib.crc32(data, crc)
+
+
+def crc32_finish(crc):
+    """DESFire EV1 CRC32 (no final XOR) as 4 little-endian bytes"""
+    return ((crc ^ 0xFFFFFFFF) & 0xFFFFFFFF).to_bytes(4, 'little')
+
+
+class EncipheredWriter:
+    def __init__(self, session, command, data):
+        """Lazily enciphers `data || CRC32(command || data)` for a chained write.
+
+        The plaintext is copied once into a working buffer and encrypted in
+        place, a frame's worth of blocks at a time, with one cached cipher
+        and a running IV. read(n) returns the next n ciphertext bytes. The
+        session IV is moved to the last ciphertext block once it has been
+        produced, ready for the response MAC.
+        """
+        self.session = session
+        size = session.block_size
+        crc = crc32_update(bytes(data), crc32_update(bytes(command)))
+        self._buf = bytearray(data)
+        self._buf.extend(crc32_finish(crc))
+        if len(self._buf) % size:
+            self._buf.extend(bytes(size - len(self._buf) % size))
+        self._view = memoryview(self._buf)
+        self._iv = session.iv
+        self._encrypted = 0
+        self._sent = 0
+
+    def __len__(self):
+        return len(self._buf)
+
+    def read(self, n):
+        end = min(self._sent + n, len(self._buf))
+        if end > self._encrypted:
+            size = self.session.block_size
+            stop = min(-(-end // size) * size, len(self._buf))
+            self._iv = self.session.context.cbc_encrypt_inplace(
+                self._view[self._encrypted:stop], self.session.session_key, self._iv, self.session.key_type)
+            self._encrypted = stop
+            if stop == len(self._buf):
+                self.session.iv = self._iv
+        chunk = bytes(self._view[self._sent:end])
+        self._sent = end
+        return chunk
+
+
+class EncipheredReader:
+    def __init__(self, session, length):
+        """Deciphers a chained enciphered response frame by frame.
+
+        Complete blocks are decrypted as each frame arrives and the CRC32
+        is updated over the plaintext data, so the CRC is known when the
+        last frame lands; only a partial block is ever carried over.
+        """
+        self.session = session
+        self.length = length
+        self.data = bytearray()
+        self._tail = bytearray()
+        self._carry = bytearray()
+        # Taken on the first frame: the command MAC moves the IV on receipt
+        self._iv = None
+        self._crc = 0
+
+    def feed(self, frame):
+        size = self.session.block_size
+        if self._iv is None:
+            self._iv = self.session.iv
+        self._carry.extend(frame)
+        full = len(self._carry) // size * size
+        if not full:
+            return
+        blocks = self._carry[:full]
+        del self._carry[:full]
+        self._iv = self.session.context.cbc_decrypt_inplace(
+            blocks, self.session.session_key, self._iv, self.session.key_type)
+        room = self.length - len(self.data)
+        if room > 0:
+            part = blocks[:room]
+            self.data.extend(part)
+            self._crc = crc32_update(part, self._crc)
+            blocks = blocks[room:]
+        self._tail.extend(blocks)
+
+    def finish(self, status=0x00):
+        """Verify the CRC and padding; returns the plaintext data"""
+        if self._carry or len(self.data) != self.length or len(self._tail) < 4:
+            self.session.invalidate()
+            raise IntegrityError("Enciphered response has an unexpected length")
+        crc = crc32_finish(crc32_update(bytes([status]), self._crc))
+        if bytes(self._tail[:4]) != crc or any(self._tail[4:]):
+            self.session.invalidate()
+            raise IntegrityError("Enciphered response CRC mismatch")
+        self.session.iv = self._iv
+        return bytes(self.data)
@@ -0,0 +1,187 @@
+from collections import OrderedDict
+import logging
+import threading
+
+from desfire_ev1.files import COMM_PLAIN
+
+log = logging.getLogger(__name__)
+
+# Unchanged runs up to this long are rewritten rather than split into two commands
+MERGE_GAP = 16
+
+# Files up to this size are re-read before diffing instead of trusting the shadow
+VERIFY_LIMIT = 96
+
+# Windows of a larger file compared with the card before its shadow is trusted, when no check is given
+SPOT_CHECKS = 3
+
+
+def diff_spans(old, new, offset=0, merge_gap=MERGE_GAP):
+    """Byte ranges of `new` that differ from `old`, as (offset, bytes) pairs.
+
+    Bytes past the end of `old` count as changed. Changed runs separated by
+    at most `merge_gap` unchanged bytes are coalesced, since one longer
+    write is cheaper than two command round trips.
+    """
+    new = bytes(new)
+    spans = []
+    start = end = None
+    for i, byte in enumerate(new):
+        if i < len(old) and old[i] == byte:
+            continue
+        if start is not None and i - end <= merge_gap:
+            end = i + 1
+            continue
+        if start is not None:
+            spans.append((offset + start, new[start:end]))
+        start, end = i, i + 1
+    if start is not None:
+        spans.append((offset + start, new[start:end]))
+    return spans
+
+
+class CardShadow:
+    def __init__(self, max_cards=256):
+        """Last known file contents per card UID, with a bounded LRU over cards"""
+        self.max_cards = max_cards
+        self._cards = OrderedDict()
+        self._checked = set()
+        self._lock = threading.Lock()
+
+    def get(self, uid, aid, file_id):
+        with self._lock:
+            files = self._cards.get(bytes(uid))
+            if files is None:
+                return None
+            self._cards.move_to_end(bytes(uid))
+            return files.get((bytes(aid), file_id))
+
+    def set(self, uid, aid, file_id, data):
+        """Record the full contents of a file, as just read or written (checked)"""
+        with self._lock:
+            files = self._cards.setdefault(bytes(uid), {})
+            self._cards.move_to_end(bytes(uid))
+            files[(bytes(aid), file_id)] = bytearray(data)
+            self._checked.add((bytes(uid), bytes(aid), file_id))
+            if len(self._cards) > self.max_cards:
+                old, _ = self._cards.popitem(last=False)
+                self._checked = {key for key in self._checked if key[0] != old}
+
+    def checked(self, uid, aid, file_id):
+        with self._lock:
+            return (bytes(uid), bytes(aid), file_id) in self._checked
+
+    def mark_checked(self, uid, aid, file_id):
+        with self._lock:
+            self._checked.add((bytes(uid), bytes(aid), file_id))
+
+    def uncheck(self, uid):
+        """The card is presented again: another station may have written it since"""
+        with self._lock:
+            self._checked = {key for key in self._checked if key[0] != bytes(uid)}
+
+    def patch(self, uid, aid, file_id, offset, data):
+        """Apply a successful write to the shadow copy"""
+        current = self.get(uid, aid, file_id)
+        if current is not None:
+            with self._lock:
+                current[offset:offset + len(data)] = bytes(data)
+
+    def forget(self, uid, aid=None, file_id=None):
+        """Drop a card, one of its applications or a single file"""
+        with self._lock:
+            files = self._cards.get(bytes(uid))
+            if files is None:
+                return
+            if aid is None:
+                del self._cards[bytes(uid)]
+                self._checked = {key for key in self._checked if key[0] != bytes(uid)}
+                return
+            for key in [key for key in files if key[0] == bytes(aid) and file_id in (None, key[1])]:
+                del files[key]
+                self._checked.discard((bytes(uid),) + key)
+
+    def clear(self):
+        with self._lock:
+            self._cards.clear()
+            self._checked.clear()
+
+
+class DiffWriter:
+    def __init__(self, file_manager, shadow=None, merge_gap=MERGE_GAP, verify_limit=VERIFY_LIMIT):
+        """Writes standard files as byte-range diffs against a CardShadow.
+
+        The shadow of a file is loaded with one read the first time a card
+        is seen (or seeded by the caller, e.g. zeros for a new file). Small
+        files are re-read every time: that costs a frame or two and catches
+        changes made by another station, such as a delivery status update.
+        The shadow of a larger file is compared with the card once per tap
+        (see CardShadow.uncheck) on a few short ranges before it is trusted.
+        Only the changed spans are written, each as one (chained) command.
+        """
+        self.file_manager = file_manager
+        self.shadow = shadow if shadow is not None else CardShadow()
+        self.merge_gap = merge_gap
+        self.verify_limit = verify_limit
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+
+    def load(self, uid, aid, file_id, file_size, comm_mode=COMM_PLAIN, check=None):
+        """Shadow of a file, reading it from the card when unknown or small; None if unknown or stale.
+
+        `check(shadow)` gives the (offset, length) ranges that vouch for a
+        large file, such as the header and CRC table of a framed payload;
+        by default a few windows spread over the file are compared.
+        """
+        current = self.shadow.get(uid, aid, file_id)
+        if current is not None and len(current) >= file_size and file_size > self.verify_limit:
+            if self.shadow.checked(uid, aid, file_id):
+                return current
+            if self.matches_card(current, file_id, file_size, comm_mode, check):
+                self.shadow.mark_checked(uid, aid, file_id)
+                return current
+            log.info("Shadow of file %s differs from the card: writing it in full", file_id)
+            self.shadow.forget(uid, aid, file_id)
+            return None
+        data = self.file_manager.read_data(file_id, 0, file_size, comm_mode=comm_mode)
+        if len(data) != file_size:
+            self.shadow.forget(uid, aid, file_id)
+            return None
+        self.shadow.set(uid, aid, file_id, data)
+        return self.shadow.get(uid, aid, file_id)
+
+    def matches_card(self, current, file_id, file_size, comm_mode=COMM_PLAIN, check=None):
+        """Whether the card holds what the shadow says on the ranges that vouch for it"""
+        spans = check(current) if check is not None else None
+        if not spans:
+            step = max(file_size // SPOT_CHECKS, self.verify_limit)
+            spans = [(start, min(self.verify_limit, file_size - start)) for start in range(0, file_size, step)]
+        for start, length in spans:
+            data = self.file_manager.read_data(file_id, start, length, comm_mode=comm_mode)
+            if bytes(data) != bytes(current[start:start + length]):
+                return False
+        return True
+
+    def write(self, uid, aid, file_id, offset, data, comm_mode=COMM_PLAIN, file_size=None, check=None):
+        """Write `data` at `offset`, sending only what differs from the card"""
+        data = bytes(data)
+        current = None
+        if uid is not None and file_size:
+            current = self.load(uid, aid, file_id, file_size, comm_mode, check)
+        if current is None:
+            spans = [(offset, data)] if data else []
+        else:
+            spans = diff_spans(current[offset:offset + len(data)], data, offset, self.merge_gap)
+        sent = 0
+        for start, chunk in spans:
+            if not self.file_manager.write_data(file_id, start, chunk, comm_mode=comm_mode):
+                if uid is not None:
+                    self.shadow.forget(uid, aid, file_id)
+                return False
+            sent += len(chunk)
+            if current is not None:
+                self.shadow.patch(uid, aid, file_id, start, chunk)
+        self.bytes_written += sent
+        self.bytes_skipped += len(data) - sent
+        log.debug("File %s: wrote %d of %d bytes in %d commands", file_id, sent, len(data), len(spans))
+        return True
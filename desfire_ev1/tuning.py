@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+from desfire_ev1.utils import to_3bytes
+
+log = logging.getLogger(__name__)
+
+# Frame sizes (command data bytes, Lc) tried by the probe; a short APDU carries at most 255
+PROBE_FRAMES = (32, 54, 64, 96, 128, 192, 255)
+
+# Timed writes per frame size
+PROBE_REPEATS = 3
+
+# WriteData header in the first frame: file ID, 3-byte offset, 3-byte length
+WRITE_HEADER = 7
+
+# Target duration of one journaled chunk: longer chunks mean fewer checkpoints, shorter ones less to resend
+CHUNK_TIME = 0.15
+
+# Bounds of a chunk, in frames
+MIN_CHUNK_FRAMES = 2
+MAX_CHUNK_FRAMES = 32
+
+
+class ReaderProfile:
+    def __init__(self, reader, max_frame_data, frame_latency, chunk_size, card_version=None):
+        """Measured transfer settings of one reader.
+
+        `max_frame_data` is the largest Lc the reader passed in a test
+        write, `frame_latency` the seconds one such frame takes and
+        `chunk_size` the bytes of a long write between two journal
+        checkpoints, a whole number of frames.
+        """
+        self.reader = reader
+        self.max_frame_data = max_frame_data
+        self.frame_latency = frame_latency
+        self.chunk_size = chunk_size
+        self.card_version = card_version
+
+    def rate(self):
+        """Bytes per second of a chained write"""
+        return self.max_frame_data / self.frame_latency if self.frame_latency else 0.0
+
+    def to_dict(self):
+        return {'max_frame_data': self.max_frame_data, 'frame_latency': self.frame_latency,
+                'chunk_size': self.chunk_size, 'card_version': self.card_version}
+
+    @classmethod
+    def from_dict(cls, reader, data):
+        return cls(reader, int(data['max_frame_data']), float(data['frame_latency']), int(data['chunk_size']),
+                   data.get('card_version'))
+
+
+def chunk_for(max_frame_data, frame_latency, chunk_time=CHUNK_TIME):
+    """Chunk size filling whole frames and taking about `chunk_time` seconds"""
+    frames = int(chunk_time / frame_latency) if frame_latency else MAX_CHUNK_FRAMES
+    frames = max(MIN_CHUNK_FRAMES, min(MAX_CHUNK_FRAMES, frames))
+    # The first frame of a WriteData also carries its header
+    return frames * max_frame_data - WRITE_HEADER
+
+
+def _write_frame(card, file_id, data):
+    """One unchained WriteData at offset 0; False if the reader or the card refused it"""
+    apdu = [0x90, 0x3D, 0x00, 0x00, WRITE_HEADER + len(data), file_id] + to_3bytes(0) + to_3bytes(len(data))
+    try:
+        response, sw1, sw2 = card.transmit(apdu + list(data) + [0x00])
+    except Exception as e:
+        log.debug("Frame of %d bytes failed: %s", WRITE_HEADER + len(data), e)
+        return False
+    return sw1 == 0x91 and sw2 == 0x00
+
+
+def probe_reader(card, file_manager, file_id, file_size, frames=PROBE_FRAMES, repeats=PROBE_REPEATS):
+    """Measure the reader's largest frame and its time per frame; None if no frame size passed.
+
+    GetVersion identifies the card; then test data is written in single
+    frames of growing size to a plain standard file of the selected
+    application (its contents are overwritten) and read back. The first
+    size the reader or card refuses, or that reads back wrong, ends the
+    probe. The refused frame resets the authentication on the card.
+    """
+    try:
+        version = card.get_version()
+    except Exception as e:
+        log.warning("GetVersion failed, reader not probed: %s", e)
+        return None
+    card_version = f"{version[1][3]}.{version[1][4]}" if len(version) > 1 and len(version[1]) > 4 else None
+    best = None
+    latency = None
+    for size in sorted(frames):
+        length = size - WRITE_HEADER
+        if length > file_size:
+            break
+        data = os.urandom(length)
+        elapsed = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            if not _write_frame(card, file_id, data):
+                break
+            elapsed.append(time.perf_counter() - start)
+        if len(elapsed) < repeats or bytes(file_manager.read_data(file_id, 0, length)) != data:
+            break
+        best, latency = size, statistics.median(elapsed)
+    if best is None:
+        return None
+    profile = ReaderProfile(str(card.reader), best, latency, chunk_for(best, latency), card_version)
+    log.info("Reader %s: %d-byte frames, %.1f ms per frame (%.0f B/s), %d-byte chunks", profile.reader, best,
+             latency * 1000, profile.rate(), profile.chunk_size)
+    return profile
+
+
+class ReaderProfiles:
+    def __init__(self, path=None):
+        """Reader profiles cached by reader name, so each reader is probed once.
+
+        With a path the profiles are kept in a JSON file, re-read before
+        each save so stations sharing the file keep each other's entries.
+        """
+        self.path = path
+        self._profiles = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._profiles = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return {reader: ReaderProfile.from_dict(reader, data) for reader, data in json.load(f).items()}
+        except (OSError, ValueError, KeyError) as e:
+            log.warning("Cannot load reader profiles %s: %s", self.path, e)
+            return {}
+
+    def get(self, reader):
+        with self._lock:
+            return self._profiles.get(str(reader))
+
+    def put(self, profile):
+        with self._lock:
+            if self.path and os.path.exists(self.path):
+                self._profiles.update(self._load())
+            self._profiles[profile.reader] = profile
+            if not self.path:
+                return
+            tmp = self.path + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({reader: p.to_dict() for reader, p in self._profiles.items()}, f, indent=2)
+            os.replace(tmp, self.path)
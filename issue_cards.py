@@ -0,0 +1,209 @@
+"""Issue a batch of mission cards from a manifest, without the window.
+
+    python issue_cards.py missions.csv [--readers 0 1] [--workers 4] [--report report.csv]
+
+A manifest is a CSV file with a header or a JSON list of objects, one mission per row:
+driver_name, driver_license, photo (path relative to the manifest), truck (license plate),
+source, destination, articles ("AR01:10;AR02:5", or a JSON list of {"content", "quantity"})
+and optionally mission_id. The card layout comes from DESFIRE_LAYOUT/DESFIRE_ENCODING as in
+main.py.
+"""
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from mission.events import EventClient, EventFlusher
+from mission.staging import CardStager
+from desfire_ev1.log import LazyHex
+from station import CardStation, configure_station
+
+log = logging.getLogger("issue_cards")
+
+# Manifest fields every mission needs
+REQUIRED_FIELDS = ('driver_name', 'driver_license', 'photo', 'source', 'destination')
+
+# Columns of the --report file
+REPORT_FIELDS = ('mission_id', 'reader', 'uid', 'status', 'stage_s', 'wait_s', 'write_s', 'bytes')
+
+# Stager of a pool worker and the layouts it was given, built once per process
+_stager = None
+_layouts = None
+
+
+def parse_articles(articles):
+    """Article list of a manifest row: "content:quantity;..." or a list of objects"""
+    if isinstance(articles, str):
+        parsed = []
+        for item in articles.split(';'):
+            content, _, quantity = item.partition(':')
+            if content.strip():
+                parsed.append({'content': content.strip(), 'quantity': int(quantity or 1)})
+        return parsed
+    return [{'content': article['content'], 'quantity': int(article.get('quantity', 1))} for article in articles]
+
+
+def load_manifest(path):
+    """Forms of a manifest, as the source interface emits them (plus their mission_id)"""
+    with open(path, newline='') as f:
+        rows = json.load(f) if path.lower().endswith('.json') else list(csv.DictReader(f))
+    base = os.path.dirname(os.path.abspath(path))
+    forms = []
+    for number, row in enumerate(rows, 1):
+        for field in REQUIRED_FIELDS:
+            if not row.get(field):
+                raise ValueError(f"Manifest row {number}: no {field}")
+        forms.append({
+            'driver_name': row['driver_name'],
+            'driver_license': row['driver_license'],
+            'truck': {'license_plate': row['truck']} if row.get('truck') else None,
+            'source': row['source'],
+            'destination': row['destination'],
+            'articles': parse_articles(row.get('articles') or []),
+            'image_path': os.path.join(base, row['photo']),
+            'image_vec': None,
+            'mission_id': row.get('mission_id') or None,
+        })
+    return forms
+
+
+def _init_worker(plans, dictionary, digest_key, driver_size):
+    global _stager, _layouts
+    # The image codec (and torch) is only loaded in the workers
+    from ui.pic_codec import CardImageCodec
+    _stager = CardStager(plans, dictionary, digest_key, compress=CardImageCodec().usable_compress,
+                         driver_size=driver_size)
+    _layouts = list(plans)
+
+
+def _stage(form, mission_id, layout_index):
+    """StagedCard of a form and the seconds it took (in a pool worker)"""
+    start = time.perf_counter()
+    staged = _stager.stage(form, mission_id, _layouts[layout_index])
+    return staged, time.perf_counter() - start
+
+
+def flush_events(station):
+    """Send the issued missions upstream now; what fails stays journaled for the window stations"""
+    if not station.api_url:
+        return
+    try:
+        EventFlusher(station.delivery_journal, EventClient(station.api_url)).flush()
+    except (OSError, ValueError) as e:
+        log.warning("Issued missions not sent (%d pending): %s", station.delivery_journal.pending_count(), e)
+
+
+def write_card(station, staged, issued):
+    """Prompt for a card on the station's reader and write it: (status, uid, wait_s, write_s)"""
+    reader = str(station.desfireCardManager.reader)
+    asked = time.perf_counter()
+    while True:
+        try:
+            answer = input(f"[{reader}] Place a card for mission {staged.mission_id} "
+                           f"and press Enter (s: skip, q: quit) ").strip().lower()
+        except EOFError:
+            answer = 'q'
+        if answer in ('q', 's'):
+            return ("quit" if answer == 'q' else "skipped"), None, time.perf_counter() - asked, 0.0
+        try:
+            uid = station.new_card()
+        except Exception as e:
+            print(f"No card on {reader}: {e}")
+            continue
+        if uid is None:
+            print(f"No DESFire card on {reader}")
+            continue
+        if uid in issued:
+            print(f"Card {LazyHex(uid)} already received a mission in this batch: swap it")
+            continue
+        wait_s = time.perf_counter() - asked
+        start = time.perf_counter()
+        if station.issue_card(uid, staged):
+            issued.add(uid)
+            return "written", uid, wait_s, time.perf_counter() - start
+        # The journal keeps the steps done: presenting the same card again resumes
+        print(f"Card {LazyHex(uid)} was not completed, present it again")
+
+
+def issue_batch(stations, forms, workers):
+    """Stage the forms in a process pool and write them through the stations in turn; report rows"""
+    station = stations[0]
+    layouts = list(station.storage_plans)
+    layout_index = layouts.index(station.issue_layout)
+    # One store, journal and ID allocator for the batch, as in a window station
+    station.open_missions()
+    for other in stations[1:]:
+        other.store, other.delivery_journal = station.store, station.delivery_journal
+    for form in forms:
+        form['mission_id'] = form['mission_id'] or station.id_allocator.next_id()
+
+    rows = []
+    issued = set()
+    # Spawned (not forked) workers: they share neither the reader connections nor torch state
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker,
+                               initargs=(station.storage_plans, station.mission_dictionary, station.digest_key,
+                                         station.driver_file_size))
+    try:
+        futures = [pool.submit(_stage, form, form['mission_id'], layout_index) for form in forms]
+        for number, (form, future) in enumerate(zip(forms, futures)):
+            station = stations[number % len(stations)]
+            row = {'mission_id': form['mission_id'], 'reader': str(station.desfireCardManager.reader), 'uid': '',
+                   'status': '', 'stage_s': '', 'wait_s': '', 'write_s': '', 'bytes': ''}
+            try:
+                staged, stage_s = future.result()
+            except Exception as e:
+                log.error("Cannot stage mission %s: %s", form['mission_id'], e)
+                row['status'] = "not staged"
+                rows.append(row)
+                print_row(row)
+                continue
+            # The worker's copy of the layout is replaced by ours: storage plans are keyed by it
+            staged.layout = layouts[layout_index]
+            status, uid, wait_s, write_s = write_card(station, staged, issued)
+            if status == "quit":
+                break
+            row.update(uid=uid.hex().upper() if uid else '', status=status, stage_s=f"{stage_s:.2f}",
+                       wait_s=f"{wait_s:.2f}", write_s=f"{write_s:.2f}", bytes=staged.size())
+            rows.append(row)
+            print_row(row)
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        flush_events(stations[0])
+        stations[0].close_missions()
+    return rows
+
+
+def print_row(row):
+    print(f"{row['mission_id']:<10} {row['status']:<10} uid {row['uid'] or '-':<14} stage {row['stage_s'] or '-':>6} s"
+          f"  wait {row['wait_s'] or '-':>6} s  write {row['write_s'] or '-':>6} s  {row['bytes'] or '-'} bytes")
+
+
+def write_report(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('manifest', help="CSV or JSON manifest of missions")
+    parser.add_argument('--readers', type=int, nargs='+', default=[0], help="reader indices, used in turn")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="staging processes")
+    parser.add_argument('--report', help="write the per-card report to this CSV file")
+    args = parser.parse_args()
+    configure_station()
+    forms = load_manifest(args.manifest)
+    stations = [CardStation(reader_index=index) for index in args.readers]
+    start = time.perf_counter()
+    rows = issue_batch(stations, forms, args.workers)
+    written = [row for row in rows if row['status'] == "written"]
+    print(f"{len(written)}/{len(forms)} cards written in {time.perf_counter() - start:.1f} s")
+    if args.report:
+        write_report(rows, args.report)
+    sys.exit(0 if len(written) == len(forms) else 1)
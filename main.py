@@ -3,54 +3,63 @@
 import sys
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, 
                              QPushButton, QVBoxLayout, QHBoxLayout, QStackedWidget)
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, pyqtSignal
 from ui.source_interface import SourceInterface
 from ui.destination_interface import DestinationInterface  # Add this import
 
-from desfire_ev1.applications import ApplicationManager
-from desfire_ev1.files import FileManager
-from desfire_ev1.desfire_ev1_card import DesfireCard
-import json
+from desfire_ev1.keys import roll_to_diversified, roll_master_to_diversified
+from desfire_ev1.exceptions import AuthenticationError
+from mission.layout import detect_layout, migrate_card, MigrationBackup
+from mission.encoding import MissionDictionary
+from mission.digest import expected_digests
+from mission.index import MissionIndex
+from mission.sync import SyncClient, BackgroundSync, SYNC_INTERVAL
+from mission.staging import CardStager, StagingQueue, form_mission
+from mission.events import EventClient, EventFlusher, FLUSH_INTERVAL
+from station import CardStation, configure_station
+import logging
+import os
 
+log = logging.getLogger("main")
 
-class MainWindow(QMainWindow):
+
+class MainWindow(CardStation, QMainWindow):
+    # Emitted (from the sync thread) when a background sync changed the local store
+    store_synced = pyqtSignal()
+    # Emitted (from the staging worker) when a submitted form is ready to be written
+    card_staged = pyqtSignal()
+    # Emitted (from the staging worker) with the mission ID and error of a form that could not be staged
+    staging_failed = pyqtSignal(str, str)
+    
     def __init__(self):
+        # Logging, metrics endpoint and profiler, then the card station of the reader
+        configure_station()
         super().__init__()
         self.setWindowTitle("File Manager Interface")
         self.setGeometry(100, 100, 600, 600)
         
-        # Initialize app file card managers
-        self.desfireCardManager = DesfireCard() 
-        self.applicationManager = ApplicationManager(self.desfireCardManager)
-        self.fileManager = FileManager(self.desfireCardManager)
-        
-        # key numbers
-        self.key_number_zero = [0x00]
-        self.master_key_value = bytes([0x00] * 8)
-        
-        # application ids 
-        self.driver_app_id = [0x00, 0x00, 0x01]
-        self.driver_file_id = 0x01
-        self.driver_pic_file_id = 0x02
-        
-        # Mission related information
-        self.mission_app_id = [0x00, 0x00, 0x02]
-        self.mission_file_id = 0x01
-        self.mission_file_size = 57
-        
-        # Articles related information
-        self.article_app_id = [0x00, 0x00, 0x03]
-        self.article_file_id = 0x01
-        self.article_record_size = 8
-        self.article_number = 50
+        # Local copy of articles, trucks and missions: stations start from it at once and keep working
+        # offline; DESFIRE_API_URL=<url> keeps it in sync and receives the journaled events in the background
+        self.open_missions()
         
         # Load from database
         self.articles_from_db = self.load_articles_from_database()
         self.trucks_from_db = self.load_trucks_from_database()
         self.missions_from_db = self.load_missions_from_database()  # Add this
         
+        # Digest of each expected mission: a card carrying it is validated without reading its articles
+        self.expected_digests = expected_digests(self.missions_from_db, self.digest_key)
+        
         # Destination point (can be configured)
         self.destination_point = "djelfa"
+        # The ID of the mission being issued is kept until its card is done
+        self.id_allocator.top_up()
+        self.mission_id = None
+        self.issuing_form = None
+        # Contents of cards being migrated to layout v2/v3 (DESFIRE_MIGRATIONS=<dir>), kept until rewritten
+        self.migration_backup = MigrationBackup(os.environ.get("DESFIRE_MIGRATIONS", "migrations"))
+        # UID of the last card issued, so one card never receives two staged missions
+        self.issued_uid = None
 
         # Create central widget with stacked layout
         central_widget = QWidget()
@@ -68,13 +77,27 @@ class MainWindow(QMainWindow):
         self.source_interface = SourceInterface(self.articles_from_db, self.trucks_from_db)
         self.source_interface.back_clicked.connect(self.show_base_interface)
         self.source_interface.form_submitted.connect(self.handle_form_data)
+        self.source_interface.write_card_btn.clicked.connect(self.issue_staged)
+        
+        # Submitted forms are staged (photo compressed, every file packed and checked) in a worker;
+        # the card on the reader then only receives the bytes
+        stager = CardStager(self.storage_plans, self.mission_dictionary, self.digest_key,
+                            compress=self.source_interface.image_processor.usable_compress,
+                            driver_size=self.driver_file_size)
+        self.staging = StagingQueue(stager, on_ready=lambda staged: self.card_staged.emit(),
+                                    on_error=lambda mission_id, error: self.staging_failed.emit(mission_id, str(error)))
+        self.card_staged.connect(self.on_card_staged)
+        self.staging_failed.connect(self.source_interface.show_staging_error)
         
         # Create destination interface
         self.destination_interface = DestinationInterface(
             destination_point=self.destination_point,
             expected_missions=self.missions_from_db,
             card_manager=self.desfireCardManager,
-            file_manager=self.fileManager
+            file_manager=self.fileManager,
+            authenticate_app=self.select_and_authenticate,
+            card_layout=self.card_layout,
+            comm_mode=self.comm_mode
         )
         self.destination_interface.back_clicked.connect(self.show_base_interface)
         self.destination_interface.read_card_btn.clicked.connect(self.on_read_card_at_destination)
@@ -85,35 +108,44 @@ class MainWindow(QMainWindow):
         self.stacked_widget.addWidget(self.source_interface)  # Index 1
         self.stacked_widget.addWidget(self.destination_interface)  # Index 2
         
+        # Background delta sync with the mission API
+        self.mission_sync = None
+        if self.api_url:
+            self.store_synced.connect(self.on_store_synced)
+            interval = float(os.environ.get("DESFIRE_SYNC_INTERVAL", SYNC_INTERVAL))
+            self.mission_sync = BackgroundSync(self.store, SyncClient(self.api_url), interval,
+                                               on_change=self.store_synced.emit).start()
+        self.event_flusher = None
+        if self.api_url:
+            interval = float(os.environ.get("DESFIRE_FLUSH_INTERVAL", FLUSH_INTERVAL))
+            self.event_flusher = EventFlusher(self.delivery_journal, EventClient(self.api_url), interval).start()
+        
     def load_articles_from_database(self):
-        """Load articles from your database"""
-        # TODO: Replace with actual API call
-        return [
-            {"id": 1, "content": "AR01", "source": "Oran", "destination": "Chlef", "site_id": 1, "tag": 1, "site_type": 9},
-            {"id": 2, "content": "AR02", "source": "Oran", "destination": "Chlef", "site_id": 1, "tag": 1, "site_type": 9},
-            {"id": 3, "content": "AR03", "source": "Oran", "destination": "Chlef", "site_id": 1, "tag": 1, "site_type": 9},
-            {"id": 4, "content": "AR04", "source": "Oran", "destination": "Chlef", "site_id": 1, "tag": 1, "site_type": 9},
-        ]
+        """Load articles from the local store"""
+        return self.store.articles()
         
     def load_trucks_from_database(self):
-        """Load trucks from your database"""
-        # TODO: Replace with actual API call
-        return [
-            {"id": 1, "model": "MR01", "license_plate": "TRCK1317", "available": "Free"},
-            {"id": 2, "model": "MR02", "license_plate": "TRCK1317", "available": "Free"},
-            {"id": 3, "model": "MR03", "license_plate": "TRCK1317", "available": "Free"},
-            {"id": 4, "model": "MR04", "license_plate": "TRCK1317", "available": "Free"},
-        ]
+        """Load trucks from the local store"""
+        return self.store.trucks()
         
     def load_missions_from_database(self):
-        """Load expected missions from database"""
-        # TODO: Replace with actual API call
-        return [
-            {"mission_id": "MSN00001", "truck_id": "TRK00123", "source": "Oran", "destination": "djelfa", "status": "In Transit"},
-            {"mission_id": "MSN00002", "truck_id": "TRK00456", "source": "Chlef", "destination": "djelfa", "status": "In Transit"},
-            {"mission_id": "MSN00003", "truck_id": "TRK00789", "source": "Biskra", "destination": "djelfa", "status": "In Transit"},
-            {"mission_id": "MSN00004", "truck_id": "TRK00999", "source": "Medya", "destination": "djelfa", "status": "In Transit"},
-        ]
+        """Load expected missions (with their article manifests) from the local store"""
+        return [m for m in self.store.missions() if m['status'] != "Delivered"]
+        
+    def on_store_synced(self):
+        """Show what the last background sync brought in"""
+        self.articles_from_db = self.load_articles_from_database()
+        self.trucks_from_db = self.load_trucks_from_database()
+        self.missions_from_db = self.load_missions_from_database()
+        # Dictionary entries the API appended for new names; cards staged from now on use them
+        self.mission_dictionary = MissionDictionary(self.store.dictionary())
+        self.staging.stager.dictionary = self.mission_dictionary
+        self.expected_digests = expected_digests(self.missions_from_db, self.digest_key)
+        self.source_interface.set_articles_database(self.articles_from_db)
+        self.source_interface.set_trucks_database(self.trucks_from_db)
+        self.destination_interface.set_expected_missions(self.missions_from_db)
+        log.info("Store synced: %d articles, %d trucks, %d missions", len(self.articles_from_db),
+                 len(self.trucks_from_db), len(self.missions_from_db))
         
     def create_base_interface(self):
         """Create the original base interface"""
@@ -135,6 +167,18 @@ class MainWindow(QMainWindow):
         self.format_card_btn = QPushButton("Format Card")
         second_line_layout.addWidget(self.format_card_btn)
         
+        # Roll cards from the static key onto diversified keys
+        if self.key_provider is not self.static_keys:
+            self.roll_keys_btn = QPushButton("Roll Card Keys")
+            self.roll_keys_btn.clicked.connect(self.on_roll_keys_clicked)
+            second_line_layout.addWidget(self.roll_keys_btn)
+        
+        # Move cards in circulation onto the single-application layout
+        if self.issue_layout.version >= 2 and not self.issue_layout.compact:
+            self.migrate_btn = QPushButton("Migrate Card Layout")
+            self.migrate_btn.clicked.connect(self.on_migrate_card_clicked)
+            second_line_layout.addWidget(self.migrate_btn)
+        
         # Add both lines to main layout
         main_layout.addLayout(first_line_layout)
         main_layout.addLayout(second_line_layout)
@@ -148,12 +192,12 @@ class MainWindow(QMainWindow):
         
     def on_source_clicked(self):
         """Switch to source interface"""
-        print("Source button clicked - switching to source interface")
+        log.debug("Source button clicked - switching to source interface")
         self.stacked_widget.setCurrentIndex(1)
         
     def on_destination_clicked(self):
         """Switch to destination interface"""
-        print("Destination button clicked - switching to destination interface")
+        log.debug("Destination button clicked - switching to destination interface")
         # Reset destination interface before showing
         self.destination_interface.reset_interface()
         # Refresh missions before showing
@@ -162,16 +206,55 @@ class MainWindow(QMainWindow):
         
     def on_format_card_clicked(self):
         """Format the card"""
-        print("Format Card button clicked")
-        master_app_id = [0x00, 0x00, 0x00]
-        self.desfireCardManager.select_application(master_app_id)
-        self.desfireCardManager.authenticate(self.key_number_zero, self.master_key_value)
+        log.debug("Format Card button clicked")
+        self.authenticate_master()
         self.desfireCardManager.format_card()
-        print("Format is done")
+        uid = self.desfireCardManager.get_uid()
+        self.card_writer.shadow.forget(uid)
+        self.inventory.invalidate(uid)
+        log.info("Format is done")
+        
+    def on_roll_keys_clicked(self):
+        """Change the key 0 of every mission application and the card master key to their diversified values"""
+        aids = detect_layout(self.desfireCardManager).applications()
+        try:
+            changed = roll_to_diversified(self.desfireCardManager, self.key_provider, aids, self.static_keys)
+            master = roll_master_to_diversified(self.desfireCardManager, self.key_provider, self.master_key_value)
+        except (ValueError, AuthenticationError) as e:
+            log.error("Cannot roll the card keys: %s", e)
+            return
+        log.info("Rolled %d application keys%s", len(changed), " and the card master key" if master else "")
+        
+    def on_migrate_card_clicked(self):
+        """Rewrite a card in the three-application layout in the issuing layout (v2 or v3)"""
+        self.card_uid = None
+        uid = self.current_uid()
+        sizes = {"driver": self.driver_file_size, "photo": self.driver_pic_file_size, "mission": self.mission_file_size}
+        try:
+            migrated = migrate_card(self.desfireCardManager, self.fileManager, self.provisioner,
+                                    self.select_and_authenticate, self.authenticate_master, self.migration_backup,
+                                    sizes, self.article_record_size, self.article_number,
+                                    num_keys=0x01 | self.app_key_flags(), comm_mode=self.comm_mode,
+                                    records_comm_mode=self.records_comm_mode(), target=self.issue_layout)
+        except Exception as e:
+            if uid is not None and self.migration_backup.load(uid) is not None:
+                # The card may be formatted already: migrating it again rewrites it from the saved contents
+                log.error("Migration failed: %s. The card contents are saved in %s: present the same card "
+                          "and migrate it again", e, self.migration_backup.path)
+            else:
+                log.error("Migration failed: %s", e)
+            return
+        finally:
+            self.card_writer.shadow.forget(uid)
+            self.inventory.invalidate(uid)
+        if migrated:
+            log.info("Card migrated to layout v%d", self.issue_layout.version)
+        else:
+            log.info("Card does not use layout v1: nothing to migrate")
         
     def show_base_interface(self):
         """Return to base interface"""
-        print("Returning to base interface")
+        log.debug("Returning to base interface")
             # Reset destination interface when leaving
         if hasattr(self, 'destination_interface'):
             self.destination_interface.reset_interface()
@@ -179,224 +262,144 @@ class MainWindow(QMainWindow):
         
     def on_read_card_at_destination(self):
         """Read card and validate at destination checkpoint"""
-        try:
-            print("Reading card at destination...")
+        with self.session("on_read_card_at_destination", "destination"):
+            self.card_uid = None
+            try:
+                log.debug("Reading card at destination...")
+                self.apply_layout(detect_layout(self.desfireCardManager))
             
-            # Read mission data
-            self.desfireCardManager.select_application(self.mission_app_id)
-            self.desfireCardManager.authenticate(self.key_number_zero, self.master_key_value)
-            mission_data = self.read_mission()
+                # Read mission data
+                self.select_and_authenticate(self.mission_app_id)
+                mission_data = self.read_mission()
+                expected = self.verified_mission(mission_data['mission_id'])
             
-            # Read driver data
-            self.desfireCardManager.select_application(self.driver_app_id)
-            self.desfireCardManager.authenticate(self.key_number_zero, self.master_key_value)
-            driver_data = self.read_driver_info()
+                # Read driver data
+                self.select_and_authenticate(self.driver_app_id)
+                driver_data = self.read_driver_info()
             
-            # Read driver photo
-            #photo_data, photo_meta = self.read_compressed_image()
-            #driver_data['photo_data'] = photo_data
-            #driver_data['photo_meta'] = photo_meta
+                # Read driver photo
+                #photo_data, photo_meta = self.read_compressed_image()
+                #driver_data['photo_data'] = photo_data
+                #driver_data['photo_meta'] = photo_meta
             
-            # Read articles
-            self.desfireCardManager.select_application(self.article_app_id)
-            self.desfireCardManager.authenticate(self.key_number_zero, self.master_key_value)
-            articles_data = self.read_all_articles()
+                if expected is not None:
+                    # The card carries the digest of this mission and manifest: no articles to read or decode
+                    articles_data = [dict(article) for article in expected['articles']]
+                else:
+                    # No digest, or a mismatch: read the articles and validate field by field
+                    self.select_and_authenticate(self.article_app_id)
+                    articles_data = self.read_all_articles()
             
-            # Combine all card data
-            card_data = {
-                'mission': mission_data,
-                'driver': driver_data,
-                'articles': articles_data
-            }
+                # Combine all card data
+                card_data = {
+                    'mission': mission_data,
+                    'driver': driver_data,
+                    'articles': articles_data
+                }
             
-            # Validate and display
-            self.destination_interface.validate_and_display_card(card_data)
+                # Validate and display
+                self.destination_interface.validate_and_display_card(card_data)
             
-        except Exception as e:
-            print(f"Error reading card: {e}")
-            self.destination_interface.status_label.setText(f"❌ Error reading card: {str(e)}")
-            self.destination_interface.status_label.setStyleSheet("padding: 10px; font-size: 12px; color: red;")
+            except Exception as e:
+                log.exception("Error reading card: %s", e)
+                if self.desfireCardManager.apdu_ring is not None:
+                    self.desfireCardManager.apdu_ring.log_dump()
+                self.destination_interface.status_label.setText(f"❌ Error reading card: {str(e)}")
+                self.destination_interface.status_label.setStyleSheet("padding: 10px; font-size: 12px; color: red;")
         
     def handle_delivery_action(self, action_data):
         """Handle delivery approval or rejection"""
         action = action_data['action']
         data = action_data['data']
         
-        print(f"Delivery {action}: {data['mission']['mission_id']}")
+        mission_id = data['mission']['mission_id']
+        log.info("Delivery %s: %s", action, mission_id)
         
         if action == 'approved':
-            # Update mission status to DELIVERED
-            self.desfireCardManager.select_application(self.mission_app_id)
-            self.desfireCardManager.authenticate(self.key_number_zero, self.master_key_value)
-            self.update_mission_status(2)  # 2 = DELIVERED
+            # Update mission status to DELIVERED; nothing is recorded unless the card has it
+            try:
+                written = self.select_and_authenticate(self.mission_app_id) and self.update_mission_status(2)
+            except Exception as e:
+                log.exception("Cannot update the card of mission %s: %s", mission_id, e)
+                written = False
+            if not written:
+                self.destination_interface.delivery_failed("The card could not be marked as DELIVERED")
+                return
             
-            # TODO: Update database
-            print("Mission marked as DELIVERED")
+            delivered = (mission_id, self.destination_point)
+            self.missions_from_db = [m for m in self.missions_from_db if MissionIndex.key(m) != delivered]
+            self.store.set_status(mission_id, "Delivered")
+            log.info("Mission marked as DELIVERED")
             
         elif action == 'rejected':
-            # TODO: Handle rejection logic
-            print("Mission rejected")
+            log.info("Mission rejected")
+        
+        # The backend learns about it from the event journal; the gate never waits on the network
+        self.delivery_journal.record(action, mission_id, self.destination_point,
+                                     truck_id=data['mission'].get('truck_id'))
+        if self.event_flusher is not None:
+            self.event_flusher.notify()
         
     def handle_form_data(self, data):
-        """Process submitted form data from source interface"""
-        self.applicationManager.create_application(self.driver_app_id)
-        self.applicationManager.create_application(self.mission_app_id)
-        self.applicationManager.create_application(self.article_app_id)
-
-        # Write driver info
-        self.desfireCardManager.select_application(self.driver_app_id)
-        self.fileManager.create_standard_file(self.driver_file_id, 20)
-        self.fileManager.create_standard_file(self.driver_pic_file_id, 1200)
-        self.desfireCardManager.authenticate(self.key_number_zero, self.master_key_value)
-        self.write_driver_infos(data['driver_name'], data['driver_license'])
-        self.write_compressed_image(data['image_vec'], data['image_metaData'])
-        print("Wrote Driver Info")
-
-        # Write mission info
-        self.desfireCardManager.select_application(self.mission_app_id)
-        self.fileManager.create_standard_file(self.mission_file_id, 57)
-        self.desfireCardManager.authenticate(self.key_number_zero, self.master_key_value)
-        truck_id = data['truck']['license_plate'] if data['truck'] else "UNKNOWN"
-        status = 0  # Pending
-        self.write_mission_information(truck_id, status, data['source'], data['destination'])
-        print(f"Wrote Mission info")
-        
-        # Write articles
-        self.desfireCardManager.select_application(self.article_app_id)
-        self.desfireCardManager.authenticate(self.key_number_zero, self.master_key_value)
-        self.fileManager.create_linear_record_file(self.article_file_id, self.article_record_size, self.article_number)
-        for article in data['articles']:
-            self.write_article(article['content'][:4].upper(), int(article['quantity']))
-
-        print("wrote articles infos")
-    # === Helper functions ===
+        """Stage submitted form data from source interface; the card is written once staged"""
+        truck_id, articles = form_mission(data)
+        try:
+            self.mission_id = self.issue_mission_id(data, truck_id, articles)
+        except (OSError, ValueError) as e:
+            log.error("No mission ID available: %s", e)
+            return
+        self.staging.submit(data, self.mission_id, self.issue_layout)
     
-    def write_driver_infos(self, driver_name, driver_license):
-        """Write driver information to card"""
-        data = driver_name + driver_license
-        byte_data = list(data.encode('utf-8'))
-        self.fileManager.write_data(self.driver_file_id, 0, byte_data)
-        
-    def read_driver_info(self):
-        """Read driver info from card"""
-        data = self.fileManager.read_data(self.driver_file_id, 0, 20)
-        info_str = bytes(data).decode('utf-8').strip()
-        # Assume format: first 10 chars = name, rest = license
-        name = info_str[:10].strip()
-        license = info_str[10:].strip()
-        return {'name': name, 'license': license}
-
-    def write_compressed_image(self, data, meta):
-        """Write compressed image to card"""
-        meta_json = json.dumps(meta).encode('utf-8')
-        meta_len = len(meta_json)
-        
-        meta_len_bytes = [meta_len & 0xFF, (meta_len >> 8) & 0xFF, (meta_len >> 16) & 0xFF, (meta_len >> 24) & 0xFF]
-        payload = meta_len_bytes + list(meta_json) + list(data)
-        
-        offset = 0
-        chunk_size = 47
-        while offset < len(payload):
-            end = min(offset + chunk_size, len(payload))
-            chunk = payload[offset:end]
-            self.fileManager.write_data(self.driver_pic_file_id, offset=offset, data=chunk)
-            offset += len(chunk)
-        
-        return offset
+    def on_card_staged(self):
+        """A staged card is ready: write it if a new card is on the reader"""
+        self.source_interface.set_staged_count(len(self.staging))
+        self.issue_staged()
     
-    def read_compressed_image(self):
-        """Read compressed image from card"""
-        header = self.fileManager.read_data(self.driver_pic_file_id, offset=0, length=4)
-        meta_len = header[0] | (header[1] << 8) | (header[2] << 16) | (header[3] << 24)
-        
-        meta_bytes = self.fileManager.read_data(self.driver_pic_file_id, offset=4, length=meta_len)
-        meta = json.loads(bytes(meta_bytes).decode('utf-8'))
-        
-        data_offset = 4 + meta_len
-        data_length = 994
-        data = self.fileManager.read_data(self.driver_pic_file_id, offset=data_offset, length=data_length)
-        
-        return bytes(data), meta
-
-    def write_mission_information(self, truck_id, status, source, destination):
-        """Write mission info to card"""
-        mission_id = "MSN00001"  # TODO: Get from API
-        
-        mission_data = list(mission_id.ljust(8, ' ').encode('utf-8')[:8])
-        truck_data = list(truck_id.ljust(8, ' ').encode('utf-8')[:8])
-        source_data = list(source.ljust(20, ' ').encode('utf-8')[:20])
-        destination_data = list(destination.ljust(20, ' ').encode('utf-8')[:20])
-        
-        complete_data = mission_data + truck_data + [status] + source_data + destination_data
-        
-        print(f"Complete data length: {len(complete_data)} bytes")
-        
-        # Split into two chunks: first 47 bytes, then remaining
-        chunk1 = complete_data[:47]  # Bytes 0-46 (47 bytes)
-        chunk2 = complete_data[47:]  # Bytes 47-56 (10 bytes)
+    def issue_staged(self):
+        """Write the oldest staged card to the card on the reader"""
+        staged = self.staging.peek()
+        if staged is None:
+            return
         
-        print(f"Chunk 1 (47 bytes): {chunk1}")
-        print(f"Chunk 2 ({len(chunk2)} bytes): {chunk2}")
-        
-        # Write first chunk at offset 0
-        self.fileManager.write_data(self.mission_file_id, offset=0, data=chunk1)
-        print(f"Written chunk 1: 47 bytes at offset 0")
-        
-        # Write second chunk at offset 47
-        self.fileManager.write_data(self.mission_file_id, offset=47, data=chunk2)
-        print(f"Written chunk 2: {len(chunk2)} bytes at offset 47")
-        
-        print(f"Mission written: {mission_id}")
-        return mission_id
-
-    def update_mission_status(self, new_status):
-        """Update mission status"""
-        self.fileManager.write_data(self.mission_file_id, 16, [new_status])
-        print(f"Status updated to: {new_status}")
-
-    def read_mission(self):
-        """Read mission data from card"""
-        data = self.fileManager.read_data(self.mission_file_id, 0, self.mission_file_size)
-        
-        mission_id = bytes(data[0:8]).decode('utf-8').strip()
-        truck_id = bytes(data[8:16]).decode('utf-8').strip()
-        status = data[16]
-        source = bytes(data[17:37]).decode('utf-8').strip()
-        destination = bytes(data[37:57]).decode('utf-8').strip()
-        
-        status_names = {0: "Pending", 1: "In Transit", 2: "Delivered"}
-        
-        return {
-            'mission_id': mission_id,
-            'truck_id': truck_id,
-            'status': status_names.get(status, 'Unknown'),
-            'source': source,
-            'destination': destination
-        }
+        self.card_uid = None
+        try:
+            uid = self.current_uid()
+        except Exception as e:
+            log.info("Mission %s is staged, no card on the reader: %s", staged.mission_id, e)
+            return
+        if uid is None:
+            log.info("Mission %s is staged, no card on the reader", staged.mission_id)
+            return
+        if uid == self.issued_uid:
+            log.info("Mission %s is staged: present the next card", staged.mission_id)
+            return
+        if not self.issue_card(uid, staged):
+            return
+        self.staging.done(staged)
+        if self.event_flusher is not None:
+            self.event_flusher.notify()
+        self.issued_uid = uid
+        if staged.mission_id == self.mission_id:
+            self.issuing_form = None
+        self.source_interface.set_staged_count(len(self.staging))
+        log.info("Wrote card for mission %s with %s articles", staged.mission_id, len(staged.articles))
+    
+    # === Helper functions ===
     
-    def write_article(self, code, quantity):
-        """Write article record"""
-        from desfire_ev1.utils import to_4bytes
-        code_data = list(code.ljust(4, ' ').encode('utf-8')[:4])
-        quantity_data = to_4bytes(quantity)
-        record_data = code_data + quantity_data
-        self.fileManager.write_record(self.article_file_id, 0, record_data)
-        self.fileManager.commit_transaction()
-        
-    def read_all_articles(self):
-        """Read all articles from card"""
-        from desfire_ev1.utils import from_4bytes
-        data = self.fileManager.read_records(self.article_file_id, 0, 0)
-        
-        articles = []
-        for i in range(0, len(data), self.article_record_size):
-            if i + self.article_record_size <= len(data):
-                record = data[i:i+self.article_record_size]
-                code = bytes(record[0:4]).decode('utf-8').strip()
-                quantity = from_4bytes(record[4:8])
-                articles.append({'code': code, 'quantity': quantity})
-        
-        return articles
+    def issue_mission_id(self, data, truck_id, articles):
+        """Mission ID for a submitted form: a new one, or the same while that form is retried"""
+        form = (data['driver_name'], data['driver_license'], truck_id, data['source'], data['destination'],
+                tuple(articles))
+        if self.issuing_form != form:
+            self.issuing_form = form
+            self.mission_id = self.id_allocator.next_id()
+        return self.mission_id
+    
+    def apply_layout(self, layout):
+        """Point the IDs at a card layout, the destination interface included"""
+        super().apply_layout(layout)
+        if hasattr(self, 'destination_interface'):
+            self.destination_interface.card_layout = layout
 
 
 # Run the application
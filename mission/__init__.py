@@ -0,0 +1,18 @@
+from mission.layout import (CardLayout, LAYOUT_V1, LAYOUT_V2, LAYOUT_V2_COMPACT, LAYOUT_V3, LAYOUT_V3_COMPACT,
+                            detect_layout, migrate_card, MigrationBackup)
+from mission.encoding import MissionDictionary, encode_mission, decode_mission
+from mission.digest import canonical_mission, mission_digest, expected_digests
+from mission.index import MissionIndex
+from mission.catalog import ArticleIndex
+from mission.store import MissionStore
+from mission.sync import SyncClient, BackgroundSync
+from mission.events import DeliveryJournal, EventClient, EventFlusher
+from mission.ids import MissionIdAllocator, LocalIdSource, HttpIdSource
+from mission.staging import CardStager, StagingQueue, StagedCard
+
+__all__ = ['CardLayout', 'LAYOUT_V1', 'LAYOUT_V2', 'LAYOUT_V2_COMPACT', 'LAYOUT_V3', 'LAYOUT_V3_COMPACT',
+           'detect_layout', 'migrate_card', 'MigrationBackup', 'MissionDictionary',
+           'encode_mission', 'decode_mission', 'canonical_mission', 'mission_digest', 'expected_digests',
+           'MissionIndex', 'ArticleIndex', 'MissionStore', 'SyncClient', 'BackgroundSync', 'DeliveryJournal',
+           'EventClient', 'EventFlusher', 'MissionIdAllocator', 'LocalIdSource', 'HttpIdSource', 'CardStager',
+           'StagingQueue', 'StagedCard']
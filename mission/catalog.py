@@ -0,0 +1,88 @@
+from bisect import bisect_left
+import heapq
+import logging
+
+log = logging.getLogger(__name__)
+
+# Matches returned per search
+SEARCH_LIMIT = 20
+
+# Length of the substrings indexed for infix search
+GRAM = 3
+
+
+def trigrams(text):
+    return {text[i:i + GRAM] for i in range(len(text) - GRAM + 1)}
+
+
+class ArticleIndex:
+    def __init__(self, articles=()):
+        """Search index over the article catalog (content and ID).
+
+        Contents are kept sorted (lowercase) for prefix search by bisection,
+        and every content and ID is split in trigrams, each mapping to the
+        articles that contain it; an infix query intersects the sets of its
+        trigrams. A keystroke therefore costs a few set operations on the
+        candidates instead of a scan of the whole catalog.
+        """
+        self._by_content = {}
+        self._by_id = {}
+        self._grams = {}  # trigram -> contents
+        for article in articles:
+            self._by_content[article['content']] = article
+            if article.get('id') is not None:
+                self._by_id[str(article['id'])] = article
+        self._sorted = sorted((content.lower(), content) for content in self._by_content)  # (lowercase, content)
+        for lower, content in self._sorted:
+            for gram in trigrams(lower):
+                self._grams.setdefault(gram, set()).add(content)
+        for article_id, article in self._by_id.items():
+            for gram in trigrams(article_id.lower()):
+                self._grams.setdefault(gram, set()).add(article['content'])
+        log.debug("Indexed %d articles (%d trigrams)", len(self._by_content), len(self._grams))
+
+    def get(self, content):
+        return self._by_content.get(content)
+
+    def by_id(self, article_id):
+        return self._by_id.get(str(article_id))
+
+    def search(self, text, limit=SEARCH_LIMIT):
+        """Contents matching `text`: the article with that ID, then prefix matches, then infix matches"""
+        query = text.strip().lower()
+        if not query:
+            return []
+        matches = []
+        seen = set()
+
+        def take(content):
+            if content not in seen:
+                seen.add(content)
+                matches.append(content)
+            return len(matches) >= limit
+
+        article = self._by_id.get(query)
+        if article is not None and take(article['content']):
+            return matches
+        start = bisect_left(self._sorted, (query,))
+        for lower, content in self._sorted[start:start + limit]:
+            if not lower.startswith(query) or take(content):
+                break
+        if len(matches) >= limit or len(query) < GRAM:
+            return matches
+        grams = sorted((self._grams.get(gram, set()) for gram in trigrams(query)), key=len)
+        candidates = set.intersection(*grams) if grams[0] else set()
+        found = (content for content in candidates if content not in seen and
+                 (query in content.lower() or query in str(self._by_content[content].get('id', '')).lower()))
+        for content in heapq.nsmallest(limit - len(matches), found, key=str.lower):
+            take(content)
+        return matches
+
+    def __contains__(self, content):
+        return content in self._by_content
+
+    def __len__(self):
+        return len(self._by_content)
+
+    def __iter__(self):
+        return iter(self._by_content.values())
@@ -0,0 +1,68 @@
+import hashlib
+import hmac
+import logging
+
+from mission.encoding import write_varint
+
+log = logging.getLogger(__name__)
+
+# BLAKE2b-128: short enough for one small file, far beyond accidental collisions
+DIGEST_SIZE = 16
+
+# Version of the canonical serialization, hashed along with it
+CANONICAL_VERSION = 1
+
+# Shortest key whose digests are trusted in place of the articles: without a key anyone can compute them
+MIN_KEY_SIZE = 16
+
+# BLAKE2b personalization, so these digests never collide with other uses of the key
+DIGEST_PERSON = b"mission-card"
+
+
+def _write_text(buf, text):
+    raw = text.encode('utf-8')
+    write_varint(buf, len(raw))
+    buf.extend(raw)
+
+
+def canonical_mission(mission_id, truck_id, source, destination, articles):
+    """Canonical bytes of a mission and its manifest.
+
+    Fields go in a fixed order as length-prefixed UTF-8, then the article
+    count and the articles sorted by (code, quantity), so the same mission
+    always serializes the same way whatever order the articles were
+    entered in. The status is left out: it changes on delivery.
+    `articles` is a list of (code, quantity).
+    """
+    buf = bytearray([CANONICAL_VERSION])
+    for text in (mission_id, truck_id, source, destination):
+        _write_text(buf, text)
+    articles = sorted((code, int(quantity)) for code, quantity in articles)
+    write_varint(buf, len(articles))
+    for code, quantity in articles:
+        _write_text(buf, code)
+        write_varint(buf, quantity)
+    return bytes(buf)
+
+
+def mission_digest(mission_id, truck_id, source, destination, articles, key=b""):
+    """Keyed BLAKE2b digest of the canonical mission"""
+    data = canonical_mission(mission_id, truck_id, source, destination, articles)
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE, key=key, person=DIGEST_PERSON).digest()
+
+
+def record_digest(record, key=b""):
+    """Digest of a database mission record with its 'articles' manifest of {'code', 'quantity'}"""
+    articles = [(article['code'], article['quantity']) for article in record.get('articles', ())]
+    return mission_digest(record['mission_id'], record['truck_id'], record['source'], record['destination'],
+                          articles, key)
+
+
+def expected_digests(records, key=b""):
+    """{mission_id: (digest, record)} for the missions a station expects"""
+    return {record['mission_id']: (record_digest(record, key), record) for record in records}
+
+
+def digests_match(card_digest, expected):
+    """Constant-time comparison of a digest read from a card"""
+    return len(card_digest) == DIGEST_SIZE and hmac.compare_digest(bytes(card_digest), bytes(expected))
@@ -0,0 +1,210 @@
+import hashlib
+import logging
+
+log = logging.getLogger(__name__)
+
+# Format byte at the start of a compact mission
+COMPACT_FORMAT = 2
+
+# Offset of the status byte inside a compact mission (after the format byte)
+COMPACT_STATUS_OFFSET = 1
+
+# Bytes of the dictionary tag stored with every compact mission
+DICTIONARY_TAG_SIZE = 4
+
+KINDS = ('location', 'truck', 'article')
+
+
+def write_varint(buf, value):
+    """Append an unsigned LEB128 varint to a bytearray"""
+    if value < 0:
+        raise ValueError("Varints are unsigned")
+    while value > 0x7F:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def read_varint(data, pos):
+    """Decode a varint at `pos`; returns (value, next position)"""
+    value = shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+class MissionDictionary:
+    def __init__(self, entries=()):
+        """Name <-> ID tables shared by source and destination stations.
+
+        `entries` are (kind, name, id) in the order the authority (the
+        mission API, or a station running without one) appended them; the
+        list only grows and an ID never changes. A card records how many
+        entries it was encoded with and a tag hashed from them, so a
+        reader decodes it with exactly that prefix, or refuses it.
+        """
+        self.entries = list(entries)
+        self.tag = dictionary_tag(self.entries)
+        self.ids = {kind: {} for kind in KINDS}
+        for kind, name, value_id in self.entries:
+            self.ids[kind][name] = value_id
+        self.names = {kind: {i: name for name, i in ids.items()} for kind, ids in self.ids.items()}
+        self._prefixes = {}
+
+    def prefix(self, count):
+        """Dictionary of the first `count` entries"""
+        if count == len(self.entries):
+            return self
+        if count not in self._prefixes:
+            self._prefixes[count] = MissionDictionary(self.entries[:count])
+        return self._prefixes[count]
+
+    def encode_value(self, buf, table, name):
+        """Dictionary ID as varint(id << 1), or a literal as varint(len << 1 | 1) + UTF-8"""
+        value_id = self.ids[table].get(name)
+        if value_id is not None:
+            write_varint(buf, value_id << 1)
+            return
+        raw = name.encode('utf-8')
+        write_varint(buf, (len(raw) << 1) | 1)
+        buf.extend(raw)
+
+    def decode_value(self, data, pos, table):
+        tagged, pos = read_varint(data, pos)
+        if tagged & 1:
+            end = pos + (tagged >> 1)
+            if end > len(data):
+                raise ValueError("Truncated literal")
+            return bytes(data[pos:end]).decode('utf-8'), end
+        name = self.names[table].get(tagged >> 1)
+        if name is None:
+            raise ValueError(f"Unknown {table} ID {tagged >> 1} in the first {len(self.entries)} dictionary entries")
+        return name, pos
+
+
+def dictionary_tag(entries):
+    """Content hash of dictionary entries, checked before a card is decoded with them"""
+    canonical = "\n".join(f"{kind}\t{name}\t{value_id}" for kind, name, value_id in entries).encode('utf-8')
+    return hashlib.blake2b(canonical, digest_size=DICTIONARY_TAG_SIZE).digest()
+
+
+def dictionary_additions(entries, articles=(), trucks=(), missions=()):
+    """Entries to append to `entries` for the names of these rows.
+
+    Only the dictionary authority calls this. Articles and trucks take
+    their database ID unless another name of the same kind already holds
+    it (they then stay literals); locations take the next free ID. New
+    names are added in sorted order.
+    """
+    names = {(kind, name) for kind, name, _ in entries}
+    ids = {(kind, value_id) for kind, _, value_id in entries}
+    candidates = sorted(('article', row['content'], row['id']) for row in articles if row.get('content'))
+    candidates += sorted(('truck', row['license_plate'], row['id']) for row in trucks if row.get('license_plate'))
+    locations = {row[key] for row in list(articles) + list(missions)
+                 for key in ('source', 'destination') if row.get(key)}
+    candidates += [('location', name, None) for name in sorted(locations)]
+
+    next_location = max((value_id for kind, value_id in ids if kind == 'location'), default=0) + 1
+    added = []
+    for kind, name, value_id in candidates:
+        if (kind, name) in names:
+            continue
+        if value_id is None:
+            value_id, next_location = next_location, next_location + 1
+        elif (kind, value_id) in ids:
+            log.info("Dictionary %s ID %d is taken, %r stays a literal", kind, value_id, name)
+            continue
+        names.add((kind, name))
+        ids.add((kind, value_id))
+        added.append((kind, name, value_id))
+    return added
+
+
+def encode_mission(dictionary, mission_id, truck_id, status, source, destination, articles):
+    """Compact mission bytes.
+
+    Layout: format, status (fixed offset, so it can be updated in place),
+    the number of dictionary entries used and their tag, then mission ID, truck, source and destination as
+    dictionary values, then the article count and one entry per article.
+    Known articles are sorted by ID and stored as varint deltas; unknown
+    ones follow as literals. `articles` is a list of (code, quantity).
+    """
+    buf = bytearray([COMPACT_FORMAT, status])
+    write_varint(buf, len(dictionary.entries))
+    buf.extend(dictionary.tag)
+    raw = mission_id.encode('utf-8')
+    write_varint(buf, len(raw))
+    buf.extend(raw)
+    dictionary.encode_value(buf, 'truck', truck_id)
+    dictionary.encode_value(buf, 'location', source)
+    dictionary.encode_value(buf, 'location', destination)
+
+    article_ids = dictionary.ids['article']
+    known = sorted((article_ids[code], quantity) for code, quantity in articles if code in article_ids)
+    literal = [(code, quantity) for code, quantity in articles if code not in article_ids]
+    write_varint(buf, len(known))
+    previous = 0
+    for article_id, quantity in known:
+        write_varint(buf, article_id - previous)
+        write_varint(buf, quantity)
+        previous = article_id
+    write_varint(buf, len(literal))
+    for code, quantity in literal:
+        raw = code.encode('utf-8')
+        write_varint(buf, len(raw))
+        buf.extend(raw)
+        write_varint(buf, quantity)
+    return bytes(buf)
+
+
+def decode_mission(data, dictionary):
+    """Decode compact mission bytes with the prefix of `dictionary` they were encoded with.
+
+    Returns a mission dict (mission_id, truck_id, status, source,
+    destination) and a list of {'code', 'quantity'} articles. Raises
+    ValueError when this station lacks the entries or their tag differs.
+    """
+    if len(data) < 2 or data[0] != COMPACT_FORMAT:
+        raise ValueError("Not a compact mission")
+    count, pos = read_varint(data, 2)
+    tag = bytes(data[pos:pos + DICTIONARY_TAG_SIZE])
+    pos += DICTIONARY_TAG_SIZE
+    if count > len(dictionary.entries):
+        raise ValueError(f"Card uses {count} dictionary entries, this station has {len(dictionary.entries)}: "
+                         "sync it first")
+    dictionary = dictionary.prefix(count)
+    if tag != dictionary.tag:
+        raise ValueError(f"Dictionary of the card does not match this station's first {count} entries")
+    length, pos = read_varint(data, pos)
+    mission = {'mission_id': bytes(data[pos:pos + length]).decode('utf-8'), 'status': data[1]}
+    pos += length
+    mission['truck_id'], pos = dictionary.decode_value(data, pos, 'truck')
+    mission['source'], pos = dictionary.decode_value(data, pos, 'location')
+    mission['destination'], pos = dictionary.decode_value(data, pos, 'location')
+
+    articles = []
+    count, pos = read_varint(data, pos)
+    article_id = 0
+    for _ in range(count):
+        delta, pos = read_varint(data, pos)
+        quantity, pos = read_varint(data, pos)
+        article_id += delta
+        code = dictionary.names['article'].get(article_id)
+        if code is None:
+            raise ValueError(f"Unknown article ID {article_id} "
+                             f"in the first {len(dictionary.entries)} dictionary entries")
+        articles.append({'code': code, 'quantity': quantity})
+    count, pos = read_varint(data, pos)
+    for _ in range(count):
+        length, pos = read_varint(data, pos)
+        code = bytes(data[pos:pos + length]).decode('utf-8')
+        pos += length
+        quantity, pos = read_varint(data, pos)
+        articles.append({'code': code, 'quantity': quantity})
+    return mission, articles
@@ -0,0 +1,187 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import urllib.request
+import uuid
+
+log = logging.getLogger(__name__)
+
+# Events sent upstream per request
+FLUSH_BATCH = 100
+
+# Seconds between two flushes while the backend keeps up
+FLUSH_INTERVAL = 2
+
+# Longest wait between two attempts while the backend is down
+MAX_BACKOFF = 60
+
+# HTTP timeout of one flush request
+FLUSH_TIMEOUT = 10
+
+# Seconds an event acknowledged upstream is kept before it is purged
+KEEP_SENT = 7 * 24 * 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS delivery_events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    event_id TEXT NOT NULL UNIQUE,
+    mission_id TEXT NOT NULL,
+    destination TEXT,
+    action TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    details TEXT,
+    sent REAL
+);
+CREATE INDEX IF NOT EXISTS delivery_events_pending ON delivery_events (sent, seq);
+"""
+
+
+class DeliveryJournal:
+    def __init__(self, path=":memory:"):
+        """Durable local journal of mission events (issued cards, approvals, rejections).
+
+        `record()` is one small SQLite insert (WAL mode, so it does not wait
+        on readers; synchronous FULL, so an event survives a power cut),
+        which is all the gate does per tap. An `EventFlusher`
+        sends the pending events upstream in batches and marks them sent.
+        Every event carries a random `event_id` the backend uses as an
+        idempotency key, so a batch re-sent after a timeout is harmless.
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode = WAL")
+            self._conn.execute("PRAGMA synchronous = FULL")
+            self._conn.executescript(SCHEMA)
+
+    def record(self, action, mission_id, destination=None, timestamp=None, **details):
+        """Append an event; returns its event_id"""
+        event_id = uuid.uuid4().hex
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO delivery_events (event_id, mission_id, destination, action, timestamp, details) "
+                               "VALUES (?, ?, ?, ?, ?, ?)",
+                               (event_id, mission_id, destination, action,
+                                time.time() if timestamp is None else timestamp,
+                                json.dumps(details) if details else None))
+        return event_id
+
+    def pending(self, limit=FLUSH_BATCH):
+        """Oldest events not acknowledged upstream yet"""
+        with self._lock:
+            rows = self._conn.execute("SELECT event_id, mission_id, destination, action, timestamp, details "
+                                      "FROM delivery_events WHERE sent IS NULL ORDER BY seq LIMIT ?", (limit,)).fetchall()
+        events = []
+        for row in rows:
+            event = dict(row)
+            event['details'] = json.loads(event['details']) if event['details'] else {}
+            events.append(event)
+        return events
+
+    def pending_count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM delivery_events WHERE sent IS NULL").fetchone()[0]
+
+    def mark_sent(self, event_ids):
+        with self._lock, self._conn:
+            self._conn.executemany("UPDATE delivery_events SET sent = ? WHERE event_id = ?",
+                                   [(time.time(), event_id) for event_id in event_ids])
+
+    def purge(self, older_than):
+        """Forget events acknowledged before `older_than` (a timestamp)"""
+        with self._lock, self._conn:
+            return self._conn.execute("DELETE FROM delivery_events WHERE sent IS NOT NULL AND sent < ?",
+                                      (older_than,)).rowcount
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class EventClient:
+    def __init__(self, base_url, timeout=FLUSH_TIMEOUT):
+        """POST <base_url>/events {"events": [...]} answers {"accepted": [event_id, ...]}"""
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def send(self, events):
+        """Send a batch; returns the event_ids the backend has (now or from an earlier attempt)"""
+        body = json.dumps({'events': events}).encode('utf-8')
+        request = urllib.request.Request(f"{self.base_url}/events", data=body, method='POST',
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read().decode('utf-8')).get('accepted', [])
+
+
+class EventFlusher:
+    def __init__(self, journal, client, interval=FLUSH_INTERVAL, batch_size=FLUSH_BATCH, max_backoff=MAX_BACKOFF,
+                 keep_sent=KEEP_SENT):
+        """Sends the journal's pending events upstream from a daemon thread.
+
+        Each round drains the journal batch by batch. When a batch fails the
+        events stay pending and the wait doubles, up to `max_backoff`; the
+        first batch that goes through resets it. Events acknowledged more
+        than `keep_sent` seconds ago are purged after a round that sent some.
+        """
+        self.journal = journal
+        self.client = client
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self.keep_sent = keep_sent
+        self.last_error = None
+        self._delay = interval
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="delivery-events", daemon=True)
+            self._thread.start()
+        return self
+
+    def notify(self):
+        """An event was recorded: flush without waiting for the interval (unless backing off)"""
+        if self.last_error is None:
+            self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def flush(self):
+        """Send everything pending; returns the number of events acknowledged"""
+        sent = 0
+        while True:
+            events = self.journal.pending(self.batch_size)
+            if not events:
+                return sent
+            accepted = self.client.send(events)
+            self.journal.mark_sent(accepted)
+            sent += len(accepted)
+            if len(accepted) < len(events):
+                log.warning("Backend accepted %d of %d delivery events", len(accepted), len(events))
+                return sent
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                sent = self.flush()
+                if sent:
+                    log.info("Flushed %d delivery events", sent)
+                    purged = self.journal.purge(time.time() - self.keep_sent)
+                    if purged:
+                        log.debug("Purged %d acknowledged delivery events", purged)
+                self.last_error = None
+                self._delay = self.interval
+            except (OSError, ValueError) as e:
+                self.last_error = e
+                self._delay = min(self._delay * 2, self.max_backoff)
+                log.warning("Delivery events not sent (%d pending), retrying in %.1fs: %s",
+                            self.journal.pending_count(), self._delay, e)
+            self._wake.wait(self._delay)
+            self._wake.clear()
@@ -0,0 +1,166 @@
+import json
+import logging
+import sqlite3
+import threading
+import urllib.parse
+import urllib.request
+
+log = logging.getLogger(__name__)
+
+# Mission IDs reserved from the backend at a time
+ID_BLOCK = 100
+
+# Refill in the background once fewer IDs than this are left
+ID_LOW_WATER = 25
+
+# HTTP timeout of one reservation
+ID_TIMEOUT = 10
+
+# "MSN" and 5 digits fill the 8-byte mission ID field of the card
+ID_PREFIX = "MSN"
+ID_DIGITS = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS id_ranges (
+    first INTEGER NOT NULL,
+    last INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS id_counter (
+    name TEXT PRIMARY KEY,
+    next INTEGER NOT NULL
+);
+"""
+
+
+def format_mission_id(number, prefix=ID_PREFIX, digits=ID_DIGITS):
+    """Mission ID of a number; ValueError once the number no longer fits the card's field"""
+    if not 0 <= number < 10 ** digits:
+        raise ValueError(f"Mission number {number} does not fit in {digits} digits")
+    return f"{prefix}{number:0{digits}d}"
+
+
+class LocalIdSource:
+    def __init__(self, path=":memory:", start=1):
+        """Stand-in for the backend's ID reservation: a counter in SQLite.
+
+        Stations sharing the file never get overlapping blocks (the counter
+        is bumped in an immediate transaction).
+        """
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(SCHEMA)
+            self._conn.execute("INSERT OR IGNORE INTO id_counter (name, next) VALUES ('mission', ?)", (start,))
+
+    def reserve(self, count):
+        """Reserve `count` IDs; returns (first, last) numbers"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                first = self._conn.execute("SELECT next FROM id_counter WHERE name = 'mission'").fetchone()[0]
+                self._conn.execute("UPDATE id_counter SET next = ? WHERE name = 'mission'", (first + count,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return first, first + count - 1
+
+
+class HttpIdSource:
+    def __init__(self, base_url, timeout=ID_TIMEOUT):
+        """POST <base_url>/ids?count=<n> answers {"first", "last"}"""
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def reserve(self, count):
+        query = urllib.parse.urlencode({'count': count})
+        request = urllib.request.Request(f"{self.base_url}/ids?{query}", data=b"", method='POST')
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            block = json.loads(response.read().decode('utf-8'))
+        return block['first'], block['last']
+
+
+class MissionIdAllocator:
+    def __init__(self, source, path=":memory:", block_size=ID_BLOCK, low_water=ID_LOW_WATER):
+        """Hands out mission IDs from blocks reserved ahead of time.
+
+        `next_id()` takes the next number of the local ranges and saves the
+        rest before returning, so an ID is never handed out twice, even
+        across a restart, and unused ranges survive it. Once fewer than
+        `low_water` IDs are left a background thread reserves another block
+        from `source`, so issuing a card does not wait on the backend; only
+        a station that ran dry (offline for a whole block) reserves inline.
+        """
+        self.source = source
+        self.block_size = block_size
+        self.low_water = low_water
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._refill_lock = threading.Lock()
+        self._refilling = False
+        with self._lock, self._conn:
+            self._conn.executescript(SCHEMA)
+            self._ranges = [list(row) for row in
+                            self._conn.execute("SELECT first, last FROM id_ranges ORDER BY first")]
+
+    def available(self):
+        with self._lock:
+            return sum(last - first + 1 for first, last in self._ranges)
+
+    def next_number(self):
+        while True:
+            with self._lock:
+                if self._ranges:
+                    first, last = self._ranges[0]
+                    if first == last:
+                        self._ranges.pop(0)
+                    else:
+                        self._ranges[0][0] = first + 1
+                    self._save()
+                    left = sum(end - start + 1 for start, end in self._ranges)
+                    break
+            log.warning("No mission IDs reserved, reserving a block now")
+            self.refill()
+        if left < self.low_water:
+            self.refill_in_background()
+        return first
+
+    def top_up(self):
+        """Start a background refill if the reserve is low (at startup)"""
+        if self.available() < self.low_water:
+            self.refill_in_background()
+
+    def next_id(self):
+        return format_mission_id(self.next_number())
+
+    def refill(self):
+        """Reserve one block from the source; returns its (first, last)"""
+        with self._refill_lock:
+            first, last = self.source.reserve(self.block_size)
+            with self._lock:
+                self._ranges.append([first, last])
+                self._ranges.sort()
+                self._save()
+        log.info("Reserved mission IDs %d-%d", first, last)
+        return first, last
+
+    def refill_in_background(self):
+        with self._lock:
+            if self._refilling:
+                return
+            self._refilling = True
+        threading.Thread(target=self._background_refill, name="mission-ids", daemon=True).start()
+
+    def _background_refill(self):
+        try:
+            self.refill()
+        except (OSError, ValueError) as e:
+            log.warning("Cannot reserve mission IDs, will retry on the next issue: %s", e)
+        finally:
+            with self._lock:
+                self._refilling = False
+
+    def _save(self):
+        with self._conn:
+            self._conn.execute("DELETE FROM id_ranges")
+            self._conn.executemany("INSERT INTO id_ranges (first, last) VALUES (?, ?)", self._ranges)
@@ -0,0 +1,93 @@
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class MissionIndex:
+    def __init__(self, missions=()):
+        """Expected missions keyed by (mission_id, destination).
+
+        Secondary indexes map a truck, a source or a destination to the
+        keys of its missions. Missions are added, delivered or cancelled
+        one at a time, so a gate expecting thousands of missions a day
+        validates a card with one dict lookup and never rebuilds anything.
+        """
+        self._missions = {}
+        self._secondary = {'truck_id': {}, 'source': {}, 'destination': {}}
+        self._lock = threading.Lock()
+        for mission in missions:
+            self.add(mission)
+
+    @staticmethod
+    def key(mission):
+        return mission['mission_id'], mission['destination']
+
+    def add(self, mission):
+        """Add or replace a mission; returns its key"""
+        key = self.key(mission)
+        with self._lock:
+            self._discard(key)
+            self._missions[key] = mission
+            for field, index in self._secondary.items():
+                index.setdefault(mission.get(field), set()).add(key)
+        return key
+
+    def remove(self, mission_id, destination):
+        """Drop a mission; returns it, or None if it was not expected"""
+        with self._lock:
+            return self._discard((mission_id, destination))
+
+    # A delivered or cancelled mission is no longer expected anywhere
+    deliver = remove
+    cancel = remove
+
+    def get(self, mission_id, destination):
+        return self._missions.get((mission_id, destination))
+
+    def _lookup(self, field, value):
+        with self._lock:
+            return [self._missions[key] for key in self._secondary[field].get(value, ())]
+
+    def for_truck(self, truck_id):
+        return self._lookup('truck_id', truck_id)
+
+    def for_source(self, source):
+        return self._lookup('source', source)
+
+    def for_destination(self, destination):
+        return self._lookup('destination', destination)
+
+    def replace_all(self, missions):
+        """Bring the index in line with a full mission list.
+
+        Returns (added, removed) keys; unchanged missions are left alone, a
+        changed one counts as both removed and added.
+        """
+        wanted = {self.key(mission): mission for mission in missions}
+        removed = [key for key, mission in list(self._missions.items()) if wanted.get(key) != mission]
+        for key in removed:
+            self.remove(*key)
+        added = [self.add(mission) for key, mission in wanted.items() if key not in self._missions]
+        return added, removed
+
+    def _discard(self, key):
+        mission = self._missions.pop(key, None)
+        if mission is None:
+            return None
+        for field, index in self._secondary.items():
+            keys = index.get(mission.get(field))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[mission.get(field)]
+        return mission
+
+    def __len__(self):
+        return len(self._missions)
+
+    def __contains__(self, key):
+        return key in self._missions
+
+    def __iter__(self):
+        return iter(list(self._missions.values()))
@@ -0,0 +1,343 @@
+import json
+import logging
+import os
+
+from desfire_ev1.planner import StoragePlanner
+from desfire_ev1.provisioning import FAILED
+from desfire_ev1.segments import FRAME_HEADER, sealed_size, seal, frame
+from mission.encoding import COMPACT_STATUS_OFFSET
+from mission.digest import DIGEST_SIZE
+
+log = logging.getLogger(__name__)
+
+MASTER_APP_ID = [0x00, 0x00, 0x00]
+
+# Three applications, one per part of the mission (the original layout)
+DRIVER_APP_ID = [0x00, 0x00, 0x01]
+MISSION_APP_ID = [0x00, 0x00, 0x02]
+ARTICLE_APP_ID = [0x00, 0x00, 0x03]
+
+# Layout v2: everything in a single application
+MISSION_CARD_APP_ID = [0x00, 0x00, 0x10]
+
+# Start of the v2 mission file: magic + layout version + encoding
+MARKER_MAGIC = b"MC"
+
+# Bytes every single-application mission file holds at least: the marker (magic, version, encoding) and a frame header
+MISSION_HEAD_SIZE = len(MARKER_MAGIC) + 2 + FRAME_HEADER
+
+# Mission file encodings: fixed 57-byte record (articles in a record file), or
+# a length-prefixed dictionary-coded mission including the articles
+ENCODING_FIXED = 0
+ENCODING_COMPACT = 1
+
+# First layout version whose driver, photo and mission data carry a CRC per segment
+SEALED_VERSION = 3
+
+# Length prefix of the compact mission in the layouts without CRCs
+LEGACY_LENGTH_SIZE = 2
+
+# Offset of the status byte in the fixed mission record
+FIXED_STATUS_OFFSET = 16
+
+
+class CardLayout:
+    def __init__(self, version, driver, photo, mission, articles, digest, encoding=ENCODING_FIXED, backup=()):
+        """Where each part of a mission card lives, as (AID, file ID) pairs.
+
+        From version 2 on, the mission file starts with a 4-byte marker
+        (magic, version, encoding) that readers check before parsing. With
+        the compact encoding the articles live in the mission file, so
+        their file ID is None. From version 3 on (`sealed`) the data
+        carries a CRC per segment: the driver record and the fixed mission
+        record are followed by their CRC table, the photo and the compact
+        mission are framed with their length (desfire_ev1.segments).
+        Earlier versions keep their original format. The digest file, in
+        the mission's application, holds the mission digest readers check
+        first.
+        Parts named in `backup` are backup data files, written in a
+        transaction that only takes effect on commit; the photo is too
+        large to keep twice on a 2 KB card.
+        """
+        self.version = version
+        self.driver = driver
+        self.photo = photo
+        self.mission = mission
+        self.articles = articles
+        self.digest = digest
+        self.encoding = encoding
+        self.backup = tuple(backup)
+        self.marker = MARKER_MAGIC + bytes([version, encoding]) if version >= 2 else b""
+
+    @property
+    def compact(self):
+        return self.encoding == ENCODING_COMPACT
+
+    @property
+    def sealed(self):
+        return self.version >= SEALED_VERSION
+
+    @property
+    def mission_offset(self):
+        """Offset of the mission data inside the mission file"""
+        if not self.compact:
+            return len(self.marker)
+        return len(self.marker) + (FRAME_HEADER if self.sealed else LEGACY_LENGTH_SIZE)
+
+    def data_size(self, length):
+        """Bytes taken on the card by `length` bytes of driver or mission data"""
+        return sealed_size(length) if self.sealed else length
+
+    @property
+    def status_offset(self):
+        """Offset of the status byte inside the mission file"""
+        return self.mission_offset + (COMPACT_STATUS_OFFSET if self.compact else FIXED_STATUS_OFFSET)
+
+    def applications(self):
+        """Distinct AIDs of the layout, in order"""
+        aids = []
+        for aid, file_id in (self.driver, self.photo, self.mission, self.articles, self.digest):
+            if aid not in aids:
+                aids.append(aid)
+        return aids
+
+    def check_marker(self, mission_file):
+        """Raise ValueError if the mission file does not carry this layout's marker"""
+        if bytes(mission_file[:len(self.marker)]) != self.marker:
+            raise ValueError(f"Mission file does not carry the layout v{self.version} marker")
+
+    def plan(self, driver_size, photo_size, mission_size, record_size, max_records, planner=None):
+        """StoragePlanner for this layout with the given logical sizes"""
+        planner = planner or StoragePlanner()
+        planner.add_standard_file(self.driver[0], self.driver[1], self.data_size(driver_size))
+        planner.add_standard_file(self.photo[0], self.photo[1], photo_size)
+        planner.add_standard_file(self.digest[0], self.digest[1], DIGEST_SIZE, backup="digest" in self.backup)
+        if self.compact:
+            # The articles share the mission file: give it the record file's budget
+            planner.add_standard_file(self.mission[0], self.mission[1],
+                                      self.mission_offset + self.data_size(mission_size + record_size * max_records),
+                                      backup="mission" in self.backup)
+            return planner
+        planner.add_standard_file(self.mission[0], self.mission[1], self.mission_offset + self.data_size(mission_size),
+                                  backup="mission" in self.backup)
+        planner.add_record_file(self.articles[0], self.articles[1], record_size, max_records)
+        return planner
+
+
+LAYOUT_V1 = CardLayout(1, driver=(DRIVER_APP_ID, 0x01), photo=(DRIVER_APP_ID, 0x02),
+                       mission=(MISSION_APP_ID, 0x01), articles=(ARTICLE_APP_ID, 0x01),
+                       digest=(MISSION_APP_ID, 0x02))
+
+LAYOUT_V2 = CardLayout(2, driver=(MISSION_CARD_APP_ID, 0x02), photo=(MISSION_CARD_APP_ID, 0x03),
+                       mission=(MISSION_CARD_APP_ID, 0x01), articles=(MISSION_CARD_APP_ID, 0x04),
+                       digest=(MISSION_CARD_APP_ID, 0x05), backup=("mission", "digest"))
+
+LAYOUT_V2_COMPACT = CardLayout(2, driver=(MISSION_CARD_APP_ID, 0x02), photo=(MISSION_CARD_APP_ID, 0x03),
+                               mission=(MISSION_CARD_APP_ID, 0x01), articles=(MISSION_CARD_APP_ID, None),
+                               digest=(MISSION_CARD_APP_ID, 0x05), encoding=ENCODING_COMPACT, backup=("digest",))
+
+LAYOUT_V3 = CardLayout(3, driver=(MISSION_CARD_APP_ID, 0x02), photo=(MISSION_CARD_APP_ID, 0x03),
+                       mission=(MISSION_CARD_APP_ID, 0x01), articles=(MISSION_CARD_APP_ID, 0x04),
+                       digest=(MISSION_CARD_APP_ID, 0x05), backup=("mission", "digest"))
+
+LAYOUT_V3_COMPACT = CardLayout(3, driver=(MISSION_CARD_APP_ID, 0x02), photo=(MISSION_CARD_APP_ID, 0x03),
+                               mission=(MISSION_CARD_APP_ID, 0x01), articles=(MISSION_CARD_APP_ID, None),
+                               digest=(MISSION_CARD_APP_ID, 0x05), encoding=ENCODING_COMPACT, backup=("digest",))
+
+LAYOUTS = {1: LAYOUT_V1, 2: LAYOUT_V2, 3: LAYOUT_V3}
+
+# Every layout a card can carry, to size a storage plan for each
+ALL_LAYOUTS = (LAYOUT_V1, LAYOUT_V2, LAYOUT_V2_COMPACT, LAYOUT_V3, LAYOUT_V3_COMPACT)
+
+
+def layout_from_marker(mission_file):
+    """Single-application layout (version and encoding) named by the marker at the start of a mission file"""
+    for layout in (LAYOUT_V2, LAYOUT_V2_COMPACT, LAYOUT_V3, LAYOUT_V3_COMPACT):
+        if bytes(mission_file[:len(layout.marker)]) == layout.marker:
+            return layout
+    raise ValueError("Mission file carries no known layout marker")
+
+
+def detect_layout(card, inventory=None, uid=None):
+    """Layout of the card in the field.
+
+    Answers from the inventory when the card is known; otherwise probes
+    for the v2 application with one SelectApplication (which then stays
+    selected, unauthenticated). Every single-application card reads as
+    LAYOUT_V2: the marker of its mission file tells the version.
+    """
+    snapshot = inventory.get(uid) if inventory is not None and uid is not None else None
+    if snapshot is not None:
+        return LAYOUT_V2 if bytes(MISSION_CARD_APP_ID) in snapshot else LAYOUT_V1
+    return LAYOUT_V2 if card.select_application(MISSION_CARD_APP_ID) else LAYOUT_V1
+
+
+def read_card_files(file_manager, layout, authenticate_app, sizes, comm_mode, records_comm_mode):
+    """Raw contents of every file of a layout: {part: bytes}.
+
+    `sizes` maps driver/photo/mission to the number of bytes to read;
+    `authenticate_app(aid)` selects and authenticates an application.
+    The digest is None when the card has none. Raises ValueError when a
+    file cannot be read in full. Only layouts without CRCs are read this
+    way.
+    """
+    if layout.sealed:
+        raise ValueError(f"Cannot read the files of layout v{layout.version} as is")
+    contents = {}
+    for part in ("driver", "photo", "mission"):
+        aid, file_id = getattr(layout, part)
+        authenticate_app(aid)
+        length = sizes[part] + (layout.mission_offset if part == "mission" else 0)
+        data = file_manager.read_data(file_id, 0, length, comm_mode=comm_mode)
+        if len(data) != length:
+            raise ValueError(f"Cannot read the {part} file of layout v{layout.version}")
+        contents[part] = bytes(data)
+    layout.check_marker(contents["mission"])
+    contents["mission"] = contents["mission"][layout.mission_offset:]
+    # Cards issued before the digest existed have no digest file
+    aid, file_id = layout.digest
+    authenticate_app(aid)
+    digest = file_manager.read_data(file_id, 0, DIGEST_SIZE, comm_mode=comm_mode)
+    contents["digest"] = bytes(digest) if len(digest) == DIGEST_SIZE else None
+    # Every record must be read before the card is formatted: the count comes from the card, not from the read
+    aid, file_id = layout.articles
+    authenticate_app(aid)
+    settings = file_manager.get_file_settings(file_id)
+    if settings is None or 'current_records' not in settings:
+        raise ValueError(f"Cannot read the settings of the article file of layout v{layout.version}")
+    count, record_size = settings['current_records'], settings['record_size']
+    records = file_manager.read_records(file_id, 0, count, comm_mode=records_comm_mode,
+                                        record_size=record_size) if count else []
+    if len(records) != count * record_size:
+        raise ValueError(f"Read {len(records)} bytes of {count} article records of {record_size} bytes")
+    contents["articles"] = bytes(records)
+    return contents
+
+
+def photo_contents(photo):
+    """Photo payload of a photo file without CRCs (metadata length, metadata, image), padding dropped"""
+    meta_len = int.from_bytes(photo[:4], 'little')
+    meta = json.loads(bytes(photo[4:4 + meta_len]).decode('utf-8'))
+    return bytes(photo[:4 + meta_len + meta.get('data_length', len(photo) - 4 - meta_len)])
+
+
+class MigrationBackup:
+    def __init__(self, path):
+        """Contents of cards being migrated, one JSON file per UID in directory `path`.
+
+        A card's contents are saved before it is formatted and discarded
+        once it is rewritten, so a card torn (or failing) in between is
+        migrated again from the saved copy instead of being lost.
+        """
+        self.path = path
+
+    def _file(self, uid):
+        return os.path.join(self.path, bytes(uid).hex() + ".json")
+
+    def save(self, uid, contents):
+        os.makedirs(self.path, exist_ok=True)
+        path = self._file(uid)
+        tmp = path + ".tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({part: data.hex() if data is not None else None for part, data in contents.items()}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def load(self, uid):
+        """Saved contents of a card, None if it has none"""
+        try:
+            with open(self._file(uid), encoding='utf-8') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return None
+        return {part: bytes.fromhex(data) if data is not None else None for part, data in saved.items()}
+
+    def discard(self, uid):
+        try:
+            os.remove(self._file(uid))
+        except FileNotFoundError:
+            pass
+
+
+def migrate_card(card, file_manager, provisioner, authenticate_app, authenticate_master, backup,
+                 sizes, record_size, max_records, num_keys=0x01, comm_mode=0x00, records_comm_mode=0x00,
+                 source=LAYOUT_V1, target=LAYOUT_V2):
+    """Move a card in circulation from one layout to another.
+
+    Everything is read first and saved in `backup` (a MigrationBackup). A
+    2 KB card cannot hold both layouts and deleted applications only free
+    memory on a format, so the card is then formatted
+    (`authenticate_master()` authenticates the PICC master key) and
+    rewritten in the target layout, with CRCs computed over the data if
+    the target has them. A card with saved contents had its migration
+    interrupted: it is rewritten from them. Returns False if the card is
+    not in the source layout.
+    """
+    if source.compact or target.compact:
+        raise ValueError("Only layouts with the fixed mission encoding can be migrated")
+    if source.sealed:
+        raise ValueError("Only layouts without CRCs can be migrated")
+    uid = card.get_uid()
+    if uid is None:
+        raise ValueError("Cannot read the card UID")
+    contents = backup.load(uid)
+    if contents is not None:
+        log.info("Resuming the migration of card %s from its saved contents", uid.hex())
+    else:
+        if detect_layout(card) is not source:
+            return False
+        contents = read_card_files(file_manager, source, authenticate_app, sizes, comm_mode, records_comm_mode)
+        backup.save(uid, contents)
+    log.info("Migrating card from layout v%d to v%d", source.version, target.version)
+
+    card.select_application(MASTER_APP_ID)
+    if not (authenticate_master() and card.format_card()):
+        raise ValueError("Cannot format the card for migration")
+    provisioner.load_applications()
+    for aid in target.applications():
+        if provisioner.ensure_application(aid, num_keys=num_keys) == FAILED:
+            raise ValueError(f"Cannot create application {bytes(aid).hex()}")
+
+    plan = target.plan(sizes["driver"], sizes["photo"], sizes["mission"], record_size, max_records)
+    if target.sealed:
+        photo = frame(photo_contents(contents["photo"]))
+        if len(photo) > sizes["photo"]:
+            raise ValueError(f"The photo takes {len(photo)} bytes with its CRCs, the photo file {sizes['photo']}")
+        payloads = {
+            "driver": seal(contents["driver"]),
+            "photo": photo,
+            "mission": target.marker + seal(contents["mission"]),
+        }
+    else:
+        payloads = {
+            "driver": contents["driver"],
+            "photo": contents["photo"],
+            "mission": target.marker + contents["mission"],
+        }
+    if contents["digest"] is not None:
+        payloads["digest"] = contents["digest"]
+    for part, payload in payloads.items():
+        aid, file_id = getattr(target, part)
+        authenticate_app(aid)
+        provisioner.application_selected(aid)
+        provisioner.ensure_standard_file(file_id, plan.file(aid, file_id)['size'], comm_settings=comm_mode,
+                                         backup=part in target.backup)
+        if not file_manager.write_data(file_id, 0, list(payload), comm_mode=comm_mode):
+            raise ValueError(f"Cannot write the {part} file")
+        if part in target.backup and not file_manager.commit_transaction():
+            raise ValueError(f"Cannot commit the {part} file")
+
+    aid, file_id = target.articles
+    authenticate_app(aid)
+    provisioner.application_selected(aid)
+    planned = plan.file(aid, file_id)
+    provisioner.ensure_record_file(file_id, record_size, planned['max_records'], comm_settings=records_comm_mode)
+    records = contents["articles"]
+    for i in range(0, len(records) - record_size + 1, record_size):
+        # One record per transaction: writes before a commit all land in the same record
+        if not (file_manager.write_record(file_id, 0, list(records[i:i + record_size]), comm_mode=records_comm_mode)
+                and file_manager.commit_transaction()):
+            raise ValueError("Cannot write the article records")
+    backup.discard(uid)
+    return True
@@ -0,0 +1,213 @@
+"""Local stand-in for the mission API (delta sync, delivery events, mission IDs).
+
+    python -m mission.mock_api --port 8765 [--churn 30]
+
+then start the stations with DESFIRE_API_URL=http://127.0.0.1:8765.
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from mission.encoding import dictionary_additions
+
+log = logging.getLogger(__name__)
+
+# Rows returned per page of /sync
+PAGE_SIZE = 500
+
+SAMPLE_ARTICLES = [
+    {"id": 1, "content": "AR01", "source": "Oran", "destination": "Chlef", "site_id": 1, "tag": 1, "site_type": 9},
+    {"id": 2, "content": "AR02", "source": "Oran", "destination": "Chlef", "site_id": 1, "tag": 1, "site_type": 9},
+    {"id": 3, "content": "AR03", "source": "Oran", "destination": "Chlef", "site_id": 1, "tag": 1, "site_type": 9},
+    {"id": 4, "content": "AR04", "source": "Oran", "destination": "Chlef", "site_id": 1, "tag": 1, "site_type": 9},
+]
+
+SAMPLE_TRUCKS = [
+    {"id": 1, "model": "MR01", "license_plate": "TRCK1317", "available": "Free"},
+    {"id": 2, "model": "MR02", "license_plate": "TRCK1317", "available": "Free"},
+    {"id": 3, "model": "MR03", "license_plate": "TRCK1317", "available": "Free"},
+    {"id": 4, "model": "MR04", "license_plate": "TRCK1317", "available": "Free"},
+]
+
+SAMPLE_MISSIONS = [
+    {"mission_id": "MSN00001", "truck_id": "TRK00123", "source": "Oran", "destination": "djelfa", "status": "In Transit",
+     "articles": [{"code": "AR01", "quantity": 10}, {"code": "AR02", "quantity": 5}]},
+    {"mission_id": "MSN00002", "truck_id": "TRK00456", "source": "Chlef", "destination": "djelfa", "status": "In Transit",
+     "articles": [{"code": "AR03", "quantity": 20}]},
+    {"mission_id": "MSN00003", "truck_id": "TRK00789", "source": "Biskra", "destination": "djelfa", "status": "In Transit",
+     "articles": [{"code": "AR01", "quantity": 2}, {"code": "AR04", "quantity": 8}]},
+    {"mission_id": "MSN00004", "truck_id": "TRK00999", "source": "Medya", "destination": "djelfa", "status": "In Transit",
+     "articles": [{"code": "AR02", "quantity": 15}]},
+]
+
+KEYS = {'articles': 'id', 'trucks': 'id', 'missions': 'mission_id', 'dictionary': 'seq'}
+
+
+class MockMissionAPI:
+    def __init__(self, articles=SAMPLE_ARTICLES, trucks=SAMPLE_TRUCKS, missions=SAMPLE_MISSIONS, page_size=PAGE_SIZE):
+        """Rows tagged with the version that last changed them, deletions kept as tombstones.
+
+        Also the dictionary authority: the names of every row put get
+        compact-encoding entries, appended and never changed or deleted.
+        """
+        self.page_size = page_size
+        self.version = 0
+        self.rows = {table: {} for table in KEYS}
+        self.dictionary = []
+        self.events = {}
+        self.next_mission = len(missions) + 1
+        self._lock = threading.Lock()
+        for table, rows in (('articles', articles), ('trucks', trucks), ('missions', missions)):
+            for row in rows:
+                self.put(table, row)
+
+    def put(self, table, row):
+        with self._lock:
+            self.version += 1
+            self.rows[table][row[KEYS[table]]] = (self.version, dict(row), False)
+            for kind, name, value_id in dictionary_additions(self.dictionary, **{table: [row]}):
+                self.version += 1
+                self.dictionary.append((kind, name, value_id))
+                seq = len(self.dictionary)
+                self.rows['dictionary'][seq] = (self.version, {'seq': seq, 'kind': kind, 'name': name, 'id': value_id},
+                                                False)
+
+    def delete(self, table, key):
+        with self._lock:
+            if key in self.rows[table]:
+                self.version += 1
+                self.rows[table][key] = (self.version, None, True)
+
+    def changes(self, since):
+        """Response of /sync?since=<version>"""
+        with self._lock:
+            changed = sorted((version, table, key, row, deleted)
+                             for table, rows in self.rows.items()
+                             for key, (version, row, deleted) in rows.items() if version > since)
+            page = changed[:self.page_size]
+            response = {table: [] for table in KEYS}
+            response['deleted'] = {table: [] for table in KEYS}
+            for version, table, key, row, deleted in page:
+                if deleted:
+                    response['deleted'][table].append(key)
+                else:
+                    response[table].append(row)
+            response['version'] = page[-1][0] if page else max(since, self.version)
+            response['full'] = since == 0
+            response['more'] = len(changed) > len(page)
+            return response
+
+
+    def reserve_ids(self, count):
+        """Response of POST /ids?count=<n>: a block of mission numbers nobody else gets"""
+        with self._lock:
+            first = self.next_mission
+            self.next_mission += count
+        return {'first': first, 'last': first + count - 1}
+
+    def post_events(self, events):
+        """Response of POST /events: the event_ids stored, duplicates included"""
+        accepted = []
+        for event in events:
+            event_id = event['event_id']
+            if event_id not in self.events:
+                self.events[event_id] = event
+                mission = self.rows['missions'].get(event['mission_id'])
+                if event['action'] == 'approved' and mission is not None and not mission[2]:
+                    self.put('missions', dict(mission[1], status="Delivered"))
+                elif event['action'] == 'issued' and mission is None:
+                    details = event.get('details') or {}
+                    self.put('missions', {'mission_id': event['mission_id'], 'truck_id': details.get('truck_id'),
+                                          'source': details.get('source'), 'destination': event['destination'],
+                                          'status': "Pending", 'articles': details.get('articles', [])})
+            accepted.append(event_id)
+        return {'accepted': accepted}
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/sync':
+                self.send_error(404)
+                return
+            try:
+                since = int(parse_qs(url.query).get('since', ['0'])[0])
+            except ValueError:
+                self.send_error(400)
+                return
+            self.send_json(api.changes(since))
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            if url.path == '/ids':
+                try:
+                    count = int(parse_qs(url.query).get('count', ['1'])[0])
+                except ValueError:
+                    self.send_error(400)
+                    return
+                self.send_json(api.reserve_ids(count))
+                return
+            if url.path != '/events':
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                events = json.loads(self.rfile.read(length).decode('utf-8'))['events']
+            except (ValueError, KeyError):
+                self.send_error(400)
+                return
+            self.send_json(api.post_events(events))
+
+        def send_json(self, response):
+            body = json.dumps(response).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(format, *args)
+
+    return Handler
+
+
+def serve(api, port=8765, host='127.0.0.1'):
+    """Serve the API in a daemon thread; returns the server"""
+    server = ThreadingHTTPServer((host, port), make_handler(api))
+    threading.Thread(target=server.serve_forever, name="mock-api", daemon=True).start()
+    return server
+
+
+def churn(api, interval):
+    """Add a mission to djelfa every `interval` seconds, to watch the stations pick it up"""
+    while True:
+        time.sleep(interval)
+        number = api.reserve_ids(1)['first']
+        api.put('missions', {"mission_id": f"MSN{number:05d}", "truck_id": "TRCK1317", "source": "Oran",
+                             "destination": "djelfa", "status": "In Transit",
+                             "articles": [{"code": "AR01", "quantity": number}]})
+        log.info("Added mission MSN%05d (version %d)", number, api.version)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--churn', type=float, default=0, help="add a mission every N seconds")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    api = MockMissionAPI()
+    server = serve(api, args.port)
+    log.info("Mock mission API on http://127.0.0.1:%d/sync", args.port)
+    try:
+        if args.churn:
+            churn(api, args.churn)
+        else:
+            threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
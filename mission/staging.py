@@ -0,0 +1,197 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import threading
+
+from desfire_ev1.segments import seal, frame
+from desfire_ev1.utils import to_4bytes
+from mission.encoding import encode_mission
+from mission.layout import LEGACY_LENGTH_SIZE
+from mission.digest import mission_digest
+
+log = logging.getLogger(__name__)
+
+# Status written on a newly issued mission
+STATUS_PENDING = 0
+
+# Width of the fixed mission record fields
+MISSION_ID_SIZE = 8
+TRUCK_ID_SIZE = 8
+PLACE_SIZE = 20
+
+# Logical size of the driver file: shorter records are padded so no earlier driver shows through
+DRIVER_SIZE = 20
+
+
+def form_mission(form):
+    """Truck ID and (code, quantity) articles of a submitted form"""
+    truck_id = form['truck']['license_plate'] if form['truck'] else "UNKNOWN"
+    articles = [(article['content'][:4].upper(), int(article['quantity'])) for article in form['articles']]
+    return truck_id, articles
+
+
+def pack_driver(layout, driver_name, driver_license, size=DRIVER_SIZE):
+    """Driver file contents: name then license, space-padded to `size` (readers strip the spaces), sealed in v3"""
+    record = (driver_name + driver_license).encode('utf-8').ljust(size, b' ')
+    return seal(record) if layout.sealed else record
+
+
+def pack_photo(layout, data, meta):
+    """Photo file contents: 4-byte metadata length, JSON metadata, compressed image, framed with CRCs in v3"""
+    # Readers size the image read exactly from data_length
+    meta_json = json.dumps(dict(meta, data_length=len(data))).encode('utf-8')
+    payload = len(meta_json).to_bytes(4, 'little') + meta_json + bytes(data)
+    return frame(payload) if layout.sealed else payload
+
+
+def pack_mission(layout, dictionary, mission_id, truck_id, status, source, destination, articles=()):
+    """Mission file contents in a layout.
+
+    The fixed encoding is the layout marker (v2 on) and a 57-byte record,
+    followed by its CRC table in v3; the compact one is the marker and the
+    dictionary-coded mission with its articles behind its length (framed
+    with CRCs in v3).
+    """
+    if layout.compact:
+        encoded = encode_mission(dictionary, mission_id, truck_id, status, source, destination, articles)
+        if layout.sealed:
+            return bytes(layout.marker) + frame(encoded)
+        return bytes(layout.marker) + len(encoded).to_bytes(LEGACY_LENGTH_SIZE, 'little') + encoded
+    if len(mission_id.encode('utf-8')) > MISSION_ID_SIZE:
+        raise ValueError(f"Mission ID {mission_id} is longer than {MISSION_ID_SIZE} bytes")
+    record = (mission_id.ljust(MISSION_ID_SIZE, ' ').encode('utf-8')[:MISSION_ID_SIZE] +
+              truck_id.ljust(TRUCK_ID_SIZE, ' ').encode('utf-8')[:TRUCK_ID_SIZE] + bytes([status]) +
+              source.ljust(PLACE_SIZE, ' ').encode('utf-8')[:PLACE_SIZE] +
+              destination.ljust(PLACE_SIZE, ' ').encode('utf-8')[:PLACE_SIZE])
+    return bytes(layout.marker) + (seal(record) if layout.sealed else record)
+
+
+def pack_article(code, quantity):
+    """8-byte article record: 4-byte code, 4-byte quantity"""
+    return code.ljust(4, ' ').encode('utf-8')[:4] + bytes(to_4bytes(quantity))
+
+
+class StagedCard:
+    def __init__(self, mission_id, layout, driver, photo, articles, mission, digest, job, record=None):
+        """Everything written to one card, built and checked before the card is on the reader.
+
+        `articles` holds the (code, quantity) pairs and `records` their
+        packed records (empty in the compact layout, where they are in the
+        mission file); `job` identifies the contents for the issuing journal.
+        `record` is the mission as the store holds it, registered once the
+        card is written.
+        """
+        self.mission_id = mission_id
+        self.layout = layout
+        self.driver = driver
+        self.photo = photo
+        self.articles = articles
+        self.records = [] if layout.compact else [pack_article(code, quantity) for code, quantity in articles]
+        self.mission = mission
+        self.digest = digest
+        self.job = job
+        self.record = record
+
+    def size(self):
+        return (len(self.driver) + len(self.photo) + sum(len(record) for record in self.records) +
+                len(self.mission) + len(self.digest))
+
+
+class CardStager:
+    def __init__(self, plans, dictionary, digest_key=b"", compress=None, driver_size=DRIVER_SIZE):
+        """Builds the complete file images of a submitted form.
+
+        `plans` maps each layout to its storage plan, against which every
+        image is checked (StorageError); `compress(image_path)` returns
+        (total_size, data, meta) for the driver photo; the driver record is
+        padded to `driver_size`.
+        """
+        self.plans = plans
+        self.dictionary = dictionary
+        self.digest_key = digest_key
+        self.compress = compress
+        self.driver_size = driver_size
+
+    def stage(self, form, mission_id, layout):
+        """StagedCard for a form (as emitted by the source interface)"""
+        truck_id, articles = form_mission(form)
+        if form.get('image_vec') is None:
+            if not form.get('image_path'):
+                raise ValueError("No driver photo")
+            _, image, meta = self.compress(form['image_path'])
+        else:
+            image, meta = form['image_vec'], form['image_metaData']
+
+        driver = pack_driver(layout, form['driver_name'], form['driver_license'], self.driver_size)
+        photo = pack_photo(layout, image, meta)
+        mission = pack_mission(layout, self.dictionary, mission_id, truck_id, STATUS_PENDING, form['source'],
+                               form['destination'], articles)
+        digest = mission_digest(mission_id, truck_id, form['source'], form['destination'], articles, self.digest_key)
+
+        plan = self.plans[layout]
+        plan.check_data(*layout.driver, len(driver))
+        plan.check_data(*layout.photo, len(photo))
+        plan.check_data(*layout.mission, len(mission))
+        if not layout.compact:
+            plan.check_data(*layout.articles, len(articles) * len(pack_article("", 0)))
+
+        job = hashlib.blake2b(digest, digest_size=16)
+        job.update(driver)
+        job.update(photo)
+        record = {'mission_id': mission_id, 'truck_id': truck_id, 'source': form['source'],
+                  'destination': form['destination'], 'status': "Pending",
+                  'articles': [{'code': code, 'quantity': quantity} for code, quantity in articles]}
+        return StagedCard(mission_id, layout, driver, photo, articles, mission, digest, job.hexdigest(), record)
+
+
+class StagingQueue:
+    def __init__(self, stager, on_ready=None, on_error=None):
+        """Stages forms in a worker thread and queues the results in order.
+
+        `submit()` returns at once; the worker compresses the photo and packs
+        the files, then queues the StagedCard and calls `on_ready(staged)`
+        (or `on_error(mission_id, error)`) from the worker thread. A form
+        submitted again (same mission ID) is not queued twice.
+        """
+        self.stager = stager
+        self.on_ready = on_ready
+        self.on_error = on_error
+        self._queue = OrderedDict()  # mission ID -> StagedCard, oldest first
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="staging")
+
+    def submit(self, form, mission_id, layout):
+        return self._executor.submit(self._stage, form, mission_id, layout)
+
+    def _stage(self, form, mission_id, layout):
+        try:
+            staged = self.stager.stage(form, mission_id, layout)
+        except Exception as e:
+            log.error("Cannot stage mission %s: %s", mission_id, e)
+            if self.on_error is not None:
+                self.on_error(mission_id, e)
+            return None
+        with self._lock:
+            self._queue.setdefault(staged.mission_id, staged)
+        log.info("Staged mission %s (%d bytes, %d queued)", mission_id, staged.size(), len(self))
+        if self.on_ready is not None:
+            self.on_ready(staged)
+        return staged
+
+    def peek(self):
+        """Oldest staged card, left in the queue until `done()`"""
+        with self._lock:
+            return next(iter(self._queue.values()), None)
+
+    def done(self, staged):
+        with self._lock:
+            self._queue.pop(staged.mission_id, None)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._queue)
@@ -0,0 +1,191 @@
+import logging
+import sqlite3
+import threading
+
+from mission.encoding import dictionary_additions
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS articles (
+    id INTEGER PRIMARY KEY,
+    content TEXT NOT NULL,
+    source TEXT,
+    destination TEXT,
+    site_id INTEGER,
+    tag INTEGER,
+    site_type INTEGER
+);
+CREATE INDEX IF NOT EXISTS articles_content ON articles (content);
+
+CREATE TABLE IF NOT EXISTS trucks (
+    id INTEGER PRIMARY KEY,
+    model TEXT,
+    license_plate TEXT NOT NULL,
+    available TEXT
+);
+CREATE INDEX IF NOT EXISTS trucks_available ON trucks (available);
+
+CREATE TABLE IF NOT EXISTS missions (
+    mission_id TEXT PRIMARY KEY,
+    truck_id TEXT,
+    source TEXT,
+    destination TEXT,
+    status TEXT
+);
+CREATE INDEX IF NOT EXISTS missions_destination ON missions (destination);
+CREATE INDEX IF NOT EXISTS missions_truck ON missions (truck_id);
+CREATE INDEX IF NOT EXISTS missions_source ON missions (source);
+
+CREATE TABLE IF NOT EXISTS mission_articles (
+    mission_id TEXT NOT NULL REFERENCES missions (mission_id) ON DELETE CASCADE,
+    code TEXT NOT NULL,
+    quantity INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mission_articles_mission ON mission_articles (mission_id);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+-- Compact-encoding dictionary, as the authority appended it: an entry keeps its seq and ID for good
+CREATE TABLE IF NOT EXISTS dictionary (
+    seq INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    UNIQUE (kind, name),
+    UNIQUE (kind, id)
+);
+"""
+
+ARTICLE_COLUMNS = ('id', 'content', 'source', 'destination', 'site_id', 'tag', 'site_type')
+TRUCK_COLUMNS = ('id', 'model', 'license_plate', 'available')
+MISSION_COLUMNS = ('mission_id', 'truck_id', 'source', 'destination', 'status')
+DICTIONARY_COLUMNS = ('seq', 'kind', 'name', 'id')
+
+
+class MissionStore:
+    def __init__(self, path=":memory:"):
+        """Local SQLite copy of the articles, trucks and missions.
+
+        Stations read from it at startup, so they come up instantly and
+        keep working offline; sync.py applies the changes the API reports
+        since the stored version. One connection is shared by the GUI and
+        the sync thread behind a lock.
+        """
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA foreign_keys = ON")
+            self._conn.executescript(SCHEMA)
+
+    def version(self):
+        """Version of the last change applied (0 before the first sync)"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM sync_state WHERE name = 'version'").fetchone()
+        return row[0] if row else 0
+
+    def empty(self):
+        with self._lock:
+            return self._conn.execute("SELECT NOT EXISTS (SELECT 1 FROM articles) "
+                                      "AND NOT EXISTS (SELECT 1 FROM missions)").fetchone()[0] == 1
+
+    def apply(self, changes, full=False):
+        """Apply one sync response in a single transaction; returns the number of rows changed.
+
+        `changes` holds upserted 'articles', 'trucks' and 'missions' (with
+        their 'articles' manifest), new 'dictionary' entries, 'deleted' IDs
+        per table and the new 'version'. A full snapshot (`full`) replaces
+        everything.
+        """
+        deleted = changes.get('deleted', {})
+        count = 0
+        with self._lock, self._conn:
+            if full:
+                for table in ('mission_articles', 'missions', 'trucks', 'articles', 'dictionary'):
+                    self._conn.execute(f"DELETE FROM {table}")
+            count += self._upsert('articles', ARTICLE_COLUMNS, changes.get('articles', ()))
+            count += self._upsert('trucks', TRUCK_COLUMNS, changes.get('trucks', ()))
+            missions = changes.get('missions', ())
+            count += self._upsert('missions', MISSION_COLUMNS, missions)
+            count += self._upsert('dictionary', DICTIONARY_COLUMNS, changes.get('dictionary', ()))
+            for mission in missions:
+                self._conn.execute("DELETE FROM mission_articles WHERE mission_id = ?", (mission['mission_id'],))
+                self._conn.executemany("INSERT INTO mission_articles (mission_id, code, quantity) VALUES (?, ?, ?)",
+                                       [(mission['mission_id'], article['code'], article['quantity'])
+                                        for article in mission.get('articles', ())])
+            for table, key in (('articles', 'id'), ('trucks', 'id'), ('missions', 'mission_id')):
+                ids = deleted.get(table, ())
+                self._conn.executemany(f"DELETE FROM {table} WHERE {key} = ?", [(i,) for i in ids])
+                count += len(ids)
+            if 'version' in changes:
+                self._conn.execute("INSERT INTO sync_state (name, value) VALUES ('version', ?) "
+                                   "ON CONFLICT (name) DO UPDATE SET value = excluded.value", (changes['version'],))
+        return count
+
+    def _upsert(self, table, columns, rows):
+        if not rows:
+            return 0
+        names = ", ".join(columns)
+        marks = ", ".join("?" for _ in columns)
+        updates = ", ".join(f"{c} = excluded.{c}" for c in columns[1:])
+        self._conn.executemany(f"INSERT INTO {table} ({names}) VALUES ({marks}) "
+                               f"ON CONFLICT ({columns[0]}) DO UPDATE SET {updates}",
+                               [tuple(row.get(c) for c in columns) for row in rows])
+        return len(rows)
+
+    def articles(self):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute("SELECT * FROM articles ORDER BY id")]
+
+    def trucks(self):
+        with self._lock:
+            return [dict(row) for row in self._conn.execute("SELECT * FROM trucks ORDER BY id")]
+
+    def missions(self, destination=None):
+        """Missions (all, or for one destination) with their 'articles' manifest"""
+        where, args = ("WHERE m.destination = ?", (destination,)) if destination is not None else ("", ())
+        with self._lock:
+            missions = {row['mission_id']: dict(row, articles=[])
+                        for row in self._conn.execute(f"SELECT * FROM missions m {where} ORDER BY mission_id", args)}
+            for row in self._conn.execute("SELECT a.mission_id, a.code, a.quantity FROM mission_articles a "
+                                          f"JOIN missions m USING (mission_id) {where} ORDER BY a.rowid", args):
+                mission = missions.get(row['mission_id'])
+                if mission is not None:
+                    mission['articles'].append({'code': row['code'], 'quantity': row['quantity']})
+        return list(missions.values())
+
+    def extend_dictionary(self):
+        """Append the names of the stored rows to the dictionary; returns the number of entries added.
+
+        Only for a station without a mission API, which is then its own
+        dictionary authority; otherwise the entries come with the sync.
+        """
+        with self._lock, self._conn:
+            entries = [tuple(row) for row in self._conn.execute("SELECT kind, name, id FROM dictionary ORDER BY seq")]
+            articles = [dict(row) for row in self._conn.execute("SELECT * FROM articles")]
+            trucks = [dict(row) for row in self._conn.execute("SELECT * FROM trucks")]
+            missions = [dict(row) for row in self._conn.execute("SELECT * FROM missions")]
+            added = dictionary_additions(entries, articles, trucks, missions)
+            self._conn.executemany("INSERT INTO dictionary (kind, name, id) VALUES (?, ?, ?)", added)
+        if added:
+            log.info("Dictionary: %d entries (%d new)", len(entries) + len(added), len(added))
+        return len(added)
+
+    def dictionary(self):
+        """Dictionary entries (kind, name, id) in the order they were appended"""
+        with self._lock:
+            return [tuple(row) for row in self._conn.execute("SELECT kind, name, id FROM dictionary ORDER BY seq")]
+
+    def set_status(self, mission_id, status):
+        """Local status change (a delivery), until the next sync reports the backend's"""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE missions SET status = ? WHERE mission_id = ?", (status, mission_id))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
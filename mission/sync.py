@@ -0,0 +1,87 @@
+import json
+import logging
+import threading
+import urllib.parse
+import urllib.request
+
+log = logging.getLogger(__name__)
+
+# Seconds between two background syncs
+SYNC_INTERVAL = 60
+
+# HTTP timeout of one sync request
+SYNC_TIMEOUT = 10
+
+
+class SyncClient:
+    def __init__(self, base_url, timeout=SYNC_TIMEOUT):
+        """Delta-sync client of the mission API.
+
+        GET <base_url>/sync?since=<version> answers with the rows changed
+        after that version: {"version", "full", "articles", "trucks",
+        "missions", "deleted": {table: [ids]}, "more"}. "full" marks a
+        complete snapshot (since=0, or a version the server no longer
+        has); "more" asks for another page.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def fetch(self, since):
+        query = urllib.parse.urlencode({'since': since})
+        with urllib.request.urlopen(f"{self.base_url}/sync?{query}", timeout=self.timeout) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def sync(self, store):
+        """Pull every change since the store's version; returns the number of rows changed"""
+        changed = 0
+        while True:
+            since = store.version()
+            changes = self.fetch(since)
+            changed += store.apply(changes, full=changes.get('full', False))
+            log.debug("Synced %d rows from version %d to %s", changed, since, changes.get('version'))
+            if not changes.get('more'):
+                return changed
+
+
+class BackgroundSync:
+    def __init__(self, store, client, interval=SYNC_INTERVAL, on_change=None):
+        """Runs client.sync(store) every `interval` seconds in a daemon thread.
+
+        `on_change()` is called from that thread after a sync that changed
+        something. Errors (the API unreachable) are logged and the station
+        keeps working from the local store until the next attempt.
+        """
+        self.store = store
+        self.client = client
+        self.interval = interval
+        self.on_change = on_change
+        self.last_error = None
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="mission-sync", daemon=True)
+            self._thread.start()
+        return self
+
+    def refresh(self):
+        """Sync now instead of waiting for the interval"""
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.client.sync(self.store) and self.on_change is not None:
+                    self.on_change()
+                self.last_error = None
+            except (OSError, ValueError) as e:
+                self.last_error = e
+                log.warning("Mission sync failed, working offline: %s", e)
+            self._wake.wait(self.interval)
+            self._wake.clear()
@@ -0,0 +1,651 @@
+# station.py
+
+from desfire_ev1.applications import ApplicationManager, APP_KEYS_DES, APP_KEYS_AES, APP_KEYS_3K3DES
+from desfire_ev1.files import FileManager, FILE_BACKUP, COMM_PLAIN, COMM_MAC, COMM_ENCRYPTED
+from desfire_ev1.crypto import KEY_DES, KEY_3DES, KEY_AES
+from desfire_ev1.keys import StaticKeys, KeyDiversifier, MASTER_APP_ID
+from desfire_ev1.provisioning import Provisioner, CREATED, RECREATED, FAILED
+from desfire_ev1.shadow import DiffWriter
+from desfire_ev1.inventory import CardInventory
+from desfire_ev1.exceptions import StorageError, AuthenticationError, IntegrityError
+from desfire_ev1.segments import SegmentedReader, framed_spans
+from desfire_ev1.journal import ProvisioningJournal, JOURNAL_CHUNK
+from desfire_ev1.tuning import ReaderProfile, ReaderProfiles, probe_reader
+from mission.layout import (LAYOUTS, ALL_LAYOUTS, LAYOUT_V3_COMPACT, LEGACY_LENGTH_SIZE, MISSION_HEAD_SIZE,
+                            layout_from_marker)
+from mission.encoding import MissionDictionary, decode_mission
+from mission.events import DeliveryJournal
+from mission.ids import MissionIdAllocator, LocalIdSource, HttpIdSource
+from mission.mock_api import SAMPLE_ARTICLES, SAMPLE_TRUCKS, SAMPLE_MISSIONS
+from mission.store import MissionStore
+from mission.digest import DIGEST_SIZE, MIN_KEY_SIZE, digests_match
+from desfire_ev1.desfire_ev1_card import DesfireCard
+from desfire_ev1.metrics import default_metrics
+from desfire_ev1.profiler import profiler
+from desfire_ev1.log import configure as configure_logging, LazyHex
+from contextlib import contextmanager
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger("station")
+
+
+def configure_station():
+    """Process-wide setup from the environment: logging, metrics endpoint and profiler"""
+    default_metrics.station = os.environ.get("DESFIRE_STATION")
+    if os.environ.get("DESFIRE_METRICS_PORT"):
+        default_metrics.serve(int(os.environ["DESFIRE_METRICS_PORT"]))
+    # Levelled logging (DESFIRE_LOG_LEVEL) and optional APDU ring buffer (DESFIRE_APDU_RING=<size>)
+    configure_logging()
+    # Opt-in session profiler: DESFIRE_TRACE=<path> writes a Chrome trace per session
+    if os.environ.get("DESFIRE_TRACE"):
+        profiler.enable()
+
+
+class CardStation:
+    def __init__(self, reader_index=0, **kwargs):
+        """Issues and reads mission cards on one reader, without any UI.
+        
+        Holds the card managers of the reader, the keys, the card layout
+        and its storage plans; the window and the batch issuer are built
+        on it. Keyword arguments go to the next class in the MRO.
+        """
+        super().__init__(**kwargs)
+        
+        # Card metrics (textfile export with DESFIRE_METRICS_FILE) and session traces (DESFIRE_TRACE)
+        self.metrics = default_metrics
+        self.metrics_file = os.environ.get("DESFIRE_METRICS_FILE")
+        self.trace_file = os.environ.get("DESFIRE_TRACE")
+
+        # Initialize app file card managers
+        self.desfireCardManager = DesfireCard(reader_index, metrics=self.metrics)
+        if os.environ.get("DESFIRE_APDU_RING"):
+            self.desfireCardManager.enable_apdu_ring(int(os.environ["DESFIRE_APDU_RING"]))
+        self.applicationManager = ApplicationManager(self.desfireCardManager)
+        self.fileManager = FileManager(self.desfireCardManager)
+        # Applications/files/settings of each card, cached by UID so repeat taps skip discovery
+        self.inventory = CardInventory(self.desfireCardManager, self.applicationManager, self.fileManager)
+        self.provisioner = Provisioner(self.desfireCardManager, self.applicationManager, self.fileManager,
+                                       inventory=self.inventory)
+        # Standard files are rewritten as diffs against the last known contents of each card
+        self.card_writer = DiffWriter(self.fileManager)
+        # Mission and photo carry a CRC per segment; a corrupted segment is read again on its own
+        self.segment_reader = SegmentedReader(self.fileManager)
+        # Completed issuing steps per card (DESFIRE_JOURNAL=<path> keeps them across restarts)
+        self.journal = ProvisioningJournal(os.environ.get("DESFIRE_JOURNAL"))
+        self.mission_payload = None
+        
+        # key numbers
+        self.key_number_zero = [0x00]
+        self.master_key_value = bytes([0x00] * 8)
+        
+        # Key type/value of the mission applications and communication mode of their files.
+        # MACed or enciphered files need EV1 keys (KEY_AES with a 16-byte key, or KEY_3DES).
+        self.app_key_type = KEY_DES
+        self.app_key_value = self.master_key_value
+        self.comm_mode = COMM_PLAIN
+        
+        # Frame and chunk sizes of this reader, probed on its first card and cached by reader name
+        # (DESFIRE_READER_PROFILES=<path>); the defaults are used until then
+        self.reader_profiles = ReaderProfiles(os.environ.get("DESFIRE_READER_PROFILES", "reader_profiles.json"))
+        self.write_chunk = JOURNAL_CHUNK
+        self.reader_profile = self.reader_profiles.get(self.desfireCardManager.reader)
+        if self.reader_profile is not None:
+            self.apply_reader_profile(self.reader_profile)
+        
+        # Application keys: the same static key on every card, or per-card keys derived
+        # from the UID when DESFIRE_DIVERSIFY_KEY=<hex master key> is set
+        self.static_keys = StaticKeys(self.app_key_value)
+        diversify_key = os.environ.get("DESFIRE_DIVERSIFY_KEY")
+        if diversify_key:
+            self.key_provider = KeyDiversifier(bytes.fromhex(diversify_key), self.app_key_type)
+        else:
+            self.key_provider = self.static_keys
+        self.card_uid = None
+        
+        # Key of the mission digest stored on each card (DESFIRE_DIGEST_KEY=<hex>), shared by all stations
+        self.digest_key = bytes.fromhex(os.environ.get("DESFIRE_DIGEST_KEY", ""))
+        if len(self.digest_key) < MIN_KEY_SIZE:
+            log.warning("DESFIRE_DIGEST_KEY is unset or shorter than %d bytes: the articles of every card are read",
+                        MIN_KEY_SIZE)
+        
+        # Card layout used when issuing: the original three applications, or with
+        # DESFIRE_LAYOUT=2 one application holding every file (=3: with CRCs). Readers detect the layout.
+        self.issue_layout = LAYOUTS[int(os.environ.get("DESFIRE_LAYOUT", "1"))]
+        # DESFIRE_ENCODING=compact: dictionary-coded mission and articles in one file (implies layout v3)
+        if os.environ.get("DESFIRE_ENCODING") == "compact":
+            self.issue_layout = LAYOUT_V3_COMPACT
+        
+        # Logical sizes of the card files
+        self.driver_file_size = 20
+        self.driver_pic_file_size = 1200
+        self.mission_file_size = 57
+        self.article_record_size = 8
+        self.article_number = 50
+        
+        # Block-aligned plan per layout, checked against the card memory before anything is written
+        self.storage_plans = {}
+        for layout in ALL_LAYOUTS:
+            self.storage_plans[layout] = layout.plan(self.driver_file_size, self.driver_pic_file_size,
+                                                     self.mission_file_size, self.article_record_size,
+                                                     self.article_number)
+            self.storage_plans[layout].check()
+        self.apply_layout(self.issue_layout)
+        
+        # Mission store, event journal, compact-encoding dictionary and mission IDs (open_missions)
+        self.api_url = os.environ.get("DESFIRE_API_URL")
+        self.store = None
+        self.delivery_journal = None
+        self.mission_dictionary = MissionDictionary()
+        self.id_allocator = None
+        # Expected mission digests, set by the owner
+        self.card_articles = []
+        self.expected_digests = {}
+    
+    def open_missions(self):
+        """Open the mission store, the event journal, the dictionary and the mission ID allocator.
+        
+        The store (DESFIRE_STORE=<path>) is a local copy of the articles,
+        trucks and missions, seeded with the sample rows the mock API
+        serves when there is no DESFIRE_API_URL. Issued missions and gate
+        decisions are journaled in DESFIRE_EVENTS=<path>. Mission IDs come
+        from blocks reserved ahead from the API (or a local counter) and
+        kept in DESFIRE_IDS=<path>.
+        """
+        self.store = MissionStore(os.environ.get("DESFIRE_STORE", "mission_store.db"))
+        if not self.api_url and self.store.empty():
+            self.store.apply({'articles': SAMPLE_ARTICLES, 'trucks': SAMPLE_TRUCKS, 'missions': SAMPLE_MISSIONS})
+        self.delivery_journal = DeliveryJournal(os.environ.get("DESFIRE_EVENTS", "delivery_events.db"))
+        # Name <-> ID dictionary for the compact encoding: synced from the API, or kept by this station without one
+        if not self.api_url:
+            self.store.extend_dictionary()
+        self.mission_dictionary = MissionDictionary(self.store.dictionary())
+        ids_path = os.environ.get("DESFIRE_IDS", "mission_ids.db")
+        if self.api_url:
+            id_source = HttpIdSource(self.api_url)
+        else:
+            id_source = LocalIdSource(ids_path, start=len(SAMPLE_MISSIONS) + 1)
+        self.id_allocator = MissionIdAllocator(id_source, ids_path)
+    
+    def close_missions(self):
+        self.store.close()
+        self.delivery_journal.close()
+    
+    def issue_card(self, uid, staged):
+        """Write a staged card to the card `uid`; False if it must be presented again"""
+        with self.session("issue_card", "source"):
+            self.apply_layout(staged.layout)
+            # Another station may have written the card since its shadow was taken
+            self.card_writer.shadow.uncheck(uid)
+            # A card torn away during a previous attempt with the same data resumes after its last step
+            done = self.journal.start(uid, staged.job)
+            if done:
+                log.info("Resuming card %s after: %s", LazyHex(uid), ", ".join(done))
+            try:
+                if not self.issue_steps(uid, staged):
+                    return False
+            except Exception as e:
+                # Most likely the card left the field: the journal keeps what was done
+                log.exception("Card issue interrupted, present the card again to resume: %s", e)
+                self.card_writer.shadow.forget(uid)
+                return False
+            self.journal.finish(uid)
+            self.register_issued(staged)
+            return True
+    
+    def register_issued(self, staged):
+        """Make an issued mission known: in the local store at once, upstream through the event journal"""
+        record = staged.record
+        if record is None:
+            return
+        if self.store is not None:
+            self.store.apply({'missions': [record]})
+        if self.delivery_journal is not None:
+            self.delivery_journal.record("issued", record['mission_id'], record['destination'],
+                                         truck_id=record['truck_id'], source=record['source'],
+                                         articles=record['articles'])
+    
+    def issue_steps(self, uid, staged):
+        """Write a staged card step by step, skipping the steps the journal says are done.
+        
+        The mission and its digest come last: they are what makes the card
+        valid, and where the layout has backup data files they are
+        committed together.
+        """
+        journal = self.journal
+        # Reuse whatever a previous issue left on the card instead of failing on duplicates
+        self.provisioner.load_applications(uid)
+        if not journal.is_done(uid, "applications"):
+            existing = {aid: set(files) for aid, files in (self.inventory.get(uid) or {}).items()}
+            try:
+                free = self.storage_plan.check(self.desfireCardManager.get_free_memory(), existing)
+            except StorageError as e:
+                log.error("Card memory: %s", e)
+                return False
+            log.info("Free memory after issuing: %d bytes", free)
+            num_keys = 0x01 | self.app_key_flags()
+            for aid in self.card_layout.applications():
+                if self.provisioner.ensure_application(aid, num_keys=num_keys) == FAILED:
+                    log.error("Cannot create application %s", LazyHex(aid))
+                    return False
+            journal.done(uid, "applications")
+
+        if not journal.is_done(uid, "driver"):
+            self.select_and_authenticate(self.driver_app_id)
+            self.ensure_standard_file(uid, self.driver_app_id, self.driver_file_id, len(staged.driver))
+            if not self.write_driver_infos(staged.driver):
+                log.error("Cannot write the driver info")
+                return False
+            journal.done(uid, "driver")
+            log.debug("Wrote Driver Info")
+
+        if not journal.is_done(uid, "photo"):
+            self.select_and_authenticate(self.driver_pic_app_id)
+            # An older, smaller photo file is kept as long as this photo fits in it
+            self.ensure_standard_file(uid, self.driver_pic_app_id, self.driver_pic_file_id, len(staged.photo))
+            if self.reader_profile is None and self.comm_mode == COMM_PLAIN and not journal.offset(uid, "photo"):
+                # First card on this reader: probe it on the photo file, which is written next anyway
+                self.tune_reader(uid)
+                # The probe ends on a refused frame, which resets the authentication on the card
+                self.desfireCardManager.session = None
+                if not self.select_and_authenticate(self.driver_pic_app_id):
+                    log.error("Cannot authenticate again after probing the reader")
+                    return False
+            if self.write_compressed_image(staged.photo) is None:
+                log.error("Cannot write the driver photo")
+                return False
+            journal.done(uid, "photo")
+
+        if not self.card_layout.compact and not journal.is_done(uid, "articles"):
+            # Articles (an existing record file is cleared rather than recreated)
+            self.select_and_authenticate(self.article_app_id)
+            written = 0
+            if journal.offset(uid, "articles"):
+                # Interrupted: every record the card holds was committed, carry on after them
+                settings = self.fileManager.get_file_settings(self.article_file_id)
+                written = settings['current_records'] if settings else 0
+            if not written:
+                planned = self.storage_plan.file(self.article_app_id, self.article_file_id)
+                self.provisioner.ensure_record_file(self.article_file_id, self.article_record_size,
+                                                    planned['max_records'], comm_settings=self.records_comm_mode(),
+                                                    min_records=planned['min_records'])
+            for record in staged.records[written:]:
+                if not self.write_article(record):
+                    log.error("Cannot write article record %d", written)
+                    return False
+                written += 1
+                journal.progress(uid, "articles", written)
+            self.inventory.invalidate(uid, self.article_app_id, self.article_file_id)
+            journal.done(uid, "articles")
+
+        if not journal.is_done(uid, "mission"):
+            self.select_and_authenticate(self.mission_app_id)
+            self.ensure_standard_file(uid, self.mission_app_id, self.mission_file_id, len(staged.mission))
+            self.ensure_standard_file(uid, self.digest_app_id, self.digest_file_id, DIGEST_SIZE)
+            ok = self.write_mission_information(staged.mission) and self.write_mission_digest(staged.digest)
+            if self.card_layout.backup:
+                # Backup data files: nothing takes effect until this commit
+                ok = ok and self.fileManager.commit_transaction()
+            if not ok:
+                log.error("Cannot write the mission")
+                if self.card_layout.backup:
+                    self.fileManager.abort_transaction()
+                self.card_writer.shadow.forget(uid, self.mission_app_id)
+                return False
+            journal.done(uid, "mission")
+            log.debug("Wrote Mission info")
+        return True
+    
+    # === Helper functions ===
+    
+    def app_key_flags(self):
+        """Crypto method flag for create_application matching app_key_type"""
+        return {KEY_DES: APP_KEYS_DES, KEY_3DES: APP_KEYS_3K3DES if len(self.app_key_value) == 24 else APP_KEYS_DES,
+                KEY_AES: APP_KEYS_AES}[self.app_key_type]
+    
+    def records_comm_mode(self):
+        """Comm mode of the article record file.
+        
+        Reading "all records" (count 0) cannot be enciphered because the CRC
+        position is unknown, so the record file is MACed instead.
+        """
+        return COMM_MAC if self.comm_mode == COMM_ENCRYPTED else self.comm_mode
+    
+    def apply_layout(self, layout):
+        """Point the application and file IDs at a card layout"""
+        self.card_layout = layout
+        self.driver_app_id, self.driver_file_id = layout.driver
+        self.driver_pic_app_id, self.driver_pic_file_id = layout.photo
+        self.mission_app_id, self.mission_file_id = layout.mission
+        self.article_app_id, self.article_file_id = layout.articles
+        self.digest_app_id, self.digest_file_id = layout.digest
+        self.storage_plan = self.storage_plans[layout]
+    
+    def authenticate_master(self):
+        """Select the PICC level and authenticate with the card master key (diversified when keys are)"""
+        card = self.desfireCardManager
+        card.select_application(MASTER_APP_ID)
+        if self.key_provider.needs_uid:
+            key = self.key_provider.key_for(self.diversification_uid(), MASTER_APP_ID, self.key_number_zero[0])
+            if card.authenticate_key(self.key_number_zero, key, self.key_provider.key_type):
+                return True
+            # Not rolled yet: the card still has the static master key
+            log.info("Diversified master key refused, trying the static one")
+            card.select_application(MASTER_APP_ID)
+        return card.authenticate(self.key_number_zero, self.master_key_value)
+    
+    def current_uid(self):
+        """UID of the card in the field, read once per session"""
+        if self.card_uid is None:
+            self.card_uid = self.desfireCardManager.get_uid()
+        return self.card_uid
+    
+    def diversification_uid(self):
+        """UID to derive the card keys from; AuthenticationError if it cannot be read"""
+        uid = self.current_uid()
+        if uid is None:
+            raise AuthenticationError("Cannot read the card UID: diversified keys cannot be derived")
+        return uid
+    
+    def new_card(self):
+        """Reconnect after a card swap; UID of the card now on the reader"""
+        self.desfireCardManager.reconnect()
+        self.card_uid = None
+        return self.current_uid()
+    
+    def ensure_standard_file(self, uid, aid, file_id, min_size):
+        """Provision a standard (or backup data) file at its planned size; a new file is known to be all zeros"""
+        planned = self.storage_plan.file(aid, file_id)
+        status = self.provisioner.ensure_standard_file(file_id, planned['size'], comm_settings=self.comm_mode,
+                                                       min_size=min_size,
+                                                       backup=planned['file_type'] == FILE_BACKUP)
+        if status in (CREATED, RECREATED):
+            self.card_writer.shadow.set(uid, aid, file_id, bytes(planned['size']))
+        return status
+    
+    def select_and_authenticate(self, aid):
+        """Select a mission application and authenticate with key 0"""
+        card = self.desfireCardManager
+        if aid == card.selected_aid and card.session is not None and card.session.valid:
+            # Still authenticated: layout v2 needs a single select + authenticate per tap
+            return True
+        uid = self.diversification_uid() if self.key_provider.needs_uid else self.card_uid
+        key = self.key_provider.key_for(uid, aid, self.key_number_zero[0])
+        self.desfireCardManager.select_application(aid)
+        self.provisioner.application_selected(aid)
+        return self.desfireCardManager.authenticate_key(self.key_number_zero, key, self.app_key_type)
+    
+    def apply_reader_profile(self, profile):
+        """Send frames and journal chunks of the sizes measured for this reader.
+        
+        Profiles are probed with plain frames: in a MACed or enciphered mode
+        the default sizes are kept.
+        """
+        self.reader_profile = profile
+        if self.comm_mode != COMM_PLAIN:
+            log.info("Reader profile of %s left out in comm mode %d", profile.reader, self.comm_mode)
+            return
+        self.fileManager.max_frame_data = profile.max_frame_data
+        self.write_chunk = profile.chunk_size
+    
+    def tune_reader(self, uid):
+        """Probe the reader with test writes to the photo file (its application selected) and cache the profile"""
+        planned = self.storage_plan.file(self.driver_pic_app_id, self.driver_pic_file_id)
+        profile = probe_reader(self.desfireCardManager, self.fileManager, self.driver_pic_file_id, planned['size'])
+        # The test data replaced whatever the file held
+        self.card_writer.shadow.forget(uid, self.driver_pic_app_id, self.driver_pic_file_id)
+        if profile is None:
+            # Keep the defaults for this session; the reader is probed again after a restart
+            log.warning("Cannot probe reader %s: keeping %d-byte frames", self.desfireCardManager.reader,
+                        self.fileManager.max_frame_data)
+            self.reader_profile = ReaderProfile(str(self.desfireCardManager.reader), self.fileManager.max_frame_data,
+                                                0.0, self.write_chunk)
+            return None
+        self.reader_profiles.put(profile)
+        self.apply_reader_profile(profile)
+        return profile
+    
+    @contextmanager
+    def session(self, name, label):
+        """Profile a card session as one root span, then export the metrics and its trace once the span is closed"""
+        try:
+            with profiler.span(name, "session"):
+                yield
+        finally:
+            self.export_metrics()
+            self.export_trace(label)
+    
+    def export_metrics(self):
+        """Write the Prometheus textfile if DESFIRE_METRICS_FILE is set"""
+        if self.metrics_file:
+            self.metrics.write_prometheus(self.metrics_file)
+    
+    def export_trace(self, session):
+        """Write the recorded spans of one session when DESFIRE_TRACE is set"""
+        if self.trace_file:
+            root, ext = os.path.splitext(self.trace_file)
+            profiler.write(f"{root}-{session}-{int(time.time())}{ext or '.json'}")
+            profiler.clear()
+    
+    def write_driver_infos(self, byte_data):
+        """Write driver information (name then license, staged) to card"""
+        return self.card_writer.write(self.current_uid(), self.driver_app_id, self.driver_file_id, 0, byte_data,
+                               comm_mode=self.comm_mode, file_size=len(byte_data))
+        
+    @profiler.profiled("read_driver_info", "card")
+    def read_driver_info(self):
+        """Read driver info from card"""
+        if self.card_layout.sealed:
+            data = self.segment_reader.read(self.driver_file_id, 0, self.driver_file_size, comm_mode=self.comm_mode)
+        else:
+            data = self.fileManager.read_data(self.driver_file_id, 0, self.driver_file_size, comm_mode=self.comm_mode)
+        info_str = bytes(data).decode('utf-8').strip()
+        # Assume format: first 10 chars = name, rest = license
+        name = info_str[:10].strip()
+        license = info_str[10:].strip()
+        return {'name': name, 'license': license}
+
+    @profiler.profiled("write_compressed_image", "card")
+    def write_compressed_image(self, payload):
+        """Write the staged photo file contents to card; returns its length, None on failure"""
+        uid = self.current_uid()
+        
+        # Only the bytes that differ from the photo already on the card are sent, a chunk (sized
+        # for this reader) at a time so an interrupted write resumes from the journal's offset.
+        # A framed photo in the shadow is checked against the card by its header and CRC table
+        for offset in range(self.journal.offset(uid, "photo"), len(payload), self.write_chunk):
+            chunk = payload[offset:offset + self.write_chunk]
+            if not self.card_writer.write(uid, self.driver_pic_app_id, self.driver_pic_file_id, offset, chunk,
+                                          comm_mode=self.comm_mode, file_size=self.driver_pic_file_size,
+                                          check=framed_spans):
+                return None
+            self.journal.progress(uid, "photo", offset + len(chunk))
+        return len(payload)
+    
+    @profiler.profiled("read_compressed_image", "card")
+    def read_compressed_image(self):
+        """Read compressed image from card"""
+        if not self.card_layout.sealed:
+            return self.read_legacy_image()
+        # The frame header gives the length: one chained read, corrupted segments re-read alone
+        payload = self.segment_reader.read_framed(self.driver_pic_file_id, 0, comm_mode=self.comm_mode)
+        meta_len = payload[0] | (payload[1] << 8) | (payload[2] << 16) | (payload[3] << 24)
+        
+        with profiler.span("parse_photo_meta", "json"):
+            meta = json.loads(payload[4:4 + meta_len].decode('utf-8'))
+        
+        data_offset = 4 + meta_len
+        data_length = meta.get('data_length', len(payload) - data_offset)
+        return payload[data_offset:data_offset + data_length], meta
+
+    def read_legacy_image(self):
+        """Read the photo of a layout without CRCs: metadata length, metadata, then the image"""
+        header = self.fileManager.read_data(self.driver_pic_file_id, offset=0, length=4, comm_mode=self.comm_mode)
+        meta_len = header[0] | (header[1] << 8) | (header[2] << 16) | (header[3] << 24)
+        
+        meta_bytes = self.fileManager.read_data(self.driver_pic_file_id, offset=4, length=meta_len,
+                                                comm_mode=self.comm_mode)
+        with profiler.span("parse_photo_meta", "json"):
+            meta = json.loads(bytes(meta_bytes).decode('utf-8'))
+        
+        data_offset = 4 + meta_len
+        # Size the read from the metadata, else from the file size the inventory knows
+        file_size = self.inventory.file_size(self.current_uid(), self.driver_pic_app_id, self.driver_pic_file_id,
+                                             default=data_offset + 994)
+        data_length = meta.get('data_length', file_size - data_offset)
+        data = self.fileManager.read_data(self.driver_pic_file_id, offset=data_offset, length=data_length,
+                                          comm_mode=self.comm_mode)
+        return bytes(data), meta
+
+    @profiler.profiled("write_mission_information", "card")
+    def write_mission_information(self, complete_data):
+        """Write the staged mission file contents to card"""
+        log.debug("Complete data length: %d bytes", len(complete_data))
+        
+        log.debug("Mission data: %s", LazyHex(complete_data))
+        
+        # Long writes are chained into frames by FileManager; unchanged bytes are skipped
+        ok = self.card_writer.write(self.current_uid(), self.mission_app_id, self.mission_file_id, 0, complete_data,
+                                    comm_mode=self.comm_mode, file_size=len(complete_data))
+        log.debug("Mission written (%d bytes) - %s", len(complete_data), ok)
+        return ok
+
+    def write_mission_digest(self, digest):
+        """Write the mission digest (the mission's application must be selected)"""
+        return self.fileManager.write_data(self.digest_file_id, 0, list(digest), comm_mode=self.comm_mode)
+    
+    def verified_mission(self, mission_id):
+        """Expected mission record whose digest the card carries, else None.
+        
+        One short read of the digest file replaces reading and decoding
+        the articles; cards without a digest file read as a mismatch.
+        Without a digest key anyone could forge the digest, so the articles
+        are always read.
+        """
+        if len(self.digest_key) < MIN_KEY_SIZE:
+            return None
+        expected = self.expected_digests.get(mission_id)
+        if expected is None:
+            return None
+        card_digest = self.fileManager.read_data(self.digest_file_id, 0, DIGEST_SIZE, comm_mode=self.comm_mode)
+        if not digests_match(card_digest, expected[0]):
+            log.info("Digest of mission %s does not match: reading the articles", mission_id)
+            return None
+        return expected[1]
+    
+    def update_mission_status(self, new_status):
+        """Update mission status and, in v3, the CRC of its segment (the mission must have been read)"""
+        offset = self.card_layout.mission_offset
+        if self.card_layout.sealed:
+            payload = self.segment_reader.patch(self.mission_file_id, offset, self.mission_payload,
+                                                self.card_layout.status_offset - offset, [new_status],
+                                                comm_mode=self.comm_mode)
+        elif self.fileManager.write_data(self.mission_file_id, self.card_layout.status_offset, [new_status],
+                                         comm_mode=self.comm_mode):
+            payload = bytearray(self.mission_payload)
+            payload[self.card_layout.status_offset - offset] = new_status
+            payload = bytes(payload)
+        else:
+            payload = None
+        if "mission" in self.card_layout.backup and payload is not None:
+            # Backup data file: the new status takes effect on commit
+            if not self.fileManager.commit_transaction():
+                payload = None
+        if payload is None:
+            log.error("Cannot update the mission status")
+            return False
+        self.mission_payload = payload
+        log.debug("Status updated to: %s", new_status)
+        return True
+
+    @profiler.profiled("read_mission", "card")
+    def read_mission(self):
+        """Read mission data from card"""
+        if self.card_layout.version >= 2:
+            # Up to one frame's worth first (never past the end of the file): the marker says which encoding follows
+            file_size = self.inventory.file_size(self.current_uid(), self.mission_app_id, self.mission_file_id,
+                                                 default=MISSION_HEAD_SIZE)
+            head = bytes(self.fileManager.read_data(self.mission_file_id, 0,
+                                                    min(self.fileManager.max_frame_data, file_size),
+                                                    comm_mode=self.comm_mode))
+            self.apply_layout(layout_from_marker(head))
+        else:
+            head = b""
+        # In v3 every segment is CRC-checked; what the first read already holds is not read again
+        if self.card_layout.sealed and self.card_layout.compact:
+            data = self.segment_reader.read_framed(self.mission_file_id, len(self.card_layout.marker),
+                                                   comm_mode=self.comm_mode, head=head)
+        elif self.card_layout.sealed:
+            data = self.segment_reader.read(self.mission_file_id, self.card_layout.mission_offset,
+                                            self.mission_file_size, comm_mode=self.comm_mode, head=head)
+        else:
+            data = self.read_legacy_mission(head)
+        self.mission_payload = data
+        
+        status_names = {0: "Pending", 1: "In Transit", 2: "Delivered"}
+        
+        if self.card_layout.compact:
+            mission, self.card_articles = decode_mission(data, self.mission_dictionary)
+            mission['status'] = status_names.get(mission['status'], 'Unknown')
+            return mission
+        
+        mission_id = bytes(data[0:8]).decode('utf-8').strip()
+        truck_id = bytes(data[8:16]).decode('utf-8').strip()
+        status = data[16]
+        source = bytes(data[17:37]).decode('utf-8').strip()
+        destination = bytes(data[37:57]).decode('utf-8').strip()
+        
+        return {
+            'mission_id': mission_id,
+            'truck_id': truck_id,
+            'status': status_names.get(status, 'Unknown'),
+            'source': source,
+            'destination': destination
+        }
+    
+    def read_legacy_mission(self, head):
+        """Mission data of a layout without CRCs, `head` holding the start of the mission file"""
+        offset = self.card_layout.mission_offset
+        if self.card_layout.compact:
+            length_at = offset - LEGACY_LENGTH_SIZE
+            total = offset + int.from_bytes(head[length_at:offset], 'little')
+        else:
+            total = offset + self.mission_file_size
+        data = bytes(head[:total])
+        if len(data) < total:
+            data += bytes(self.fileManager.read_data(self.mission_file_id, len(data), total - len(data),
+                                                     comm_mode=self.comm_mode))
+        if len(data) != total:
+            raise IntegrityError(f"Short read of the mission file: {len(data)} of {total} bytes")
+        self.card_layout.check_marker(data)
+        return data[offset:]
+
+    def write_article(self, record_data):
+        """Write a staged article record and commit it; False on failure (nothing is committed)"""
+        if not self.fileManager.write_record(self.article_file_id, 0, list(record_data),
+                                             comm_mode=self.records_comm_mode()):
+            self.fileManager.abort_transaction()
+            return False
+        return self.fileManager.commit_transaction()
+        
+    @profiler.profiled("read_all_articles", "card")
+    def read_all_articles(self):
+        """Read all articles from card"""
+        if self.card_layout.compact:
+            # Decoded along with the mission file by read_mission
+            return self.card_articles
+        from desfire_ev1.utils import from_4bytes
+        data = self.fileManager.read_records(self.article_file_id, 0, 0, comm_mode=self.records_comm_mode())
+        
+        articles = []
+        for i in range(0, len(data), self.article_record_size):
+            if i + self.article_record_size <= len(data):
+                record = data[i:i+self.article_record_size]
+                code = bytes(record[0:4]).decode('utf-8').strip()
+                quantity = from_4bytes(record[4:8])
+                articles.append({'code': code, 'quantity': quantity})
+        
+        return articles
+
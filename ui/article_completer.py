@@ -0,0 +1,33 @@
+# article_completer.py
+
+from PyQt5.QtWidgets import QCompleter
+from PyQt5.QtCore import Qt, QStringListModel
+from mission.catalog import SEARCH_LIMIT
+
+
+class ArticleCompleter(QCompleter):
+    def __init__(self, index, limit=SEARCH_LIMIT, parent=None):
+        """Completer fed by an ArticleIndex one keystroke at a time.
+
+        Its model only ever holds the top `limit` matches of the current
+        text, asked from the index on each edit; the completer shows them
+        unfiltered, so it never walks the whole catalog.
+        """
+        super().__init__(parent)
+        self.index = index
+        self.limit = limit
+        self.setModel(QStringListModel(self))
+        self.setCompletionMode(QCompleter.UnfilteredPopupCompletion)
+        self.setCaseSensitivity(Qt.CaseInsensitive)
+
+    def attach(self, line_edit):
+        line_edit.setCompleter(self)
+        # textEdited is emitted before the line edit asks the completer to complete
+        line_edit.textEdited.connect(self.update_matches)
+
+    def set_index(self, index):
+        self.index = index
+        self.model().setStringList([])
+
+    def update_matches(self, text):
+        self.model().setStringList(self.index.search(text, self.limit))
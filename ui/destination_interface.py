@@ -2,27 +2,47 @@
 
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QPushButton, 
                              QLabel, QGroupBox, QFormLayout, 
-                             QTableWidget, QTableWidgetItem, QTextEdit,
+                             QTableView, QHeaderView, QTextEdit,
                              QMessageBox)
 from PyQt5.QtGui import QPixmap, QImage
 from PyQt5.QtCore import Qt, pyqtSignal
 from .pic_codec import CardImageCodec, HashManager
+from .table_models import RecordTableModel
+from desfire_ev1.profiler import profiler
+from desfire_ev1.files import COMM_PLAIN
+from desfire_ev1.segments import SegmentedReader
+from mission.layout import LAYOUT_V1
+from mission.index import MissionIndex
 import json
+import logging
 import numpy as np
 import cv2
 
+log = logging.getLogger(__name__)
+
 
 class DestinationInterface(QWidget):
     # Signal to go back to main interface
     back_clicked = pyqtSignal()
     card_validated = pyqtSignal(dict)  # Signal when card is successfully validated
 
-    def __init__(self, destination_point="djelfa", expected_missions=None, card_manager=None, file_manager=None):
+    def __init__(self, destination_point="djelfa", expected_missions=None, card_manager=None, file_manager=None,
+                 authenticate_app=None, comm_mode=COMM_PLAIN, card_layout=LAYOUT_V1):
         super().__init__()
         self.destination_point = destination_point
-        self.expected_missions = expected_missions if expected_missions else []
+        # Expected missions by (mission_id, destination); the table model is updated row by row
+        self.mission_index = MissionIndex(expected_missions or ())
+        self.missions_model = RecordTableModel([("Mission ID", 'mission_id'), ("Truck ID", 'truck_id'),
+                                                ("Source", 'source')], key=MissionIndex.key)
+        self.articles_model = RecordTableModel([("Article Code", 'code'), ("Quantity", 'quantity')])
+        self.delivery_error = None  # Set by the card_validated handler when a delivery is not recorded
         self.card_manager = card_manager  # Store card manager reference
         self.file_manager = file_manager  # Store file manager reference
+        # The photo is framed with a CRC per segment; corrupted segments are read again alone
+        self.segment_reader = SegmentedReader(file_manager) if file_manager is not None else None
+        self.authenticate_app = authenticate_app  # Callable(aid): select + authenticate
+        self.comm_mode = comm_mode  # Communication mode of the driver photo file
+        self.card_layout = card_layout  # Where the photo lives (set per tap after detection)
         self.image_processor = CardImageCodec()
         self.hashManager = HashManager()
         self.current_card_data = None
@@ -50,11 +70,7 @@ class DestinationInterface(QWidget):
         self.missions_box = QGroupBox("Expected Missions")
         missions_layout = QVBoxLayout()
         
-        self.missions_table = QTableWidget()
-        self.missions_table.setColumnCount(3)
-        self.missions_table.setHorizontalHeaderLabels(["Mission ID", "Truck ID", "Source"])
-        self.missions_table.horizontalHeader().setStretchLastSection(True)
-        self.missions_table.setEditTriggers(QTableWidget.NoEditTriggers)  # Read-only
+        self.missions_table = self.create_table_view(self.missions_model)
         
         missions_layout.addWidget(self.missions_table)
         self.missions_box.setLayout(missions_layout)
@@ -125,11 +141,7 @@ class DestinationInterface(QWidget):
         articles_label.setStyleSheet("font-weight: bold; font-size: 12px; margin-top: 10px;")
         card_info_layout.addWidget(articles_label)
         
-        self.articles_table = QTableWidget()
-        self.articles_table.setColumnCount(2)
-        self.articles_table.setHorizontalHeaderLabels(["Article Code", "Quantity"])
-        self.articles_table.horizontalHeader().setStretchLastSection(True)
-        self.articles_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.articles_table = self.create_table_view(self.articles_model)
         
         card_info_layout.addWidget(self.articles_table)
         
@@ -152,89 +164,99 @@ class DestinationInterface(QWidget):
         self.card_info_box.setLayout(card_info_layout)
         main_layout.addWidget(self.card_info_box)
         
+    def create_table_view(self, model):
+        """Read-only view of a model; fixed row heights so only the visible rows are measured"""
+        view = QTableView()
+        view.setModel(model)
+        view.horizontalHeader().setStretchLastSection(True)
+        view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        view.setEditTriggers(QTableView.NoEditTriggers)  # Read-only
+        view.setSelectionBehavior(QTableView.SelectRows)
+        return view
+    
     def load_expected_missions(self):
         """Load expected missions into the table"""
-        # Filter missions for this destination
-        filtered_missions = [
-            m for m in self.expected_missions 
-            if m.get('destination') == self.destination_point
-        ]
-        
-        self.missions_table.setRowCount(len(filtered_missions))
+        # Missions for this destination, straight from the index
+        filtered_missions = self.mission_index.for_destination(self.destination_point)
         
-        for row, mission in enumerate(filtered_missions):
-            self.missions_table.setItem(row, 0, QTableWidgetItem(mission.get('mission_id', '-')))
-            self.missions_table.setItem(row, 1, QTableWidgetItem(mission.get('truck_id', '-')))
-            self.missions_table.setItem(row, 2, QTableWidgetItem(mission.get('source', '-')))
+        self.missions_model.reset(filtered_missions)
         
-        print(f"Loaded {len(filtered_missions)} missions for {self.destination_point}")
+        log.debug("Loaded %d missions for %s", len(filtered_missions), self.destination_point)
+    
+    def show_mission_row(self, mission):
+        """Add the table row of a mission, or refresh it if it is shown"""
+        self.missions_model.put(mission)
+    
+    def hide_mission_row(self, key):
+        self.missions_model.remove(key)
+    
+    def add_mission(self, mission):
+        """A new expected mission"""
+        key = self.mission_index.add(mission)
+        if key[1] == self.destination_point:
+            self.show_mission_row(mission)
+    
+    def deliver_mission(self, mission_id):
+        """A mission was delivered here: it is no longer expected"""
+        self.mission_index.deliver(mission_id, self.destination_point)
+        self.hide_mission_row((mission_id, self.destination_point))
+    
+    def delivery_failed(self, reason):
+        """The approved delivery could not be recorded: the mission stays expected"""
+        self.delivery_error = reason
+        self.status_label.setText(f"❌ {reason}")
+        self.status_label.setStyleSheet("padding: 10px; font-size: 14px; color: red; font-weight: bold;")
+    
+    def cancel_mission(self, mission_id, destination):
+        self.mission_index.cancel(mission_id, destination)
+        self.hide_mission_row((mission_id, destination))
         
     def on_read_card(self):
         """Handle card reading - to be connected to actual card reader"""
         self.status_label.setText("Reading card...")
         self.status_label.setStyleSheet("padding: 10px; font-size: 12px; color: blue;")
-        print("Card read initiated - waiting for card data...")
-    
-    def read_data_with_additional_frames(self, file_id, offset, length):
-        """Read data from card and handle additional frames (0xAF status)"""
-        from desfire_ev1.utils import to_3bytes
-        
-        offset_bytes = to_3bytes(offset)
-        length_bytes = to_3bytes(length)
-        
-        # Initial read
-        apdu = [0x90, 0xBD, 0x00, 0x00, 0x07, file_id] + offset_bytes + length_bytes + [0x00]
-        data, sw1, sw2 = self.card_manager.transmit(apdu)
-        
-        all_data = list(data)
-        
-        # Keep fetching additional frames while sw2 == 0xAF
-        frame_count = 1
-        while sw2 == 0xAF:
-            apdu_af = [0x90, 0xAF, 0x00, 0x00, 0x00]
-            data, sw1, sw2 = self.card_manager.transmit(apdu_af)
-            all_data.extend(data)
-            frame_count += 1
-            print(f"  Fetched additional frame {frame_count}, total: {len(all_data)} bytes")
-        
-        print(f"  ✓ Read complete: {len(all_data)} bytes in {frame_count} frame(s)")
-        return all_data
+        log.debug("Card read initiated - waiting for card data...")
     
+    @profiler.profiled("read_compressed_image_from_card", "card")
     def read_compressed_image_from_card(self):
         """Read compressed image from card with additional frame handling"""
-        driver_pic_file_id = 0x02
+        driver_pic_file_id = self.card_layout.photo[1]
         
         try:
-            print(f"\n📸 Reading image from card...")
+            if not self.card_layout.sealed:
+                return self.read_legacy_image(driver_pic_file_id)
+            # Header (4 bytes), metadata and image in one verified read
+            payload = self.segment_reader.read_framed(driver_pic_file_id, 0, comm_mode=self.comm_mode)
+            meta_len = payload[0] | (payload[1] << 8) | (payload[2] << 16) | (payload[3] << 24)
             
-            # Read header (4 bytes)
-            header = self.read_data_with_additional_frames(driver_pic_file_id, offset=0, length=4)
-            meta_len = header[0] | (header[1] << 8) | (header[2] << 16) | (header[3] << 24)
+            with profiler.span("parse_photo_meta", "json"):
+                meta = json.loads(payload[4:4 + meta_len].decode('utf-8'))
             
-            print(f"  Metadata length: {meta_len} bytes")
-            
-            # Read metadata
-            meta_bytes = self.read_data_with_additional_frames(driver_pic_file_id, offset=4, length=meta_len)
-            meta = json.loads(bytes(meta_bytes).decode('utf-8'))
-            
-            print(f"  Metadata: {meta}")
-            
-            # Read image data using stored length
+            # Image data using stored length
             data_offset = 4 + meta_len
-            data_length = meta.get('data_length', 996)
-            
-            print(f"  Reading image data: {data_length} bytes from offset {data_offset}")
-            data = self.read_data_with_additional_frames(driver_pic_file_id, offset=data_offset, length=data_length)
+            data_length = meta.get('data_length', len(payload) - data_offset)
             
-            print(f"  ✓ Image data read: {len(data)} bytes")
-            
-            return bytes(data), meta
+            log.debug("Image data: %d bytes at offset %d (metadata %d bytes)", data_length, data_offset, meta_len)
+            return payload[data_offset:data_offset + data_length], meta
             
         except Exception as e:
-            print(f"❌ Error reading compressed image: {e}")
-            import traceback
-            traceback.print_exc()
+            log.exception("Error reading compressed image: %s", e)
             return None, None
+
+    def read_legacy_image(self, driver_pic_file_id):
+        """Photo of a layout without CRCs: header (4 bytes), metadata, then the image, read in turn"""
+        header = self.file_manager.read_data(driver_pic_file_id, 0, 4, comm_mode=self.comm_mode)
+        meta_len = header[0] | (header[1] << 8) | (header[2] << 16) | (header[3] << 24)
+        
+        meta_bytes = self.file_manager.read_data(driver_pic_file_id, 4, meta_len, comm_mode=self.comm_mode)
+        with profiler.span("parse_photo_meta", "json"):
+            meta = json.loads(bytes(meta_bytes).decode('utf-8'))
+        
+        data_offset = 4 + meta_len
+        data_length = meta.get('data_length', 996)
+        log.debug("Reading image data: %d bytes from offset %d (metadata %d bytes)", data_length, data_offset, meta_len)
+        data = self.file_manager.read_data(driver_pic_file_id, data_offset, data_length, comm_mode=self.comm_mode)
+        return bytes(data), meta
         
     def validate_and_display_card(self, card_data):
         """
@@ -250,12 +272,7 @@ class DestinationInterface(QWidget):
         mission_id = card_data['mission']['mission_id']
         
         # Check if mission is expected
-        mission_found = None
-        for mission in self.expected_missions:
-            if (mission.get('mission_id') == mission_id and 
-                mission.get('destination') == self.destination_point):
-                mission_found = mission
-                break
+        mission_found = self.mission_index.get(mission_id, self.destination_point)
         
         if not mission_found:
             # Mission not found or wrong destination
@@ -281,6 +298,7 @@ class DestinationInterface(QWidget):
         self.status_label.setText("✅ VALID MISSION")
         self.status_label.setStyleSheet("padding: 10px; font-size: 14px; color: green; font-weight: bold;")
         
+    @profiler.profiled("display_card_info", "qt")
     def display_card_info(self, card_data):
         """Display card information including photo read directly from card"""
         # Show the card info box
@@ -299,57 +317,46 @@ class DestinationInterface(QWidget):
         self.driver_name_label.setText(driver['name'])
         self.driver_license_label.setText(driver.get('license', '-'))
         
-        # === Debug: Check if managers are available ===
-        print(f"\n🔍 DEBUG display_card_info:")
-        print(f"  card_manager: {self.card_manager}")
-        print(f"  file_manager: {self.file_manager}")
-
         # === Read and display photo directly from card ===
         if self.card_manager and self.file_manager:
             try:
-                print("\n📸 Loading driver photo from card...")
-                
                 # Select driver application and authenticate
-                print("  Selecting driver app...")
-                self.card_manager.select_application([0x00, 0x00, 0x01])
-                print("  Authenticating...")
-                auth_success = self.card_manager.authenticate([0x00], bytes([0x00] * 8))
-                print(f"  Auth result: {auth_success}")
+                photo_app_id = self.card_layout.photo[0]
+                if self.authenticate_app:
+                    auth_success = self.authenticate_app(photo_app_id)
+                else:
+                    self.card_manager.select_application(photo_app_id)
+                    auth_success = self.card_manager.authenticate([0x00], bytes([0x00] * 8))
+                log.debug("Driver app auth result: %s", auth_success)
                 # Read compressed image with additional frame handling
-                print("  Reading compressed image...")
                 compressed_data, meta = self.read_compressed_image_from_card()
                 
                 if compressed_data and meta:
-                    print(f"  ✓ Got data: {len(compressed_data)} bytes")
-                    print(f"  ✓ Meta: {meta}")
-                    print(f"  Decompressing...")                    
                     # Decompress using pic_codec
                     recon_img = self.image_processor.decompress(compressed_data, meta)
-                    print(f"  ✓ Decompressed shape: {recon_img.shape}")
-                    # Convert OpenCV BGR image to QImage
-                    height, width, channel = recon_img.shape
-                    bytes_per_line = 3 * width
-                    
-                    # OpenCV uses BGR, Qt uses RGB - convert
-                    rgb_image = cv2.cvtColor(recon_img, cv2.COLOR_BGR2RGB)
-                    
-                    q_image = QImage(rgb_image.data, width, height, bytes_per_line, QImage.Format_RGB888)
-                    
-                    # Create pixmap and scale for display
-                    pixmap = QPixmap.fromImage(q_image)
-                    scaled_pixmap = pixmap.scaled(200, 150, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-                    
-                    self.driver_photo_label.setPixmap(scaled_pixmap)
-                    self.driver_photo_label.setText("")
-                    
-                    print("  ✓ Photo displayed successfully")
+                    log.debug("Decompressed %d bytes to shape %s", len(compressed_data), recon_img.shape)
+                    with profiler.span("display_photo", "qt"):
+                        # Convert OpenCV BGR image to QImage
+                        height, width, channel = recon_img.shape
+                        bytes_per_line = 3 * width
+                        
+                        # OpenCV uses BGR, Qt uses RGB - convert
+                        rgb_image = cv2.cvtColor(recon_img, cv2.COLOR_BGR2RGB)
+                        
+                        q_image = QImage(rgb_image.data, width, height, bytes_per_line, QImage.Format_RGB888)
+                        
+                        # Create pixmap and scale for display
+                        pixmap = QPixmap.fromImage(q_image)
+                        scaled_pixmap = pixmap.scaled(200, 150, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+                        
+                        self.driver_photo_label.setPixmap(scaled_pixmap)
+                        self.driver_photo_label.setText("")
+
                 else:
                     self.driver_photo_label.setText("No photo data")
                     
             except Exception as e:
-                print(f"❌ Error loading photo: {e}")
-                import traceback
-                traceback.print_exc()
+                log.exception("Error loading photo: %s", e)
                 self.driver_photo_label.setText(f"Error: {str(e)}")
         else:
             # Fallback: use photo_data from card_data if card/file managers not available
@@ -374,12 +381,7 @@ class DestinationInterface(QWidget):
                     self.driver_photo_label.setText(f"Error: {str(e)}")
         
         # Articles
-        articles = card_data['articles']
-        self.articles_table.setRowCount(len(articles))
-        
-        for row, article in enumerate(articles):
-            self.articles_table.setItem(row, 0, QTableWidgetItem(article['code']))
-            self.articles_table.setItem(row, 1, QTableWidgetItem(str(article['quantity'])))
+        self.articles_model.reset(card_data['articles'])
         
     def on_approve_delivery(self):
         """Handle delivery approval"""
@@ -394,10 +396,17 @@ class DestinationInterface(QWidget):
         )
         
         if reply == QMessageBox.Yes:
+            # The handler runs before emit returns and reports a failure through delivery_failed
+            self.delivery_error = None
             self.card_validated.emit({
                 'action': 'approved',
                 'data': self.current_card_data
             })
+            if self.delivery_error is not None:
+                QMessageBox.critical(self, "Delivery Not Recorded",
+                                     f"{self.delivery_error}.\n\nKeep the card on the reader and approve again.")
+                return
+            self.deliver_mission(self.current_card_data['mission']['mission_id'])
             
             QMessageBox.information(self, "Success", "Delivery approved!")
             self.reset_interface()
@@ -439,9 +448,14 @@ class DestinationInterface(QWidget):
         self.back_clicked.emit()
         
     def set_expected_missions(self, missions_list):
-        """Update expected missions from external source"""
-        self.expected_missions = missions_list
-        self.load_expected_missions()
+        """Update expected missions from external source, touching only the rows that changed"""
+        added, removed = self.mission_index.replace_all(missions_list)
+        for key in removed:
+            self.hide_mission_row(key)
+        for key in added:
+            if key[1] == self.destination_point:
+                self.show_mission_row(self.mission_index.get(*key))
+        log.debug("Expected missions: %d added, %d removed", len(added), len(removed))
         
     def set_destination_point(self, destination):
         """Update the destination point"""
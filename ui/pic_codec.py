@@ -5,6 +5,8 @@ from compressai.zoo import bmshj2018_factorized
 import hashlib
 from typing import List, Any, Union
 import json
+from desfire_ev1.metrics import default_metrics
+from desfire_ev1.profiler import profiler
 
 class CardImageCodec:
     def __init__(
@@ -12,7 +14,9 @@ class CardImageCodec:
         quality=4,
         image_size=(128, 128),
         device=None,
+        metrics=None,
     ):
+        self.metrics = metrics if metrics is not None else default_metrics
         self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
         self.image_size = image_size
     
@@ -32,9 +36,10 @@ class CardImageCodec:
         return img.to(self.device)
 
     def compress(self, image_path):
-        x = self._preprocess(image_path)
+        with self.metrics.timed("codec_preprocess"):
+            x = self._preprocess(image_path)
 
-        with torch.no_grad():
+        with self.metrics.timed("codec_compress"), profiler.span("compress", "neural"), torch.no_grad():
             out = self.model.compress(x)
 
         strings = out["strings"]
@@ -53,7 +58,7 @@ class CardImageCodec:
         strings = [[data]]
         shape = meta["shape"]
 
-        with torch.no_grad():
+        with self.metrics.timed("codec_decompress"), profiler.span("decompress", "neural"), torch.no_grad():
             recon = self.model.decompress(strings, shape)["x_hat"]
 
         recon_img = recon.squeeze().cpu().numpy()
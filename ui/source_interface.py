@@ -3,11 +3,17 @@
 
 from PyQt5.QtWidgets import (QWidget, QVBoxLayout, QHBoxLayout, QPushButton, 
                              QLabel, QLineEdit, QGroupBox, QFormLayout, 
-                             QTableWidget, QTableWidgetItem, QFileDialog, 
-                             QComboBox, QCompleter)
+                             QTableView, QHeaderView, QFileDialog, 
+                             QComboBox)
 from PyQt5.QtGui import QPixmap
 from PyQt5.QtCore import Qt, pyqtSignal
-from .pic_codec import CardImageCodec, HashManager
+from .pic_codec import CardImageCodec
+from .table_models import RecordTableModel
+from .article_completer import ArticleCompleter
+from mission.catalog import ArticleIndex
+import logging
+
+log = logging.getLogger(__name__)
 
 class SourceInterface(QWidget):
     # Signal to go back to main interface
@@ -26,11 +32,13 @@ class SourceInterface(QWidget):
         # Trucks database - store full objects
         self.trucks_database = trucks_list if trucks_list else []
         
-        # Create lookup dictionaries for easy access
-        self.articles_by_content = {item['content']: item for item in self.articles_database}
+        # Article lookup and search by content or ID
+        self.article_index = ArticleIndex(self.articles_database)
         self.trucks_by_display = {}
         
-        self.hashManager = HashManager()
+        # Chosen articles (copies with their quantity), one row per article content
+        self.articles_model = RecordTableModel([("Article", 'content'), ("Quantity", 'quantity')],
+                                               key=lambda article: article['content'], editable=['quantity'])
         
         self.init_ui()
         
@@ -119,11 +127,9 @@ class SourceInterface(QWidget):
         self.article_search_input = QLineEdit()
         self.article_search_input.setPlaceholderText("Search and select article...")
         
-        # Setup autocomplete with article names only
-        article_names = [item['content'] for item in self.articles_database]
-        completer = QCompleter(article_names)
-        completer.setCaseSensitivity(Qt.CaseInsensitive)
-        self.article_search_input.setCompleter(completer)
+        # Autocomplete with the top matches of the index for each keystroke
+        self.article_completer = ArticleCompleter(self.article_index, parent=self)
+        self.article_completer.attach(self.article_search_input)
         
         # Add button
         add_article_btn = QPushButton("Add to Table")
@@ -139,13 +145,12 @@ class SourceInterface(QWidget):
         table_label.setStyleSheet("font-weight: bold; font-size: 12px;")
         main_layout.addWidget(table_label)
         
-        self.articles_table = QTableWidget()
-        self.articles_table.setColumnCount(2)
-        self.articles_table.setHorizontalHeaderLabels(["Article", "Quantity"])
-        self.articles_table.setRowCount(0)  # Start with 0 rows
+        self.articles_table = QTableView()
+        self.articles_table.setModel(self.articles_model)  # Article read-only, Quantity editable
         self.articles_table.horizontalHeader().setStretchLastSection(True)
+        self.articles_table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.articles_table.setSelectionBehavior(QTableView.SelectRows)
         
-        # Make Article column read-only, Quantity editable
         self.articles_table.setColumnWidth(0, 300)
         
         main_layout.addWidget(self.articles_table)
@@ -165,50 +170,50 @@ class SourceInterface(QWidget):
         submit_btn.clicked.connect(self.on_submit)
         main_layout.addWidget(submit_btn)
         
+        # Write the oldest staged mission to the card on the reader
+        self.write_card_btn = QPushButton("Write Next Card")
+        self.write_card_btn.setStyleSheet("background-color: #2196F3; color: white; padding: 10px;")
+        self.write_card_btn.setEnabled(False)
+        main_layout.addWidget(self.write_card_btn)
+        
+        # Why the last submitted form could not be staged
+        self.status_label = QLabel("")
+        self.status_label.setWordWrap(True)
+        self.status_label.setStyleSheet("padding: 5px; color: red;")
+        main_layout.addWidget(self.status_label)
+        
     def add_article_to_table(self):
         """Add selected article to table with default quantity of 1"""
         article_name = self.article_search_input.text().strip()
         
-        # Check if article exists in database
-        if article_name not in self.articles_by_content:
-            print(f"Article '{article_name}' not found in database")
+        # Check if article exists in database (by content, or by ID)
+        article = self.article_index.get(article_name) or self.article_index.by_id(article_name)
+        if article is None:
+            log.debug("Article %r not found in database", article_name)
             return
+        article_name = article['content']
             
         # Check if article already exists in table
-        for row in range(self.articles_table.rowCount()):
-            existing_article = self.articles_table.item(row, 0)
-            if existing_article and existing_article.text() == article_name:
-                print(f"Article '{article_name}' already in table")
-                return
-        
-        # Add new row
-        current_rows = self.articles_table.rowCount()
-        self.articles_table.insertRow(current_rows)
-        
-        # Add article name (read-only)
-        article_item = QTableWidgetItem(article_name)
-        article_item.setFlags(article_item.flags() & ~Qt.ItemIsEditable)  # Make read-only
-        
-        # Store the full article object as item data for later retrieval
-        article_item.setData(Qt.UserRole, self.articles_by_content[article_name])
-        
-        self.articles_table.setItem(current_rows, 0, article_item)
+        if article_name in self.articles_model:
+            log.debug("Article %r already in table", article_name)
+            return
         
-        # Add default quantity (editable)
-        quantity_item = QTableWidgetItem("1")
-        self.articles_table.setItem(current_rows, 1, quantity_item)
+        # Add new row: a copy of the full article object with the default quantity (editable)
+        article_with_quantity = article.copy()
+        article_with_quantity['quantity'] = "1"
+        self.articles_model.put(article_with_quantity)
         
         # Clear search input
         self.article_search_input.clear()
         
-        print(f"Added: {article_name} with quantity 1")
+        log.debug("Added: %s with quantity 1", article_name)
         
     def remove_selected_row(self):
         """Remove the currently selected row"""
-        current_row = self.articles_table.currentRow()
+        current_row = self.articles_table.currentIndex().row()
         if current_row >= 0:
-            self.articles_table.removeRow(current_row)
-            print(f"Removed row {current_row}")
+            self.articles_model.remove_row(current_row)
+            log.debug("Removed row %d", current_row)
         
     def upload_image(self):
         """Open file dialog to upload an image"""
@@ -226,7 +231,7 @@ class SourceInterface(QWidget):
             scaled_pixmap = pixmap.scaled(200, 100, Qt.KeepAspectRatio, Qt.SmoothTransformation)
             self.image_label.setPixmap(scaled_pixmap)
             self.image_label.setText("")  # Clear the "No image" text
-            print(f"Image uploaded: {file_path}")
+            log.debug("Image uploaded: %s", file_path)
             
     def on_back_clicked(self):
         """Emit signal to go back to main interface"""
@@ -246,57 +251,43 @@ class SourceInterface(QWidget):
         destination = self.destination_input.text()
         
         # Collect table data with full article objects
-        articles = []
-        for row in range(self.articles_table.rowCount()):
-            article_item = self.articles_table.item(row, 0)
-            quantity_item = self.articles_table.item(row, 1)
-            
-            if article_item and quantity_item:
-                # Get the full article object stored in item data
-                article_obj = article_item.data(Qt.UserRole)
-                quantity = quantity_item.text()
-                
-                if article_obj and quantity:
-                    # Add quantity to the article object
-                    article_with_quantity = article_obj.copy()
-                    article_with_quantity['quantity'] = quantity
-                    articles.append(article_with_quantity)
-        
-        # Process image if it exists
-        image_vector = None
-        if self.image_path:
-            total_size, data, meta = self.image_processor.usable_compress(self.image_path)
-        
-        hashed = self.hashManager.hash_list(articles)
-        
-        # Create form data dictionary
+        articles = [article.copy() for article in self.articles_model.records() if article['quantity']]
+        
+        # Create form data dictionary; the image is compressed when the card is staged
         form_data = {
             "driver_name": driver_name,
             "driver_license": driver_license,
-            "image_vec": data,
-            "image_metaData": meta,
+            "image_path": self.image_path,
+            "image_vec": None,
+            "image_metaData": None,
             "mission_status": status,
             "truck": selected_truck,  # Full truck object or None
             "source": source,
             "destination": destination,
-            "articles": articles,  # Full article objects with quantity
-            "hashed_articles_table": hashed
+            "articles": articles  # Full article objects with quantity
         }
         
-        print(f"Selected truck: {selected_truck}")
-        print(f"Articles with full data: {articles}")
+        log.debug("Selected truck: %s", selected_truck)
+        log.debug("Articles with full data: %s", articles)
+        self.status_label.setText("")
         self.form_submitted.emit(form_data)
     
+    def set_staged_count(self, count):
+        """Show how many staged cards wait for the reader"""
+        self.write_card_btn.setText(f"Write Next Card ({count} staged)" if count else "Write Next Card")
+        self.write_card_btn.setEnabled(count > 0)
+    
+    def show_staging_error(self, mission_id, message):
+        """A submitted form could not be staged: no card will be written for it"""
+        self.status_label.setText(f"❌ Mission {mission_id} not staged: {message}")
+    
     def set_articles_database(self, articles_list):
         """Update the articles database from external source"""
         self.articles_database = articles_list
-        self.articles_by_content = {item['content']: item for item in self.articles_database}
+        self.article_index = ArticleIndex(self.articles_database)
         
         # Update autocomplete
-        article_names = [item['content'] for item in self.articles_database]
-        completer = QCompleter(article_names)
-        completer.setCaseSensitivity(Qt.CaseInsensitive)
-        self.article_search_input.setCompleter(completer)
+        self.article_completer.set_index(self.article_index)
     
     def set_trucks_database(self, trucks_list):
         """Update the trucks database from external source"""
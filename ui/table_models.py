@@ -0,0 +1,117 @@
+# table_models.py
+
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex
+
+
+class RecordTableModel(QAbstractTableModel):
+    def __init__(self, columns, key=None, editable=(), parent=None):
+        """Table model over a list of dict records, one row per record.
+
+        `columns` is a list of (header, field). Views ask only for the cells
+        they paint, so no per-cell item exists; rows are inserted, updated
+        and removed one at a time with the matching model signals, and `key`
+        (a function of the record) finds a row without scanning. Fields in
+        `editable` can be edited in the view.
+        """
+        super().__init__(parent)
+        self.columns = list(columns)
+        self.key = key
+        self.editable = set(editable)
+        self._records = []
+        self._rows = {}  # key -> row
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self._records)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        record = self._records[index.row()]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            value = record.get(self.columns[index.column()][1])
+            return '-' if value is None else str(value)
+        if role == Qt.UserRole:
+            return record
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.columns[section][0]
+        return None
+
+    def flags(self, index):
+        flags = super().flags(index)
+        if index.isValid() and self.columns[index.column()][1] in self.editable:
+            flags |= Qt.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if role != Qt.EditRole or not index.isValid():
+            return False
+        field = self.columns[index.column()][1]
+        if field not in self.editable:
+            return False
+        self._records[index.row()][field] = value
+        self.dataChanged.emit(index, index, [Qt.DisplayRole, Qt.EditRole])
+        return True
+
+    def reset(self, records):
+        """Replace every record (one model reset)"""
+        self.beginResetModel()
+        self._records = list(records)
+        self._reindex(0)
+        self.endResetModel()
+
+    def put(self, record):
+        """Append a record, or update the row holding its key"""
+        row = self._rows.get(self.key(record)) if self.key else None
+        if row is not None:
+            self._records[row] = record
+            self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.columns) - 1))
+            return row
+        row = len(self._records)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self._records.append(record)
+        if self.key:
+            self._rows[self.key(record)] = row
+        self.endInsertRows()
+        return row
+
+    def remove(self, key):
+        """Drop the row of a key; returns its record or None"""
+        row = self._rows.get(key)
+        return self.remove_row(row) if row is not None else None
+
+    def remove_row(self, row):
+        if not 0 <= row < len(self._records):
+            return None
+        self.beginRemoveRows(QModelIndex(), row, row)
+        record = self._records.pop(row)
+        if self.key:
+            del self._rows[self.key(record)]
+            self._reindex(row)
+        self.endRemoveRows()
+        return record
+
+    def record(self, row):
+        return self._records[row]
+
+    def records(self):
+        return list(self._records)
+
+    def _reindex(self, start):
+        if not self.key:
+            return
+        if start == 0:
+            self._rows = {}
+        for row in range(start, len(self._records)):
+            self._rows[self.key(self._records[row])] = row
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __len__(self):
+        return len(self._records)